@@ -0,0 +1,160 @@
+"""Stress the money endpoints concurrently: check for lost updates and measure how throughput
+scales as families are added.
+
+    python -m benchmarks.bench_contention [--families 1 2 4 8] [--ops 2000]
+    python -m benchmarks.bench_contention --no-locks --families 1 --members-per-family 2 --ops 20000
+
+Threads: every family gets --threads workers calling resolve_debt around its debt ring (the
+handler FastAPI would run on its threadpool), with a tiny GIL switch interval so interleavings
+that lose an update actually happen. Afterwards every balance and debt must equal its start value
+plus the sum of the successful calls ("drift" counts the cents that do not). --no-locks swaps
+database.member_locks for a no-op to show the drift the locks prevent. These handlers are pure
+Python, so their throughput is bounded by the GIL: it should hold steady as families are added,
+not collapse the way one global lock would make it.
+
+Async: pay_merchant over ASGI against benchmarks.fake_nessie with upstream latency, passing
+`wait` so each call answers once the outbox has made the purchase. Each family adds its own
+concurrent callers; with per-member locks never held across the Nessie call,
+throughput grows about linearly with families until the event loop runs out of CPU.
+"""
+import argparse
+import asyncio
+import contextlib
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+import httpx
+from fastapi import HTTPException
+
+import database
+import main
+import nessie_client
+import outbox
+from benchmarks import fake_nessie
+from benchmarks.dataset import populate, reset
+from routers import requests as requests_router
+
+AMOUNT = 0.01
+
+
+def _ring(family_id: str):
+    roster = database.lookup("members_by_family", family_id)
+    return [(m, next(iter(database.members_db[m].debts))) for m in roster]
+
+
+def _threaded(families: int, members: int, per_family: int, ops: int) -> dict:
+    reset()
+    populate(families, members, debt=ops * AMOUNT * 2)
+    start = {m.id: (m.balance, dict(m.debts)) for m in database.members_db.values()}
+    paid = Counter()  # (borrower, lender) -> successful resolve_debt calls
+    paid_lock = threading.Lock()
+
+    def worker(ring, seed):
+        rng = random.Random(seed)
+        done = Counter()
+        for _ in range(ops):
+            borrower, lender = rng.choice(ring)
+            try:
+                requests_router.resolve_debt(borrower, lender, AMOUNT)
+                done[(borrower, lender)] += 1
+            except HTTPException:
+                pass
+        with paid_lock:
+            paid.update(done)
+
+    threads = [threading.Thread(target=worker, args=(_ring(f), i * per_family + k))
+               for i, f in enumerate(database.families_db) for k in range(per_family)]
+    began = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - began
+
+    drift = 0
+    for member_id, (balance, debts) in start.items():
+        expected = balance
+        for (borrower, lender), n in paid.items():
+            if borrower == member_id:
+                expected -= n * AMOUNT
+            if lender == member_id:
+                expected += n * AMOUNT
+        member = database.members_db[member_id]
+        drift += abs(round((member.balance - expected) * 100))
+        for lender, owed in debts.items():
+            drift += abs(round((member.debts.get(lender, 0) - (owed - paid[(member_id, lender)] * AMOUNT)) * 100))
+    return {"calls": sum(paid.values()), "ops_per_s": len(threads) * ops / elapsed, "drift_cents": drift}
+
+
+async def _async(families: int, members: int, per_member: int, latency: str) -> dict:
+    reset()
+    populate(families, members)
+    fake_app = fake_nessie.create_app(fake_nessie.FakeConfig(latency=latency, seed=0))
+    for member in database.members_db.values():
+        fake_nessie.add_account(fake_app, member.nessie_account_id[0]["_id"], 1_000_000.0)
+    merchant = next(iter(fake_app.state.fake.merchants))
+    start = {m.id: m.balance for m in database.members_db.values()}
+    database.flusher.start()
+    outbox.dispatcher.start()
+    await nessie_client.close()
+    await nessie_client.start(httpx.ASGITransport(app=fake_app))
+    ok = Counter()
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://bench") as client:
+            async def buyer(member_id):
+                for _ in range(per_member):
+                    res = await client.post("/merchants/pay", params={
+                        "member_id": member_id, "merchant_id": merchant, "amount": AMOUNT, "wait": 30})
+                    if res.status_code == 200:
+                        ok[member_id] += 1
+
+            began = time.perf_counter()
+            await asyncio.gather(*(buyer(m) for m in list(database.members_db)))
+            elapsed = time.perf_counter() - began
+    finally:
+        await outbox.dispatcher.stop()
+        await database.flusher.stop()
+        await nessie_client.close()
+
+    drift = 0
+    for member_id, balance in start.items():
+        member = database.members_db[member_id]
+        drift += abs(round((member.balance - (balance - ok[member_id] * AMOUNT)) * 100))
+        account = fake_app.state.fake.accounts[member.nessie_account_id[0]["_id"]]
+        drift += abs(round((account["balance"] - (1_000_000.0 - ok[member_id] * AMOUNT)) * 100))
+    calls = members * families * per_member
+    return {"calls": sum(ok.values()), "ops_per_s": calls / elapsed, "drift_cents": drift}
+
+
+def main_() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--families", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--members-per-family", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=2, help="resolve_debt threads per family")
+    parser.add_argument("--ops", type=int, default=2000, help="resolve_debt calls per thread")
+    parser.add_argument("--purchases", type=int, default=20, help="pay_merchant calls per member")
+    parser.add_argument("--nessie-latency", default="fixed:100")
+    parser.add_argument("--no-locks", action="store_true")
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix="bench_contention_"))
+    database.init()
+    if args.no_locks:
+        database.member_locks = lambda *ids: contextlib.nullcontext()
+    sys.setswitchinterval(1e-6)
+
+    print(f"{'families':>8}  {'resolve_debt ops/s':>18} {'drift':>6}   {'pay_merchant ops/s':>18} {'drift':>6}")
+    for families in args.families:
+        threaded = _threaded(families, args.members_per_family, args.threads, args.ops)
+        purchases = asyncio.run(_async(families, args.members_per_family, args.purchases, args.nessie_latency))
+        print(f"{families:>8}  {threaded['ops_per_s']:>18.0f} {threaded['drift_cents']:>6}   "
+              f"{purchases['ops_per_s']:>18.0f} {purchases['drift_cents']:>6}")
+
+
+if __name__ == "__main__":
+    main_()
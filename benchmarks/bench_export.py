@@ -0,0 +1,89 @@
+"""Family export: peak memory of streaming NDJSON against building the export as one document.
+
+    python -m benchmarks.bench_export [--histories 2000,10000,40000] [--window 200]
+
+One family of --members-per-family members, each recording --history transfers to the next
+member (so every transfer is in two members' lists), archived every 1000 per member as the
+archiver would. Each history size runs in its own interpreter. Reported: lines exported, the
+tracemalloc peak while consuming GET /family/{id}/export's generator against joining all of
+its lines first, the time to the first chunk and the total time.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from uuid import uuid4
+
+
+def _run(args) -> dict:
+    os.environ["HISTORY_HOT_WINDOW"] = str(args.window)
+    import database
+    import history
+    from benchmarks.dataset import populate
+    from models import Transaction
+    from routers import family as family_router
+
+    database.init()
+    populate(1, args.members_per_family)
+    family_id = next(iter(database.families_db))
+    roster = sorted(database.lookup("members_by_family", family_id))
+    for done in range(0, args.history, 1000):
+        for i, member_id in enumerate(roster):
+            other = roster[(i + 1) % len(roster)]
+            for _ in range(min(1000, args.history - done)):
+                database.record_transaction(Transaction(
+                    id=str(uuid4()), type_transaction="transfer", from_id=member_id, to_id=other,
+                    from_name=member_id, to_name=other, amount=1.0, from_debt=0.0, to_debt=0.0),
+                    member_id, other)
+        history.archive_due()
+    database.sync()
+
+    report = {"segments": len(database.segments_db)}
+    for mode in ("stream", "document"):
+        tracemalloc.start()
+        began = time.perf_counter()
+        first = None
+        lines = 0
+        chunks = family_router._export_lines(roster, None, None)
+        if mode == "document":
+            chunks = [b"".join(list(chunks))]
+        for chunk in chunks:
+            first = first or time.perf_counter() - began
+            lines += chunk.count(b"\n")
+        report[mode] = {"lines": lines, "peak_mb": tracemalloc.get_traced_memory()[1] / 2**20,
+                        "first_ms": first * 1000, "seconds": time.perf_counter() - began}
+        tracemalloc.stop()
+    return report
+
+
+def main_() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--histories", default="2000,10000,40000", help="transfers per member, per run")
+    parser.add_argument("--history", type=int)
+    parser.add_argument("--members-per-family", type=int, default=5)
+    parser.add_argument("--window", type=int, default=200, help="HISTORY_HOT_WINDOW")
+    args = parser.parse_args()
+
+    if args.history is not None:
+        os.chdir(tempfile.mkdtemp(prefix="bench_export_"))
+        print(json.dumps(_run(args)))
+        return
+
+    print(f"{'history':>8} {'segments':>9} {'mode':<9} {'lines':>8} {'peak MB':>8} {'first ms':>9} {'seconds':>8}")
+    for n in args.histories.split(","):
+        out = subprocess.run([sys.executable, "-m", "benchmarks.bench_export", "--history", n,
+                              "--members-per-family", str(args.members_per_family), "--window", str(args.window)],
+                             capture_output=True, text=True, check=True)
+        report = json.loads(out.stdout.strip().splitlines()[-1])
+        for mode in ("stream", "document"):
+            r = report[mode]
+            print(f"{n:>8} {report['segments']:>9} {mode:<9} {r['lines']:>8} {r['peak_mb']:>8.1f} "
+                  f"{r['first_ms']:>9.1f} {r['seconds']:>8.2f}")
+
+
+if __name__ == "__main__":
+    main_()
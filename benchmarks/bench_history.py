@@ -0,0 +1,75 @@
+"""Tiered history: what archiving old transactions into segments saves, and what reads cost.
+
+    python -m benchmarks.bench_history [--families 100] [--history 2000] [--window 200]
+
+Every member gets --history transactions, then history.archive_due() moves everything past the
+last --window entries into segment files. Reported before and after: records held in
+transactions_db, the encoded size of the member records (rewritten by every sync() that touches
+a member) and of the compacted snapshot. Then the latency of the newest page (from memory) and
+of the oldest page (from a segment, first read and cached) of GET /members/{id}/transactions.
+"""
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import time
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--families", type=int, default=100)
+parser.add_argument("--members-per-family", type=int, default=5)
+parser.add_argument("--history", type=int, default=2000, help="transactions per member")
+parser.add_argument("--window", type=int, default=200, help="HISTORY_HOT_WINDOW")
+args = parser.parse_args()
+os.environ["HISTORY_HOT_WINDOW"] = str(args.window)
+os.environ.setdefault("STORAGE_BACKEND", "json")
+
+import database  # noqa: E402
+import history  # noqa: E402
+from benchmarks.dataset import populate  # noqa: E402
+from routers import members as members_router  # noqa: E402
+
+
+def sizes() -> dict:
+    database.sync()
+    database.compact()
+    members = sum(len(json.dumps(database._to_plain(m))) for m in database.members_db.values())
+    snapshot = os.path.getsize("data/snapshot.bin") if os.path.exists("data/snapshot.bin") else 0
+    return {"records": len(database.transactions_db), "members_mb": members / 2**20, "snapshot_mb": snapshot / 2**20}
+
+
+def latency(member_ids, cursor_of) -> float:
+    times = []
+    for member_id in member_ids:
+        began = time.perf_counter()
+        members_router.get_member_transactions(member_id, limit=50, cursor=cursor_of(member_id))
+        times.append(time.perf_counter() - began)
+    return statistics.median(times) * 1000
+
+
+def main_() -> None:
+    os.chdir(tempfile.mkdtemp(prefix="bench_history_"))
+    database.init()
+    populate(args.families, args.members_per_family, history=args.history)
+    before = sizes()
+    began = time.perf_counter()
+    segments = history.archive_due()
+    archived_in = time.perf_counter() - began
+    after = sizes()
+
+    print(f"{'':<8} {'tx records':>10} {'members MB':>11} {'snapshot MB':>12}")
+    for label, r in (("before", before), ("after", after)):
+        print(f"{label:<8} {r['records']:>10} {r['members_mb']:>11.1f} {r['snapshot_mb']:>12.1f}")
+    print(f"archived into {len(segments)} segments in {archived_in:.1f}s")
+
+    sample = [family.members[0] for family in list(database.families_db.values())[:200]]  # one per segment
+    newest = latency(sample, lambda m: args.history - 50)
+    history.load_segment.cache_clear()
+    oldest_cold = latency(sample, lambda m: 0)
+    oldest_warm = latency(sample[-history.HISTORY_CACHE_SEGMENTS:], lambda m: 0)
+    print(f"page of 50, median ms: newest {newest:.2f}  oldest {oldest_cold:.2f} (segment read) "
+          f"{oldest_warm:.2f} (cached)")
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,81 @@
+"""A retry storm on POST /merchants/pay, with and without Idempotency-Key.
+
+    python -m benchmarks.bench_idempotency [--purchases 200] [--copies 5] [--nessie-latency fixed:100]
+
+Each of --purchases logical purchases is sent --copies times at once, as clients retrying on a
+timeout would, over ASGI against benchmarks.fake_nessie. With keys, every copy carries the
+purchase's key. Reported: Nessie purchases made, local transactions recorded, replayed answers
+and the wall time of the storm.
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+import httpx
+
+import database
+import idempotency
+import main
+import nessie_client
+import outbox
+from benchmarks import fake_nessie
+from benchmarks.dataset import populate, reset
+
+
+async def _storm(purchases: int, copies: int, latency: str, keyed: bool) -> dict:
+    reset()
+    populate(families=20, members_per_family=5)
+    database.sync()
+    idempotency.store = idempotency.IdempotencyStore()
+    fake = fake_nessie.create_app(fake_nessie.FakeConfig(latency=latency, seed=0))
+    for member in database.members_db.values():
+        fake_nessie.add_account(fake, member.nessie_account_id[0]["_id"], 1_000_000.0)
+    merchant = next(iter(fake.state.fake.merchants))
+    members = list(database.members_db)
+    transactions = len(database.transactions_db)
+    database.flusher.start()
+    outbox.dispatcher.start()
+    await nessie_client.close()
+    await nessie_client.start(httpx.ASGITransport(app=fake))
+    replayed = 0
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://bench",
+                                     timeout=60) as client:
+            async def send(i: int):
+                nonlocal replayed
+                headers = {"Idempotency-Key": f"purchase-{i}"} if keyed else {}
+                res = await client.post("/merchants/pay", headers=headers, params={
+                    "member_id": members[i % len(members)], "merchant_id": merchant, "amount": 1, "wait": 30})
+                replayed += res.headers.get("idempotent-replayed") == "true"
+
+            began = time.perf_counter()
+            await asyncio.gather(*(send(i) for i in range(purchases) for _ in range(copies)))
+            elapsed = time.perf_counter() - began
+    finally:
+        await outbox.dispatcher.stop()
+        await database.flusher.stop()
+        await nessie_client.close()
+    return {"nessie": len(fake.state.fake.purchases), "recorded": len(database.transactions_db) - transactions,
+            "replayed": replayed, "seconds": elapsed}
+
+
+def main_() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--purchases", type=int, default=200)
+    parser.add_argument("--copies", type=int, default=5, help="concurrent copies of each request")
+    parser.add_argument("--nessie-latency", default="fixed:100")
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix="bench_idempotency_"))
+    database.init()
+    print(f"{'keys':<6} {'requests':>9} {'nessie calls':>13} {'recorded':>9} {'replayed':>9} {'seconds':>8}")
+    for keyed in (False, True):
+        r = asyncio.run(_storm(args.purchases, args.copies, args.nessie_latency, keyed))
+        print(f"{'yes' if keyed else 'no':<6} {args.purchases * args.copies:>9} {r['nessie']:>13} "
+              f"{r['recorded']:>9} {r['replayed']:>9} {r['seconds']:>8.2f}")
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,80 @@
+"""Resident memory of the transaction store: Pydantic Transaction models vs TransactionRecord.
+
+    python -m benchmarks.bench_memory [--transactions 1000000] [--members 10000]
+
+Each variant builds the store in a fresh interpreter, the way database.init() would from a
+snapshot (a dict of plain records decoded one by one), and reports the growth in resident set
+size and in Python allocations (tracemalloc, measured in a separate run), scaled to one
+million transactions.
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+CHILD = r"""
+import datetime, gc, json, random, sys, tracemalloc, uuid
+sys.path.insert(0, {repo!r})
+from models import Transaction
+from records import TransactionRecord
+
+def rss():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * 4096
+
+rng = random.Random(0)
+members = [(str(uuid.uuid4()), f"First{{i}} Last{{i}}") for i in range({members})]
+kinds = ["purchased", "debt resolution", "request fufilled", "debt settlement"]
+start = datetime.datetime(2025, 1, 1)
+def plain(i):
+    (a, a_name), (b, b_name) = rng.sample(members, 2)
+    return {{"id": str(uuid.uuid4()), "type_transaction": rng.choice(kinds), "from_id": a, "to_id": b,
+             "from_name": a_name, "to_name": b_name, "amount": round(rng.uniform(1, 200), 2),
+             "from_debt": round(rng.uniform(0, 500), 2), "to_debt": 0.0,
+             "date": (start + datetime.timedelta(seconds=i * 7.3)).isoformat(), "description": None}}
+
+# decode straight from JSON text, as a snapshot load does, so inputs do not share strings
+lines = [json.dumps(plain(i)) for i in range({n})]
+gc.collect()
+if {trace}:
+    tracemalloc.start()
+base_rss, (base_py, _) = rss(), tracemalloc.get_traced_memory()
+decode = Transaction.model_validate if {variant!r} == "pydantic" else TransactionRecord.from_plain
+store = {{}}
+for line in lines:
+    record = decode(json.loads(line))
+    store[record.id] = record
+gc.collect()
+py, _ = tracemalloc.get_traced_memory()
+print(json.dumps({{"rss": rss() - base_rss, "py": py - base_py}}))
+"""
+
+
+def measure(variant: str, n: int, members: int) -> dict:
+    # RSS from a run without tracemalloc, whose own bookkeeping would inflate it
+    import os
+
+    repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = {}
+    for trace, field in ((False, "rss"), (True, "py")):
+        code = CHILD.format(repo=repo, n=n, members=members, variant=variant, trace=trace)
+        out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+        result[field] = json.loads(out.stdout)[field]
+    return result
+
+
+def main_() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--transactions", type=int, default=1_000_000)
+    parser.add_argument("--members", type=int, default=10_000)
+    args = parser.parse_args()
+    scale = 1_000_000 / args.transactions
+    print(f"{'store':<20} {'RSS MB/1M':>10} {'Python MB/1M':>13} {'bytes/tx':>9}")
+    for variant in ("pydantic", "record"):
+        r = measure(variant, args.transactions, args.members)
+        print(f"{variant:<20} {r['rss'] * scale / 2**20:>10.0f} {r['py'] * scale / 2**20:>13.0f} "
+              f"{r['py'] / args.transactions:>9.0f}")
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,77 @@
+"""What the sampled request profiler costs, off and at several sample rates.
+
+    python -m benchmarks.bench_profiling [--requests 2000] [--concurrency 16] [--rates 0,0.01,0.1,1]
+
+Each rate runs in its own interpreter, as profiling is configured at import
+(PROFILE_SAMPLE_RATE); rate 0 is profiling off. Per endpoint: throughput and p50/p99 over
+ASGI, with the flusher running, and how many requests the profiler sampled.
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+ENDPOINTS = ("GET /members/{member_id}", "GET /members/{member_id}/transactions",
+             "POST /request/{from_id}/request_money", "POST /request/resolve_request/{request_id}")
+
+
+async def _run(args) -> dict:
+    import httpx
+
+    import database
+    import main
+    import profiling
+    from benchmarks import fake_nessie
+    from benchmarks.load import build_dataset, run_endpoint, scenarios
+
+    fake = fake_nessie.create_app(fake_nessie.FakeConfig(seed=0))
+    ctx = build_dataset(argparse.Namespace(families=200, members_per_family=5, history=20, pending=0,
+                                           requests=args.requests), fake)
+    calls = scenarios({**ctx, "scratch_family": None})  # only for the family endpoints, not run here
+    database.flusher.start()
+    report = {}
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://bench") as client:
+            for name in ENDPOINTS:
+                report[name] = await run_endpoint(client, calls[name], args.requests, args.concurrency)
+    finally:
+        await database.flusher.stop()
+    if profiling.ENABLED:
+        profiling.profiles.save()
+        report["samples"] = {entry["route"]: entry["samples"] for entry in profiling.listing()}
+    return report
+
+
+def main_() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000, help="per endpoint")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--rates", default="0,0.01,0.1,1")
+    parser.add_argument("--child", action="store_true")
+    args = parser.parse_args()
+
+    if args.child:
+        os.chdir(tempfile.mkdtemp(prefix="bench_profiling_"))
+        print(json.dumps(asyncio.run(_run(args))))
+        return
+
+    print(f"{'rate':>5} {'endpoint':<42} {'req/s':>7} {'p50 ms':>7} {'p99 ms':>7} {'sampled':>8}")
+    for rate in args.rates.split(","):
+        env = {**os.environ, "PROFILE_SAMPLE_RATE": rate}
+        out = subprocess.run([sys.executable, "-m", "benchmarks.bench_profiling", "--child",
+                              "--requests", str(args.requests), "--concurrency", str(args.concurrency)],
+                             env=env, capture_output=True, text=True, check=True)
+        report = json.loads(out.stdout.strip().splitlines()[-1])
+        samples = report.pop("samples", {})
+        for name, r in report.items():
+            sampled = samples.get(name.split(" ", 1)[1], 0)
+            print(f"{rate:>5} {name:<42} {r['throughput_rps']:>7.0f} {r['p50_ms']:>7.2f} {r['p99_ms']:>7.2f} "
+                  f"{sampled:>8}")
+        print(f"{rate:>5} {'sync()':<42} {'':>7} {'':>7} {'':>7} {samples.get('sync()', 0):>8}")
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,67 @@
+"""Cost of the family dashboard reads: encoded on every request vs cached bytes vs 304.
+
+    python -m benchmarks.bench_responses [--members-per-family 8] [--pending 20] [--requests 2000]
+
+Drives GET /family/get_members/{family_id} and GET /members/{member_id} over ASGI, first with
+the response cache disabled (every call re-encodes, like before), then warm, then with the
+client echoing the ETag as a polling dashboard would.
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+import httpx
+
+import database
+import main
+import responses
+from benchmarks.dataset import populate
+
+
+async def _drive(client: httpx.AsyncClient, paths, requests: int, etags=None) -> float:
+    start = time.perf_counter()
+    for i in range(requests):
+        path = paths[i % len(paths)]
+        headers = {"If-None-Match": etags[path]} if etags else None
+        await client.get(path, headers=headers)
+    return requests / (time.perf_counter() - start)
+
+
+async def run(args) -> None:
+    database.init()
+    populate(args.families, args.members_per_family, history=args.history, pending=args.pending, debt=10.0)
+    database.sync()
+    families = list(database.families_db)
+    paths = {
+        "GET /family/get_members/{family_id}": [f"/family/get_members/{f}" for f in families],
+        "GET /members/{member_id}": [f"/members/{m}" for m in database.members_db],
+    }
+    print(f"{'endpoint':<40} {'uncached':>10} {'cached':>10} {'304':>10}  rps")
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://bench") as client:
+        for name, endpoint_paths in paths.items():
+            responses.cache.size = 0
+            uncached = await _drive(client, endpoint_paths, args.requests)
+            responses.cache.size = responses.RESPONSE_CACHE_SIZE
+            etags = {p: (await client.get(p)).headers["etag"] for p in endpoint_paths}
+            cached = await _drive(client, endpoint_paths, args.requests)
+            not_modified = await _drive(client, endpoint_paths, args.requests, etags)
+            print(f"{name:<40} {uncached:>10.0f} {cached:>10.0f} {not_modified:>10.0f}")
+    print(f"encoder: {'orjson' if responses.orjson else 'json'}")
+
+
+def main_() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--families", type=int, default=50)
+    parser.add_argument("--members-per-family", type=int, default=8)
+    parser.add_argument("--history", type=int, default=50)
+    parser.add_argument("--pending", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+    os.chdir(tempfile.mkdtemp(prefix="bench_responses_"))
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main_()
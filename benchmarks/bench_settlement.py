@@ -0,0 +1,77 @@
+"""Settle a family's debt graph edge by edge (resolve_debt) versus netted in one batch.
+
+    python -m benchmarks.bench_settlement [--members 5 10 20] [--density 0.5]
+
+Counts ledger writes (transactions recorded) and the Nessie calls a real-money settlement
+would make (a withdrawal plus a deposit per transfer), and times both paths over ASGI.
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+import httpx
+
+import database
+import main
+from benchmarks.dataset import populate
+
+
+def _add_debts(family_id: str, density: float) -> int:
+    roster = database.lookup("members_by_family", family_id)
+    edges = 0
+    for borrower in roster:
+        for lender in roster:
+            if borrower != lender and random.random() < density:
+                amount = round(random.uniform(1, 50), 2)
+                database.members_db[borrower].debts[lender] = amount
+                database.members_db[borrower].current_debt += amount
+                edges += 1
+    database.mark_dirty("members", *roster)
+    return edges
+
+
+async def _run(members: int, density: float) -> dict:
+    os.chdir(tempfile.mkdtemp(prefix="bench_settlement_"))
+    database.init()
+    populate(families=2, members_per_family=members)
+    database.sync()
+    edge_family, net_family = list(database.families_db)
+    edges = _add_debts(edge_family, density)
+    _add_debts(net_family, density)
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://bench") as client:
+        before = len(database.transactions_db)
+        start = time.perf_counter()
+        for borrower in database.lookup("members_by_family", edge_family):
+            for lender, amount in list(database.members_db[borrower].debts.items()):
+                await client.post(f"/request/resolve_debt/{borrower}/{lender}", params={"amount": amount})
+        edge_seconds = time.perf_counter() - start
+        edge_writes = len(database.transactions_db) - before
+
+        before = len(database.transactions_db)
+        start = time.perf_counter()
+        res = (await client.post(f"/family/{net_family}/settle")).json()
+        net_seconds = time.perf_counter() - start
+        net_writes = len(database.transactions_db) - before
+    return {"edges": edges, "edge_writes": edge_writes, "edge_ms": edge_seconds * 1000,
+            "transfers": len(res["transfers"]), "net_writes": net_writes, "net_ms": net_seconds * 1000}
+
+
+def main_() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--members", type=int, nargs="+", default=[5, 10, 20])
+    parser.add_argument("--density", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    print(f"{'members':>8} {'edges':>6} {'transfers':>9} {'writes':>12} {'nessie calls':>14} {'ms':>16}")
+    for members in args.members:
+        r = asyncio.run(_run(members, args.density))
+        print(f"{members:>8} {r['edges']:>6} {r['transfers']:>9} {r['edge_writes']:>5} -> {r['net_writes']:<4} "
+              f"{2 * r['edges']:>6} -> {2 * r['transfers']:<5} {r['edge_ms']:>7.1f} -> {r['net_ms']:<6.1f}")
+
+
+if __name__ == "__main__":
+    main_()
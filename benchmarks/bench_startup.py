@@ -0,0 +1,95 @@
+"""Startup time of the json backend: JSON snapshots vs the binary snapshot (data/snapshot.bin).
+
+    python -m benchmarks.bench_startup [--members 10000] [--history 100]
+
+A scratch data/ directory is filled with --members members of --history transactions each
+(1M transactions by default) and written both ways: as the per-store JSON files init() used to
+read, and as a compacted binary snapshot. Each load runs in a fresh interpreter:
+
+  json    read every data/<store>.json and validate each record, as init() did before
+  binary  database.init(): map snapshot.bin, build the small stores without validation and
+          leave transactions to decode on first access
+
+"startup" excludes importing the app's modules, which both pay alike. "first reads" is the
+extra time to fetch 1000 random members' latest 20 transactions after startup, which is where
+the binary load pays for its laziness.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PREPARE = r"""
+import os, sys
+sys.path.insert(0, {repo!r})
+os.chdir({directory!r})
+import database
+from benchmarks.dataset import populate
+database.init()
+populate({families}, 10, history={history})
+database.export_json("json/data")
+os.makedirs("binary/data")
+for name in os.listdir("json/data"):
+    os.link(os.path.join("json/data", name), os.path.join("binary/data", name))
+os.chdir("binary")
+database.init()       # imports the JSON files and starts compacting them into snapshot.bin
+database.compact()    # waits for that compaction
+for name in os.listdir("data"):
+    if name.endswith(".json"):
+        os.remove(os.path.join("data", name))
+"""
+
+LOAD = r"""
+import json, os, random, sys, time
+sys.path.insert(0, {repo!r})
+os.chdir({directory!r})
+import database
+from storage import decode, read_json_file
+began = time.perf_counter()
+if {variant!r} == "json":
+    for name, (path, model) in database.STORES.items():
+        globals()[name] = {{k: decode(model, v) for k, v in read_json_file(path).items()}}
+    members = globals()["members"]
+    transactions = globals()["transactions"]
+else:
+    database.init()
+    members, transactions = database.members_db, database.transactions_db
+startup = time.perf_counter() - began
+began = time.perf_counter()
+for member_id in random.Random(0).sample(list(members), 1000):
+    [transactions[t].to_model() for t in members[member_id].transactions[-20:]]
+first_reads = time.perf_counter() - began
+print(json.dumps({{"startup": startup, "first_reads": first_reads, "transactions": len(transactions)}}))
+"""
+
+
+def main_() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--members", type=int, default=10_000)
+    parser.add_argument("--history", type=int, default=100, help="transactions per member")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="bench_startup_")
+    try:
+        code = PREPARE.format(repo=REPO, directory=directory, families=args.members // 10, history=args.history)
+        subprocess.run([sys.executable, "-c", code], check=True)
+        print(f"{'load':<8} {'data MB':>8} {'startup s':>10} {'first reads s':>14} {'transactions':>13}")
+        for variant in ("json", "binary"):
+            data = os.path.join(directory, variant, "data")
+            size = sum(os.path.getsize(os.path.join(data, name)) for name in os.listdir(data))
+            code = LOAD.format(repo=REPO, directory=os.path.join(directory, variant), variant=variant)
+            out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+            r = json.loads(out.stdout.strip().splitlines()[-1])
+            print(f"{variant:<8} {size / 2**20:>8.0f} {r['startup']:>10.2f} {r['first_reads']:>14.3f} "
+                  f"{r['transactions']:>13}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,69 @@
+"""Startup time and request throughput for the json and sqlite storage backends.
+
+    python -m benchmarks.bench_storage [--sizes 10000 100000 1000000] [--requests 2000]
+
+Each size is generated once per backend in a scratch directory, then the process state is
+dropped and database.init() is timed as a cold start before driving requests over ASGI.
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+import httpx
+
+import database
+import main
+from benchmarks.dataset import populate
+
+
+async def _drive(member_ids, requests: int, concurrency: int) -> float:
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def worker(n):
+            for _ in range(n):
+                i = random.randrange(len(member_ids) // 10) * 10
+                if random.random() < 0.8:
+                    await client.get(f"/members/{member_ids[i]}")
+                else:
+                    await client.post(f"/request/{member_ids[i]}/request_money",
+                                      params={"to_id": member_ids[i + 1], "amount": 1})
+        database.flusher.start()
+        start = time.perf_counter()
+        await asyncio.gather(*[worker(requests // concurrency) for _ in range(concurrency)])
+        elapsed = time.perf_counter() - start
+        await database.flusher.stop()
+    return requests / elapsed
+
+
+def main_() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--backends", nargs="+", default=["json", "sqlite"])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    args = parser.parse_args()
+
+    print(f"{'backend':>8} {'members':>9} {'startup s':>10} {'req/s':>10}")
+    for size in args.sizes:
+        for backend in args.backends:
+            os.environ["STORAGE_BACKEND"] = backend
+            os.chdir(tempfile.mkdtemp(prefix=f"bench_storage_{backend}_"))
+            database.init()
+            populate(families=size // 10, members_per_family=10)
+            database.sync()
+            database.compact()
+
+            start = time.perf_counter()
+            database.init()
+            startup = time.perf_counter() - start
+            # iterating ids is cheap on both backends and not part of the measured startup
+            member_ids = list(database.members_db)
+            rps = asyncio.run(_drive(member_ids, args.requests, args.concurrency))
+            print(f"{backend:>8} {size:>9} {startup:>10.3f} {rps:>10.0f}")
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,58 @@
+"""Compare the old full-rewrite sync against dirty-tracked, journaled sync.
+
+    python -m benchmarks.bench_sync [--sizes 1000 10000] [--changes 1 10 100]
+
+Runs in a scratch directory so the repo's data/ is untouched.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import database
+from benchmarks.dataset import populate, reset
+
+
+def _full_rewrite() -> None:
+    # What every request paid before dirty tracking: all five stores re-encoded with indent=2.
+    database.save_mapping("data/members.json", database.members_db)
+    database.save_mapping("data/families.json", database.families_db)
+    database.save_mapping("data/merchants.json", database.merchants_db)
+    database.save_mapping("data/money_requests.json", database.money_requests_db)
+    database.save_mapping("data/transactions.json", database.transactions_db)
+
+
+def _timed(fn, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000])
+    parser.add_argument("--changes", type=int, nargs="+", default=[0, 1, 10, 100])
+    parser.add_argument("--history", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix="bench_sync_"))
+    print(f"{'members':>8} {'changed':>8} {'full ms':>10} {'dirty ms':>10}")
+    database.init()
+    for size in args.sizes:
+        reset()
+        populate(families=max(1, size // 10), members_per_family=10, history=args.history)
+        database.sync()
+        member_ids = list(database.members_db)
+        full = _timed(_full_rewrite, args.repeat)
+        for changes in args.changes:
+            def touch_and_sync():
+                database.mark_dirty("members", *member_ids[:changes])
+                database.sync()
+            dirty = _timed(touch_and_sync, args.repeat)
+            print(f"{size:>8} {changes:>8} {full:>10.2f} {dirty:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
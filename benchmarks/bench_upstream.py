@@ -0,0 +1,132 @@
+"""Nessie misbehaving: tail latency, pile-up and memory with and without the upstream limits.
+
+    python -m benchmarks.bench_upstream [--rate 200] [--phase-seconds 10] [--slow-latency 8000]
+
+Calls arrive open-loop at --rate per second (two thirds balance reads, one third purchases,
+straight through routers/nessie.py) against benchmarks.fake_nessie, over four phases:
+
+  healthy    lognormal latency around 40 ms
+  slow       --slow-latency ms per call
+  failing    healthy latency, but half the answers are 500s
+  recovered  healthy again
+
+Each variant runs in its own interpreter so peak RSS is its own:
+
+  unbounded  what the client did before: a 10 s timeout (NESSIE_TIMEOUT), no limits, no retries
+  limited    nessie_client as configured: route deadlines, in-flight limits with queueing,
+             circuit breaker and GET retry budget
+
+Per phase: calls answered successfully, failed (error or deadline) and refused fast (circuit
+open or queue full), p50/p99 latency of all calls, the most calls pending at once, and at the
+end the process's peak RSS.
+"""
+import argparse
+import asyncio
+import json
+import resource
+import subprocess
+import sys
+import time
+
+PHASES = ("healthy", "slow", "failing", "recovered")
+
+
+async def _run(args) -> dict:
+    import httpx
+
+    import nessie_client
+    from benchmarks import fake_nessie
+    from routers import nessie
+
+    healthy = {"latency": "lognormal:40:0.5", "error_rate": 0.0}
+    fake = fake_nessie.create_app(fake_nessie.FakeConfig(seed=0, **healthy))
+    accounts = [f"acct{i:05d}" for i in range(1000)]
+    for account_id in accounts:
+        fake_nessie.add_account(fake, account_id, 1e9)
+    merchant = next(iter(fake.state.fake.merchants))
+
+    if args.variant == "unbounded":
+        nessie_client.ROUTES = {}
+        nessie_client.DEFAULT_ROUTE = nessie_client.Route(deadline=nessie_client.TIMEOUT, limit=10**9)
+        nessie_client.MAX_IN_FLIGHT = nessie_client.MAX_QUEUE = 10**9
+    await nessie_client.start(httpx.ASGITransport(app=fake))
+    if args.variant == "unbounded":
+        nessie_client._upstream.breaker = nessie_client.CircuitBreaker(min_calls=10**9)
+        nessie_client._upstream.budget = nessie_client.RetryBudget(ratio=0, cap=0)
+
+    results = {phase: {"ok": 0, "failed": 0, "refused": 0, "latencies": [], "peak_pending": 0}
+               for phase in PHASES}
+    pending = set()
+
+    async def call(i: int, phase: str) -> None:
+        r = results[phase]
+        began = time.perf_counter()
+        try:
+            if i % 3 == 2:
+                await nessie.nessie_make_purchase(accounts[i % len(accounts)], merchant, 1)
+            else:
+                await nessie.get_nessie_account_balance(accounts[i % len(accounts)])
+            r["ok"] += 1
+        except nessie_client.Unavailable:
+            r["refused"] += 1
+        except Exception:
+            r["failed"] += 1
+        r["latencies"].append(time.perf_counter() - began)
+
+    i = 0
+    for phase in PHASES:
+        changes = {"slow": {"latency": f"fixed:{args.slow_latency}", "error_rate": 0.0},
+                   "failing": {**healthy, "error_rate": 0.5}}.get(phase, healthy)
+        for key, value in changes.items():
+            setattr(fake.state.config, key, value)
+        began = time.perf_counter()
+        while (elapsed := time.perf_counter() - began) < args.phase_seconds:
+            while i < elapsed * args.rate + (PHASES.index(phase) * args.phase_seconds * args.rate):
+                task = asyncio.get_running_loop().create_task(call(i, phase))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+                i += 1
+            results[phase]["peak_pending"] = max(results[phase]["peak_pending"], len(pending))
+            await asyncio.sleep(0.005)
+    await asyncio.gather(*pending)
+    await nessie_client.close()
+
+    report = {}
+    for phase, r in results.items():
+        latencies = sorted(r.pop("latencies"))
+        r["p50_ms"] = latencies[len(latencies) // 2] * 1000 if latencies else 0
+        r["p99_ms"] = latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0
+        report[phase] = r
+    report["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return report
+
+
+def main_() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rate", type=float, default=200, help="calls per second")
+    parser.add_argument("--phase-seconds", type=float, default=10)
+    parser.add_argument("--slow-latency", type=int, default=8000, help="ms per call while slow")
+    parser.add_argument("--variant", choices=("unbounded", "limited"))
+    args = parser.parse_args()
+
+    if args.variant:
+        print(json.dumps(asyncio.run(_run(args))))
+        return
+
+    print(f"{'variant':<10} {'phase':<10} {'ok':>6} {'failed':>7} {'refused':>8} {'p50 ms':>8} "
+          f"{'p99 ms':>8} {'pending':>8} {'RSS MB':>7}")
+    for variant in ("unbounded", "limited"):
+        out = subprocess.run([sys.executable, "-m", "benchmarks.bench_upstream", "--variant", variant,
+                              "--rate", str(args.rate), "--phase-seconds", str(args.phase_seconds),
+                              "--slow-latency", str(args.slow_latency)],
+                             capture_output=True, text=True, check=True)
+        report = json.loads(out.stdout.strip().splitlines()[-1])
+        for phase in PHASES:
+            r = report[phase]
+            rss = f"{report['peak_rss_mb']:>7.0f}" if phase == PHASES[-1] else ""
+            print(f"{variant:<10} {phase:<10} {r['ok']:>6} {r['failed']:>7} {r['refused']:>8} "
+                  f"{r['p50_ms']:>8.0f} {r['p99_ms']:>8.0f} {r['peak_pending']:>8} {rss}")
+
+
+if __name__ == "__main__":
+    main_()
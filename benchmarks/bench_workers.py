@@ -0,0 +1,185 @@
+"""Throughput of `uvicorn --workers N` sharing one SQLite store (SHARED_STORE=1).
+
+    python -m benchmarks.bench_workers [--workers 1 2 4] [--seconds 10] [--clients 4]
+
+For each worker count the app is served from a scratch directory whose data/cap360.db is
+pre-populated, and --clients load-generator processes drive a mix of reads and resolve_debt
+writes against it for --seconds. Throughput only grows with workers if the machine has the
+cores for them (and for the load generators).
+
+Afterwards the store is checked: total balance must be unchanged and every debt must equal its
+start value minus the successful resolve_debt calls on it, i.e. no worker undid another's write.
+409 responses (a conflicting write from another worker) are counted and not retried.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+AMOUNT = 0.01
+
+
+def _prepare(directory: str, families: int, members: int) -> dict:
+    # A child process, so this process never holds the store open while the server runs.
+    code = f"""
+import json, os
+os.chdir({directory!r})
+import database
+from benchmarks.dataset import populate
+database.init()
+populate({families}, {members}, debt=1000.0)
+database.sync()
+database.claim("seed")
+print(json.dumps({{
+    "families": list(database.families_db),
+    "members": list(database.members_db),
+    "edges": [[m.id, lender] for m in database.members_db.values() for lender in m.debts],
+}}))
+"""
+    import json
+    out = subprocess.run([sys.executable, "-c", code], cwd=REPO, capture_output=True, text=True, check=True,
+                         env={**os.environ, "STORAGE_BACKEND": "sqlite", "PYTHONPATH": REPO})
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def _verify(directory: str, paid: Counter) -> dict:
+    code = f"""
+import json, os
+os.chdir({directory!r})
+import database
+database.init()
+print(json.dumps({{m.id: [m.balance, m.debts] for m in database.members_db.values()}}))
+"""
+    import json
+    out = subprocess.run([sys.executable, "-c", code], cwd=REPO, capture_output=True, text=True, check=True,
+                         env={**os.environ, "STORAGE_BACKEND": "sqlite", "PYTHONPATH": REPO})
+    members = json.loads(out.stdout.strip().splitlines()[-1])
+    drift = 0
+    for (borrower, lender), n in paid.items():
+        drift += abs(round((members[borrower][1].get(lender, 0) - (1000.0 - n * AMOUNT)) * 100))
+    total = sum(balance for balance, _ in members.values())
+    return {"debt_drift_cents": drift, "balance_total": total}
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _client(port: int, data: dict, seconds: float, concurrency: int, seed: int, results) -> None:
+    import httpx
+
+    rng = random.Random(seed)
+    statuses: Counter = Counter()
+    paid: Counter = Counter()
+
+    def pick():
+        roll = rng.random()
+        if roll < 0.4:
+            return "GET", f"/members/{rng.choice(data['members'])}", {}, None
+        if roll < 0.6:
+            return "GET", f"/family/get_members/{rng.choice(data['families'])}", {}, None
+        if roll < 0.7:
+            return "GET", f"/members/{rng.choice(data['members'])}/transactions", {"limit": 20}, None
+        borrower, lender = rng.choice(data["edges"])
+        return "POST", f"/request/resolve_debt/{borrower}/{lender}", {"amount": AMOUNT}, (borrower, lender)
+
+    async def worker(client, deadline):
+        while time.monotonic() < deadline:
+            method, path, params, edge = pick()
+            res = await client.request(method, path, params=params)
+            statuses[res.status_code] += 1
+            if edge and res.status_code == 200:
+                paid[tuple(edge)] += 1
+
+    async def run():
+        limits = httpx.Limits(max_connections=concurrency)
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=30) as client:
+            deadline = time.monotonic() + seconds
+            await asyncio.gather(*(worker(client, deadline) for _ in range(concurrency)))
+
+    asyncio.run(run())
+    results.put((dict(statuses), dict(paid)))
+
+
+def _serve(directory: str, port: int, workers: int) -> subprocess.Popen:
+    env = {**os.environ, "STORAGE_BACKEND": "sqlite", "SHARED_STORE": "1", "PYTHONPATH": REPO,
+           "NESSIE_BASE_URL": "http://127.0.0.1:9"}
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", REPO, "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning"],
+        cwd=directory, env=env, stdout=subprocess.DEVNULL)
+    import httpx
+
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/docs").status_code == 200:
+                time.sleep(workers * 0.5)  # let the remaining workers finish starting
+                return server
+        except httpx.TransportError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError("server did not start")
+
+
+def run(workers: int, args) -> dict:
+    directory = tempfile.mkdtemp(prefix="bench_workers_")
+    data = _prepare(directory, args.families, args.members_per_family)
+    port = _free_port()
+    server = _serve(directory, port, workers)
+    results = multiprocessing.Queue()
+    try:
+        clients = [multiprocessing.Process(target=_client, args=(port, data, args.seconds, args.concurrency, i, results))
+                   for i in range(args.clients)]
+        for c in clients:
+            c.start()
+        collected = [results.get() for _ in clients]
+        for c in clients:
+            c.join()
+    finally:
+        server.terminate()
+        server.wait()
+    statuses, paid = Counter(), Counter()
+    for s, p in collected:
+        statuses.update(s)
+        paid.update({tuple(k) if isinstance(k, list) else k: v for k, v in p.items()})
+    check = _verify(directory, paid)
+    expected_total = 1_000_000.0 * len(data["members"])
+    return {
+        "rps": sum(statuses.values()) / args.seconds,
+        "statuses": dict(statuses),
+        "debt_drift_cents": check["debt_drift_cents"],
+        "balance_drift_cents": abs(round((check["balance_total"] - expected_total) * 100)),
+    }
+
+
+def main_() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--families", type=int, default=200)
+    parser.add_argument("--members-per-family", type=int, default=5)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--clients", type=int, default=4, help="load-generator processes")
+    parser.add_argument("--concurrency", type=int, default=16, help="connections per client")
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} CPUs")
+    print(f"{'workers':>7} {'rps':>8}  {'409s':>5} {'debt drift':>10} {'balance drift':>13}  statuses")
+    for workers in args.workers:
+        r = run(workers, args)
+        print(f"{workers:>7} {r['rps']:>8.0f}  {r['statuses'].get(409, 0):>5} {r['debt_drift_cents']:>10} "
+              f"{r['balance_drift_cents']:>13}  {r['statuses']}")
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,62 @@
+"""Synthetic datasets for the benchmarks: populate the database module in-memory."""
+from uuid import uuid4
+
+import database
+from models import Family, Member, MoneyRequest, Transaction
+
+
+def populate(families: int, members_per_family: int, history: int = 0, pending: int = 0,
+             debt: float = 0.0) -> None:
+    """Fill the stores with `families` families of `members_per_family` members each.
+
+    Every member gets `history` transactions and `pending` open money requests
+    addressed to the next member of the family, and owes that member `debt`.
+    """
+    for f in range(families):
+        family = Family(id=str(uuid4()), name=f"family-{f}")
+        roster = []
+        for m in range(members_per_family):
+            member = Member(
+                id=str(uuid4()),
+                first_name=f"first{m}",
+                last_name=f"last{f}",
+                balance=1_000_000.0,
+                family_id=family.id,
+                nessie_account_id=[{"_id": f"acct-{f}-{m}"}],
+            )
+            roster.append(member)
+            family.members.append(member.id)
+            database.members_db[member.id] = member
+        for i, member in enumerate(roster):
+            other = roster[(i + 1) % len(roster)]
+            if debt and other is not member:
+                member.debts[other.id] = debt
+                member.current_debt += debt
+            for _ in range(history):
+                database.record_transaction(Transaction(
+                    id=str(uuid4()),
+                    type_transaction="purchased",
+                    from_id=member.id,
+                    to_id=other.id,
+                    from_name=f"{member.first_name} {member.last_name}",
+                    to_name=f"{other.first_name} {other.last_name}",
+                    amount=1.0,
+                    from_debt=0.0,
+                    to_debt=0.0,
+                ), member.id)
+            for _ in range(pending):
+                req = MoneyRequest(id=str(uuid4()), from_id=member.id, to_id=other.id, amount=1.0)
+                database.money_requests_db[req.id] = req
+                other.requests[req.id] = req
+        database.families_db[family.id] = family
+    database.mark_all_dirty()
+
+
+def reset() -> None:
+    database.members_db.clear()
+    database.families_db.clear()
+    database.merchants_db.clear()
+    database.money_requests_db.clear()
+    database.transactions_db.clear()
+    database.segments_db.clear()
+    database.operations_db.clear()
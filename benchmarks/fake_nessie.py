@@ -0,0 +1,186 @@
+"""In-memory stand-in for the parts of the Nessie API the backend calls.
+
+Standalone:
+
+    python -m benchmarks.fake_nessie --port 8001 --latency lognormal:40:0.5 --error-rate 0.01
+    NESSIE_BASE_URL=http://127.0.0.1:8001 uvicorn main:app
+
+In-process, route the backend's pooled client straight into the app:
+
+    await nessie_client.start(httpx.ASGITransport(app=fake_nessie.create_app(FakeConfig())))
+
+Latency is `fixed:MS`, `uniform:LO_MS:HI_MS` or `lognormal:MEDIAN_MS:SIGMA`. `error_rate` answers
+that fraction of calls with a 500, and `rate_limit` (requests/second, token bucket with one
+second of burst) answers the overflow with a 429. All three can be changed while running with
+POST /_fake/config.
+"""
+import argparse
+import asyncio
+import math
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional
+from uuid import uuid4
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse
+
+
+@dataclass
+class FakeConfig:
+    latency: str = "fixed:0"
+    error_rate: float = 0.0
+    rate_limit: Optional[float] = None
+    merchants: int = 50
+    seed: Optional[int] = None
+
+    def sample_latency(self, rng: random.Random) -> float:
+        kind, *params = self.latency.split(":")
+        values = [float(p) for p in params]
+        if kind == "fixed":
+            return values[0] / 1000
+        if kind == "uniform":
+            return rng.uniform(values[0], values[1]) / 1000
+        if kind == "lognormal":
+            return rng.lognormvariate(math.log(values[0]), values[1]) / 1000
+        raise ValueError(f"unknown latency distribution {self.latency!r}")
+
+
+@dataclass
+class FakeState:
+    customers: Dict[str, dict] = field(default_factory=dict)
+    accounts: Dict[str, dict] = field(default_factory=dict)
+    merchants: Dict[str, dict] = field(default_factory=dict)
+    purchases: Dict[str, dict] = field(default_factory=dict)
+    withdrawals: Dict[str, dict] = field(default_factory=dict)
+    deposits: Dict[str, dict] = field(default_factory=dict)
+    calls: int = 0
+
+
+def _created(message: str, obj: dict) -> JSONResponse:
+    return JSONResponse({"code": 201, "message": message, "objectCreated": obj}, status_code=201)
+
+
+def create_app(config: Optional[FakeConfig] = None) -> FastAPI:
+    config = config or FakeConfig()
+    rng = random.Random(config.seed)
+    state = FakeState()
+    bucket = {"tokens": config.rate_limit or 0.0, "at": time.monotonic()}
+    app = FastAPI(title="Fake Nessie")
+    app.state.config = config
+    app.state.fake = state
+
+    for i in range(config.merchants):
+        mid = uuid4().hex[:24]
+        state.merchants[mid] = {"_id": mid, "name": f"Merchant {i}",
+                                "category": [["Food", "Shopping", "Grocery"][i % 3]]}
+
+    @app.middleware("http")
+    async def misbehave(request: Request, call_next):
+        if request.url.path.startswith("/_fake"):
+            return await call_next(request)
+        state.calls += 1
+        if config.rate_limit:
+            now = time.monotonic()
+            bucket["tokens"] = min(config.rate_limit, bucket["tokens"] + (now - bucket["at"]) * config.rate_limit)
+            bucket["at"] = now
+            if bucket["tokens"] < 1:
+                return JSONResponse({"code": 429, "message": "Too many requests"}, status_code=429)
+            bucket["tokens"] -= 1
+        await asyncio.sleep(config.sample_latency(rng))
+        if rng.random() < config.error_rate:
+            return JSONResponse({"code": 500, "message": "Injected failure"}, status_code=500)
+        return await call_next(request)
+
+    @app.post("/_fake/config")
+    async def update_config(changes: Dict[str, Any]):
+        for key, value in changes.items():
+            if not hasattr(config, key):
+                raise HTTPException(400, f"unknown setting {key}")
+            setattr(config, key, value)
+        if "rate_limit" in changes:
+            bucket["tokens"] = config.rate_limit or 0.0
+        return {"config": config.__dict__, "calls": state.calls}
+
+    @app.post("/customers")
+    async def create_customer(body: Dict[str, Any]):
+        cid = uuid4().hex[:24]
+        state.customers[cid] = {"_id": cid, **body}
+        return _created("Customer created", state.customers[cid])
+
+    @app.post("/customers/{customer_id}/accounts")
+    async def create_account(customer_id: str, body: Dict[str, Any]):
+        if customer_id not in state.customers:
+            raise HTTPException(404, "Customer not found")
+        aid = uuid4().hex[:24]
+        state.accounts[aid] = {"_id": aid, "customer_id": customer_id, "balance": 0, "rewards": 0, **body}
+        return _created("Account created", state.accounts[aid])
+
+    @app.get("/accounts/{account_id}")
+    async def get_account(account_id: str):
+        account = state.accounts.get(account_id)
+        if account is None:
+            raise HTTPException(404, "Account not found")
+        return account
+
+    @app.get("/merchants")
+    async def list_merchants():
+        return list(state.merchants.values())
+
+    @app.post("/merchants")
+    async def create_merchant(body: Dict[str, Any]):
+        mid = uuid4().hex[:24]
+        state.merchants[mid] = {"_id": mid, **body}
+        return _created("Created merchant", state.merchants[mid])
+
+    def _move(kind: Dict[str, dict], account_id: str, body: Dict[str, Any], sign: int, message: str):
+        account = state.accounts.get(account_id)
+        if account is None:
+            raise HTTPException(404, "Account not found")
+        account["balance"] += sign * body.get("amount", 0)
+        tid = uuid4().hex[:24]
+        kind[tid] = {"_id": tid, "payer_id": account_id, "type": message.split()[0].lower(), **body}
+        return _created(message, kind[tid])
+
+    @app.post("/accounts/{account_id}/purchases")
+    async def create_purchase(account_id: str, body: Dict[str, Any]):
+        return _move(state.purchases, account_id, body, -1, "Created purchase")
+
+    @app.post("/accounts/{account_id}/withdrawals")
+    async def create_withdrawal(account_id: str, body: Dict[str, Any]):
+        return _move(state.withdrawals, account_id, body, -1, "Created withdrawal")
+
+    @app.post("/accounts/{account_id}/deposits")
+    async def create_deposit(account_id: str, body: Dict[str, Any]):
+        return _move(state.deposits, account_id, body, 1, "Created deposit")
+
+    return app
+
+
+def add_account(app: FastAPI, account_id: str, balance: float) -> None:
+    # Seed an account directly, e.g. to match members produced by benchmarks.dataset.
+    customer_id = f"cust-{account_id}"
+    app.state.fake.customers.setdefault(customer_id, {"_id": customer_id})
+    app.state.fake.accounts[account_id] = {"_id": account_id, "customer_id": customer_id,
+                                           "balance": balance, "rewards": 0}
+
+
+def main() -> None:
+    import uvicorn
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", default="fixed:0")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit", type=float, default=None)
+    parser.add_argument("--merchants", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    config = FakeConfig(args.latency, args.error_rate, args.rate_limit, args.merchants, args.seed)
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+"""End-to-end load test: throughput, latency percentiles and sync() time for every endpoint.
+
+    python -m benchmarks.load --families 200 --members-per-family 5 --history 20 \\
+        --requests 500 --concurrency 16 --mode asgi --output bench_output.json
+    python -m benchmarks.load --mode uvicorn --compare bench_output.json
+
+`asgi` drives main.app in-process; `uvicorn` serves it on a local port and drives it over
+real sockets. Nessie is the in-memory stand-in from benchmarks.fake_nessie in both modes.
+Results are written as JSON; --compare prints the change against an earlier run.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import httpx
+
+import database
+import main
+import nessie_client
+from benchmarks import fake_nessie
+from benchmarks.dataset import populate
+
+Call = Tuple[str, str, Dict[str, object]]  # method, path, query params
+
+
+class SyncTimer:
+    """Wraps database.sync so every call made by the app (flusher included) is timed."""
+
+    def __init__(self):
+        self.original = database.sync
+        self.calls = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        start = time.perf_counter()
+        try:
+            self.original()
+        finally:
+            with self._lock:
+                self.calls += 1
+                self.seconds += time.perf_counter() - start
+
+    def take(self) -> Tuple[int, float]:
+        with self._lock:
+            result = (self.calls, self.seconds)
+            self.calls, self.seconds = 0, 0.0
+        return result
+
+
+def scenarios(ctx: dict) -> Dict[str, Callable[[int], Call]]:
+    families, members, pending = ctx["families"], ctx["members"], ctx["pending"]
+    merchants, scratch_family = ctx["merchants"], ctx["scratch_family"]
+    debtors = ctx["debtors"]
+
+    def member(i):
+        return members[i % len(members)]
+
+    return {
+        "POST /family/": lambda i: ("POST", "/family/", {"name": f"bench-{i}"}),
+        "GET /family/{family_id}": lambda i: ("GET", f"/family/{families[i % len(families)]}", {}),
+        "GET /family/get_members/{family_id}": lambda i: ("GET", f"/family/get_members/{families[i % len(families)]}", {}),
+        "POST /members/register": lambda i: ("POST", "/members/register", {"first_name_temp": "Bench", "last_name_temp": str(i)}),
+        "GET /members/{member_id}": lambda i: ("GET", f"/members/{member(i)}", {}),
+        "POST /members/{family_id}/add/{member_id}": lambda i: ("POST", f"/members/{scratch_family}/add/{member(i)}", {}),
+        "GET /members/{member_id}/transactions": lambda i: ("GET", f"/members/{member(i)}/transactions", {}),
+        "GET /members/{member_id}/borrower_transactions": lambda i: ("GET", f"/members/{member(i)}/borrower_transactions", {}),
+        "GET /members/{member_id}/get_indebted_to": lambda i: ("GET", f"/members/{member(i)}/get_indebted_to", {}),
+        "GET /members/thegoat/bakra": lambda i: ("GET", "/members/thegoat/bakra", {}),
+        "POST /request/{from_id}/request_money": lambda i: (
+            "POST", f"/request/{member(i)}/request_money", {"to_id": ctx["next"][member(i)], "amount": 1}),
+        "POST /request/resolve_request/{request_id}": lambda i: (
+            "POST", f"/request/resolve_request/{pending[i % len(pending)]}", {"success": True}),
+        "POST /request/resolve_debt/{from_id}/{to_id}": lambda i: (
+            "POST", f"/request/resolve_debt/{debtors[i % len(debtors)][0]}/{debtors[i % len(debtors)][1]}", {"amount": 0.01}),
+        "GET /merchants/": lambda i: ("GET", "/merchants/", {"limit": 10}),
+        "POST /merchants/create": lambda i: ("POST", "/merchants/create", {"name": f"Bench {i}", "category": "Food"}),
+        "POST /merchants/pay": lambda i: (
+            "POST", "/merchants/pay", {"member_id": member(i), "merchant_id": merchants[i % len(merchants)], "amount": 1}),
+    }
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, max(0, round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[k]
+
+
+async def run_endpoint(client: httpx.AsyncClient, make: Callable[[int], Call], requests: int,
+                       concurrency: int) -> dict:
+    counter = itertools.count()
+    latencies: List[float] = []
+    statuses: Dict[str, int] = {}
+
+    async def worker():
+        while (i := next(counter)) < requests:
+            method, path, params = make(i)
+            start = time.perf_counter()
+            res = await client.request(method, path, params=params)
+            latencies.append(time.perf_counter() - start)
+            statuses[str(res.status_code)] = statuses.get(str(res.status_code), 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "requests": requests,
+        "errors": sum(n for code, n in statuses.items() if not code.startswith("2")),
+        "statuses": statuses,
+        "throughput_rps": requests / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+
+def build_dataset(args, fake_app) -> dict:
+    database.init()
+    populate(args.families, args.members_per_family, history=args.history,
+             pending=max(args.pending, -(-args.requests // (args.families * args.members_per_family))),
+             debt=1_000.0)
+    database.sync()
+    for member in database.members_db.values():
+        fake_nessie.add_account(fake_app, member.nessie_account_id[0]["_id"], 1_000_000.0)
+    members = list(database.members_db)
+    return {
+        "families": list(database.families_db),
+        "members": members,
+        "next": {m.id: next(iter(m.debts)) for m in database.members_db.values() if m.debts},
+        "debtors": [(m.id, lender) for m in database.members_db.values() for lender in m.debts],
+        "pending": list(database.money_requests_db),
+        "merchants": list(fake_app.state.fake.merchants),
+    }
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _serve(app, port: int):
+    import uvicorn
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    return server, thread
+
+
+async def run(args) -> dict:
+    fake_app = fake_nessie.create_app(fake_nessie.FakeConfig(latency=args.nessie_latency, seed=args.seed))
+    ctx = build_dataset(args, fake_app)
+    timer = SyncTimer()
+    database.sync = timer
+    servers = []
+    try:
+        if args.mode == "uvicorn":
+            nessie_port, app_port = _free_port(), _free_port()
+            servers.append(_serve(fake_app, nessie_port))
+            nessie_client.BASE_URL = f"http://127.0.0.1:{nessie_port}"
+            servers.append(_serve(main.app, app_port))
+            client = httpx.AsyncClient(base_url=f"http://127.0.0.1:{app_port}",
+                                       limits=httpx.Limits(max_connections=args.concurrency))
+        else:
+            await main.on_startup()
+            await nessie_client.close()
+            await nessie_client.start(httpx.ASGITransport(app=fake_app))
+            client = httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://bench")
+
+        # a scratch family for add_member, so real rosters keep their shape
+        async with client:
+            res = await client.post("/family/", params={"name": "bench-scratch"})
+            ctx["scratch_family"] = res.json()["family_id"]
+            selected = scenarios(ctx)
+            if args.endpoints:
+                selected = {k: v for k, v in selected.items() if any(e in k for e in args.endpoints)}
+            results = {}
+            for name, make in selected.items():
+                timer.take()
+                result = await run_endpoint(client, make, args.requests, args.concurrency)
+                if args.mode == "asgi":
+                    await database.flusher.flush()
+                else:
+                    await asyncio.sleep(database.FLUSH_INTERVAL * 2)
+                calls, seconds = timer.take()
+                result["sync_calls"] = calls
+                result["sync_ms_total"] = seconds * 1000
+                results[name] = result
+                print(f"{name:<48} {result['throughput_rps']:>9.0f} rps  p50 {result['p50_ms']:>7.2f}  "
+                      f"p95 {result['p95_ms']:>7.2f}  p99 {result['p99_ms']:>7.2f} ms  "
+                      f"sync {result['sync_ms_total']:>8.1f} ms  errors {result['errors']}", file=sys.stderr)
+    finally:
+        if args.mode == "asgi":
+            await main.on_shutdown()
+        for server, thread in reversed(servers):
+            server.should_exit = True
+            thread.join()
+        database.sync = timer.original
+    return results
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(baseline: dict, current: dict) -> None:
+    print(f"{'endpoint':<48} {'rps':>14} {'p99 ms':>16}")
+    for name, now in current["endpoints"].items():
+        before = baseline.get("endpoints", {}).get(name)
+        if before is None:
+            continue
+        rps = (now["throughput_rps"] / before["throughput_rps"] - 1) * 100 if before["throughput_rps"] else 0
+        p99 = (now["p99_ms"] / before["p99_ms"] - 1) * 100 if before["p99_ms"] else 0
+        print(f"{name:<48} {now['throughput_rps']:>8.0f} {rps:>+5.0f}% {now['p99_ms']:>9.2f} {p99:>+5.0f}%")
+
+
+def main_() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=["asgi", "uvicorn"], default="asgi")
+    parser.add_argument("--families", type=int, default=100)
+    parser.add_argument("--members-per-family", type=int, default=5)
+    parser.add_argument("--history", type=int, default=10)
+    parser.add_argument("--pending", type=int, default=2)
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--nessie-latency", default="fixed:0")
+    parser.add_argument("--endpoints", nargs="*", help="only endpoints whose name contains one of these")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write results JSON here (default: stdout)")
+    parser.add_argument("--compare", help="earlier results JSON to diff against")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    args.output = args.output and os.path.abspath(args.output)
+    args.compare = args.compare and os.path.abspath(args.compare)
+    os.chdir(tempfile.mkdtemp(prefix="bench_load_"))
+    endpoints = asyncio.run(run(args))
+    report = {
+        "meta": {
+            "commit": _git_commit(),
+            "timestamp": time.time(),
+            "mode": args.mode,
+            "storage_backend": os.getenv("STORAGE_BACKEND", database.STORAGE_BACKEND),
+            "dataset": {"families": args.families, "members_per_family": args.members_per_family,
+                        "history": args.history, "pending": args.pending},
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "nessie_latency": args.nessie_latency,
+        },
+        "endpoints": endpoints,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main_()
@@ -1,17 +1,176 @@
+import asyncio
+import contextvars
+import gc
 import json
-from typing import Dict, Any, Optional, Type
-from models import Family, Member, Merchants, MoneyRequest, Transaction
-from pathlib import Path
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Callable, Dict, Any, Iterable, List, Optional, Set, Tuple, Type, TypeVar
+import metrics
+import profiling
+from models import Family, HistorySegment, Member, Merchants, MoneyRequest, Operation, Transaction
+from records import TransactionRecord
 from pydantic import BaseModel
 from fastapi.encoders import jsonable_encoder
+from storage import WriteConflict, decode, open_storage, read_json_file, write_encoded_mapping, write_json_file
 
 from uuid import uuid4
 
 families_db: Dict[str, Family] = {}
 members_db: Dict[str, Member] = {}
-transactions_db: Dict[str, Transaction] = {}
+transactions_db: Dict[str, TransactionRecord] = {}  # API models only at the boundary
 merchants_db: Dict[str, dict] = {}
 money_requests_db: Dict[str, MoneyRequest] = {}
+segments_db: Dict[str, HistorySegment] = {}
+operations_db: Dict[str, Operation] = {}
+
+# store name -> (snapshot path, record type); the in-memory dict is `<name>_db`
+STORES = {
+    "members": ("data/members.json", Member),
+    "families": ("data/families.json", Family),
+    "merchants": ("data/merchants.json", Merchants),
+    "money_requests": ("data/money_requests.json", MoneyRequest),
+    "transactions": ("data/transactions.json", TransactionRecord),
+    "segments": ("data/segments.json", HistorySegment),
+    "operations": ("data/operations.json", Operation),
+}
+
+# "json" keeps snapshots plus an append-only journal under data/; "sqlite" keeps one table per
+# store in data/cap360.db and loads rows on demand. Routers see the same dict-like stores either way.
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json")
+JOURNAL_COMPACT_BYTES = int(os.getenv("JOURNAL_COMPACT_BYTES", 4 * 1024 * 1024))
+FLUSH_INTERVAL = float(os.getenv("FLUSH_INTERVAL_MS", 50)) / 1000
+# Set when several processes serve the app (uvicorn --workers N). Needs the sqlite backend: the
+# database file is the authoritative store, each request commits its own writes with row-version
+# checks, and every worker replays the others' changes into its cache before handling a request.
+SHARED_STORE = os.getenv("SHARED_STORE") == "1"
+WORKER_ID = f"{os.getpid()}-{uuid4().hex[:8]}"
+
+logger = logging.getLogger(__name__)
+T = TypeVar("T")
+
+# Secondary indexes: index name -> (store, field). Each maps a field value to the keys of the
+# records holding it; dict fields (Member.debts) are indexed by their keys.
+INDEXES = {
+    "members_by_name": ("members", "first_name"),
+    "members_by_family": ("members", "family_id"),
+    "borrowers_by_lender": ("members", "debts"),
+    "requests_by_from": ("money_requests", "from_id"),
+    "requests_by_to": ("money_requests", "to_id"),
+    "segments_by_member": ("segments", "members"),
+    "operations_by_status": ("operations", "status"),
+}
+
+_dirty: Dict[str, Set[str]] = {name: set() for name in STORES}  # keys changed since last sync
+indexes: Dict[str, Dict[str, Set[str]]] = {name: {} for name in INDEXES}
+_indexed_under: Dict[Tuple[str, str], Tuple[str, ...]] = {}     # (index, key) -> values filed under
+_versions: Dict[str, Dict[str, int]] = {name: {} for name in STORES}  # bumped on every change
+_lock = threading.Lock()        # guards _dirty, the indexes and _versions
+_member_locks: Dict[str, threading.Lock] = {}
+_member_locks_guard = threading.Lock()
+_write_lock = threading.Lock()  # one sync() at a time, so writes reach the engine in order
+_engine = None
+# For the history archiver (history.py), kept where member lists grow: how many hot lists hold
+# each transaction ID, and the hot-list length of members that may have outgrown their window.
+# Only this worker's writes are counted, so the archiver runs without SHARED_STORE.
+_references: Dict[str, int] = {}
+_hot_lengths: Dict[str, int] = {}
+# (store, key) pairs marked dirty by the current request, when something is collecting them,
+# each with its _discards count when first marked
+_request_keys: contextvars.ContextVar[Optional[Dict[Tuple[str, str], int]]] = contextvars.ContextVar(
+    "request_keys", default=None)
+# How often each record's local changes were thrown away after a conflict (shared store): a
+# request that changed it before then lost its change too, even if its own commit would pass.
+_discards: Dict[Tuple[str, str], int] = {}
+
+def _mapping(store: str) -> Dict[str, Any]:
+    return globals()[f"{store}_db"]
+
+metrics.Gauge("credibridge_store_records", "Records held per store.", ("store",),
+              lambda: [((name,), len(_mapping(name))) for name in STORES])
+
+def mark_dirty(store: str, *keys: str) -> None:
+    # Call after creating, mutating or deleting records so the next sync() persists them
+    # and the secondary indexes pick up the change.
+    mapping = _mapping(store)
+    collecting = _request_keys.get()
+    with _lock:
+        if collecting is not None:
+            for key in keys:
+                collecting.setdefault((store, key), _discards.get((store, key), 0))
+        _dirty[store].update(keys)
+        for key in keys:
+            _changed(store, key, mapping.get(key))
+
+def mark_all_dirty() -> None:
+    for name in STORES:
+        mark_dirty(name, *_mapping(name).keys())
+
+def _index_values(value: Any) -> Tuple[str, ...]:
+    if isinstance(value, dict):
+        return tuple(value)
+    return (value,) if value else ()
+
+def _file(index: str, key: str, values: Tuple[str, ...]) -> None:
+    old = _indexed_under.pop((index, key), ())
+    if old == values:
+        if values:
+            _indexed_under[(index, key)] = values
+        return
+    entries = indexes[index]
+    for value in old:
+        bucket = entries.get(value)
+        if bucket is not None:
+            bucket.discard(key)
+            if not bucket:
+                del entries[value]
+    for value in values:
+        entries.setdefault(value, set()).add(key)
+    if values:
+        _indexed_under[(index, key)] = values
+
+def _reindex(store: str, key: str, record: Any) -> None:
+    for index, (index_store, field) in INDEXES.items():
+        if index_store == store:
+            _file(index, key, _index_values(getattr(record, field)) if record is not None else ())
+
+def _changed(store: str, key: str, record: Any) -> None:
+    # Caller holds _lock. Refile the record and move its version on, so anything derived from
+    # it (the indexes, cached responses) is rebuilt.
+    _reindex(store, key, record)
+    versions = _versions[store]
+    versions[key] = versions.get(key, 0) + 1
+
+def version(store: str, key: str) -> int:
+    # Changes whenever the record is marked dirty or reloaded from another worker's write.
+    return _versions[store].get(key, 0)
+
+def _rebuild_indexes() -> None:
+    with _lock:
+        _indexed_under.clear()
+        for index, (store, field) in INDEXES.items():
+            indexes[index] = {}
+            for key, value in _scan(store, field):
+                _file(index, key, _index_values(value))
+
+def _scan(store: str, field: str) -> Iterable[Tuple[str, Any]]:
+    # Engines that load lazily can project one field without materializing every record.
+    scan = getattr(_engine, "scan", None)
+    if scan is not None:
+        return scan(store, field)
+    return ((key, getattr(record, field)) for key, record in _mapping(store).items())
+
+def lookup(index: str, value: str) -> List[str]:
+    with _lock:
+        return list(indexes[index].get(value, ()))
+
+def is_dirty(store: Optional[str] = None, key: Optional[str] = None) -> bool:
+    # Whether anything, or one record, has changed since it was last synced or committed.
+    if store is None:
+        return any(_dirty.values())
+    return key in _dirty[store]
 
 def seed_data():
     member_one = Member(
@@ -86,21 +245,13 @@ def seed_data():
     )
 
     money_requests_db[req.id] = req
-
-def read_json_file(path: str) -> Dict[str, Any]:
-    p = Path(path)
-    if not p.exists() or p.stat().st_size == 0:
-        return {}
-    return json.loads(p.read_text(encoding="utf-8"))
-
-def write_json_file(path: str, obj: Any) -> None:
-    p = Path(path)
-    p.parent.mkdir(parents=True, exist_ok=True)
-    p.write_text(json.dumps(obj, ensure_ascii=False, indent=2), encoding="utf-8")
+    mark_all_dirty()
 
 def _to_plain(value: Any) -> Any:
     if isinstance(value, BaseModel):
         return value.model_dump(mode="json")
+    if isinstance(value, TransactionRecord):
+        return value.to_plain()
     if isinstance(value, dict):
         return {k: _to_plain(v) for k, v in value.items()}
     if isinstance(value, (list, tuple)):
@@ -113,26 +264,376 @@ def load_mapping(path: str, model: Optional[Type[BaseModel]] = None) -> Dict[str
         return {}
     if model is None:
         return raw
-    return {k: model.model_validate(v) for k, v in raw.items()}
+    return {k: decode(model, v) for k, v in raw.items()}
 
 def save_mapping(path: str, mapping: Dict[str, Any]) -> None:
     plain = {k: _to_plain(v) for k, v in mapping.items()}
     write_json_file(path, plain)
 
+def _upgrade_raw(raw: Dict[str, Dict[str, Any]]) -> Set[str]:
+    # Older snapshots embedded a full copy of each Transaction in every member list that
+    # referenced it; keep one copy in the transactions store and leave the IDs behind.
+    upgraded = set()
+    for member_id, member in raw["members"].items():
+        for field in ("transactions", "tracked_transactions"):
+            entries = member.get(field) or []
+            if any(isinstance(t, dict) for t in entries):
+                for t in entries:
+                    if isinstance(t, dict):
+                        raw["transactions"].setdefault(t["id"], t)
+                member[field] = [t["id"] if isinstance(t, dict) else t for t in entries]
+                upgraded.add(member_id)
+    return upgraded
+
 def init():
-    if not Path("data").is_dir():
-        return
-    global members_db, families_db, merchants_db, money_requests_db, transactions_db
-    members_db = load_mapping("data/members.json", Member)
-    families_db = load_mapping("data/families.json", Family)
-    merchants_db = load_mapping("data/merchants.json", Merchants)
-    money_requests_db = load_mapping("data/money_requests.json", MoneyRequest)
-    transactions_db = load_mapping("data/transactions.json", Transaction)
+    global _engine
+    _engine = open_storage(os.getenv("STORAGE_BACKEND", STORAGE_BACKEND), STORES, JOURNAL_COMPACT_BYTES,
+                           shared=SHARED_STORE, worker_id=WORKER_ID)
+    upgraded: Set[str] = set()
+    # Loading allocates millions of long-lived objects in one go; collection passes over them
+    # meanwhile find nothing to free.
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        for name, mapping in _engine.load(upgrade=lambda raw: upgraded.update(_upgrade_raw(raw))).items():
+            globals()[f"{name}_db"] = mapping
+            _dirty[name].clear()
+        _rebuild_indexes()
+        _count_references()
+    finally:
+        if collecting:
+            gc.enable()
+    if upgraded:
+        mark_dirty("members", *upgraded)
+        mark_dirty("transactions", *transactions_db.keys())
+
+def record_transaction(transaction: Transaction, *member_ids: str) -> None:
+    # Store the transaction once and append its ID to each listed member's history.
+    transactions_db[transaction.id] = TransactionRecord.from_model(transaction)
+    mark_dirty("transactions", transaction.id)
+    member_ids = tuple(dict.fromkeys(member_ids))
+    for member_id in member_ids:
+        members_db[member_id].transactions.append(transaction.id)
+    with _lock:
+        _references[transaction.id] = _references.get(transaction.id, 0) + len(member_ids)
+        for member_id in member_ids:
+            _hot_lengths[member_id] = len(members_db[member_id].transactions)
+    mark_dirty("members", *member_ids)
+
+def history_candidates(window: int) -> List[str]:
+    """Members whose hot lists have grown past `window`, forgotten until they grow again."""
+    with _lock:
+        found = [member_id for member_id, n in _hot_lengths.items() if n > window]
+        _hot_lengths.clear()
+    return found
+
+def release_references(transaction_ids: Iterable[str]) -> Set[str]:
+    """Drop one hot-list reference per ID given; returns the IDs no hot list holds any more."""
+    released = set()
+    with _lock:
+        for transaction_id in transaction_ids:
+            n = _references.get(transaction_id, 0) - 1
+            if n > 0:
+                _references[transaction_id] = n
+            else:
+                _references.pop(transaction_id, None)
+                released.add(transaction_id)
+    return released
+
+def _count_references() -> None:
+    # From a projection of the lists, so lazily loaded members stay unloaded.
+    with _lock:
+        _references.clear()
+        _hot_lengths.clear()
+        for field in ("transactions", "tracked_transactions"):
+            for member_id, ids in _scan("members", field):
+                for transaction_id in ids or ():
+                    _references[transaction_id] = _references.get(transaction_id, 0) + 1
+                _hot_lengths[member_id] = max(_hot_lengths.get(member_id, 0), len(ids or ()))
+
+def get_transactions(ids: List[str]) -> List[Transaction]:
+    return [transactions_db[i].to_model() for i in ids if i in transactions_db]
+
+def is_empty() -> bool:
+    return not any(_mapping(name) for name in STORES)
+
+def _ops(batch: Dict[str, Iterable[str]]) -> list:
+    ops = []
+    for name, keys in batch.items():
+        mapping = _mapping(name)
+        for key in keys:
+            value = mapping.get(key)
+            if value is None:
+                ops.append((name, key, None, None))
+            else:
+                plain = _to_plain(value)
+                ops.append((name, key, plain, json.dumps(plain, ensure_ascii=False)))
+    return ops
+
+def _write(batch: Dict[str, Iterable[str]], kind: str) -> None:
+    began = time.perf_counter()
+    ops = _ops(batch)
+    _engine.write(ops)
+    metrics.sync_latency.observe(time.perf_counter() - began, kind)
+    metrics.sync_records.inc(amount=len(ops))
+    # records are written as UTF-8 (ensure_ascii=False), so only non-ASCII text needs encoding to count
+    metrics.sync_bytes.inc(amount=sum(len(text) if text.isascii() else len(text.encode())
+                                      for _, _, _, text in ops if text is not None))
 
 def sync():
-    Path("data").mkdir(parents=True, exist_ok=True)
-    save_mapping("data/members.json", members_db)
-    save_mapping("data/families.json", families_db)
-    save_mapping("data/merchants.json", merchants_db)
-    save_mapping("data/money_requests.json", money_requests_db)
-    save_mapping("data/transactions.json", transactions_db)
\ No newline at end of file
+    # Hand the records touched since the last sync to the storage engine as one batch, so the
+    # cost of a write follows the size of the change rather than the size of the dataset.
+    # Requests that changed nothing (e.g. GETs) return without touching the disk.
+    if not is_dirty():
+        return
+    with _write_lock:
+        with _lock:
+            batch = {name: keys for name, keys in _dirty.items() if keys}
+            for name in batch:
+                _dirty[name] = set()
+        if not batch:
+            return
+        if _engine is None:
+            raise RuntimeError("database.init() must run before sync()")
+        try:
+            _write(batch, "sync")
+            return
+        except WriteConflict as e:
+            conflicts = set(e.keys)
+        except BaseException:
+            _requeue(batch)  # nothing was written; the next sync tries again
+            raise
+    # Shared store only: another worker got there first. Their version of the conflicting
+    # records wins; everything else in the batch is retried on the next sync.
+    logger.warning("sync lost %d record(s) to other workers", len(conflicts))
+    _discard(conflicts)
+    for name, keys in batch.items():
+        mark_dirty(name, *(k for k in keys if (name, k) not in conflicts))
+
+def collect_request_keys() -> contextvars.Token:
+    # Start recording what the current request marks dirty; end_request_keys() returns it.
+    return _request_keys.set({})
+
+def end_request_keys(token: contextvars.Token) -> Dict[Tuple[str, str], int]:
+    keys = _request_keys.get()
+    _request_keys.reset(token)
+    return keys or {}
+
+def commit(keys: Dict[Tuple[str, str], int]) -> None:
+    """Write exactly these records (from end_request_keys()) now, as one transaction.
+
+    On a shared store, raises WriteConflict if another worker changed any of them since they
+    were read, or if another request's conflict in this worker threw away changes to them; the
+    local changes to all of them are then discarded, so the request that made them can be
+    answered with a 409 and retried.
+    """
+    batch: Dict[str, Set[str]] = {}
+    for store, key in keys:
+        batch.setdefault(store, set()).add(key)
+    with _write_lock:
+        with _lock:
+            lost = [k for k, seen in keys.items() if _discards.get(k, 0) != seen]
+            if not lost:
+                for store, store_keys in batch.items():
+                    _dirty[store] -= store_keys
+        if not lost:
+            try:
+                _write(batch, "commit")
+                return
+            except WriteConflict:
+                pass
+            except BaseException:
+                _requeue(batch)
+                raise
+    _discard(keys)
+    raise WriteConflict(sorted(lost or keys))
+
+def _requeue(batch: Dict[str, Iterable[str]]) -> None:
+    # A write that failed outright: its records are still changed in memory, so they stay dirty.
+    with _lock:
+        for name, keys in batch.items():
+            _dirty[name].update(keys)
+
+def _discard(keys: Iterable[Tuple[str, str]]) -> None:
+    # Drop local changes: reload each record as stored and refile it in the indexes.
+    for store, key in keys:
+        with _record_lock(store, key):
+            with _lock:
+                _dirty[store].discard(key)
+                _discards[(store, key)] = _discards.get((store, key), 0) + 1
+            with _write_lock:
+                record = _mapping(store).reload(key)
+            with _lock:
+                _changed(store, key, record)
+
+def _record_lock(store: str, key: str):
+    # Members are only changed under their member lock; other records need no extra lock.
+    return member_locks(key) if store == "members" else nullcontext()
+
+def refresh() -> None:
+    """Bring this worker's cache up to date with what other workers committed (shared store).
+
+    Changed records are reloaded in place, members under their lock, and refiled in the
+    indexes. A record with uncommitted local changes is left alone; its commit will conflict.
+    """
+    if not SHARED_STORE or _engine is None:
+        return
+    changes = _engine.changes_since()
+    if changes is None:
+        changes = [(name, key) for name in STORES for key in _mapping(name).cached_keys()]
+        _rebuild_indexes()
+    for store, key in dict.fromkeys(changes):
+        with _record_lock(store, key):
+            with _lock:
+                if key in _dirty[store]:
+                    continue
+            with _write_lock:
+                record = _mapping(store).reload(key)
+            with _lock:
+                _changed(store, key, record)
+
+def commit_now(apply: Callable[[], T], attempts: int = 5) -> T:
+    """Run `apply` and commit what it changes right away, re-running it after a conflict.
+
+    For writes that follow an irreversible side effect (a Nessie purchase), which must not be
+    answered with a 409. Without a shared store this is just apply().
+    """
+    if not SHARED_STORE:
+        return apply()
+    for attempt in range(attempts):
+        token = collect_request_keys()
+        try:
+            result = apply()
+        finally:
+            keys = end_request_keys(token)
+        try:
+            commit(keys)
+            return result
+        except WriteConflict:
+            if attempt == attempts - 1:
+                raise
+            refresh()
+
+def claim(name: str) -> bool:
+    # True in exactly one worker per database, for one-off work such as seeding.
+    return _engine.claim(name)
+
+def compact():
+    if _engine is not None:
+        _engine.compact()
+
+def export_json(directory: str) -> None:
+    # One <store>.json per store, in the layout of the old data/ snapshots.
+    for name, (path, _) in STORES.items():
+        encoded = {k: json.dumps(_to_plain(v), ensure_ascii=False) for k, v in _mapping(name).items()}
+        write_encoded_mapping(os.path.join(directory, os.path.basename(path)), encoded)
+
+def import_json(directory: str) -> None:
+    """Replace every store with the files export_json() writes, then persist the result.
+
+    Records are validated, and legacy layouts upgraded, before any store is touched.
+    """
+    raw = {name: read_json_file(os.path.join(directory, os.path.basename(path))) for name, (path, _) in STORES.items()}
+    _upgrade_raw(raw)
+    loaded = {name: {k: decode(model, v) for k, v in raw[name].items()} for name, (_, model) in STORES.items()}
+    for name, records in loaded.items():
+        mapping = _mapping(name)
+        replaced = set(mapping) | set(records)
+        mapping.clear()
+        mapping.update(records)
+        mark_dirty(name, *replaced)
+    _count_references()
+    sync()
+
+@contextmanager
+def member_locks(*member_ids: str):
+    """Hold the locks of every listed member for a read-check-write on their balances or debts.
+
+    Locks are taken in sorted ID order so multi-party operations never deadlock, and members of
+    unrelated families never contend. Threadpool handlers and async handlers share them, so hold
+    them only around synchronous code -- never across an await.
+    """
+    with _member_locks_guard:
+        locks = [_member_locks.setdefault(m, threading.Lock()) for m in sorted(set(member_ids))]
+    for lock in locks:
+        lock.acquire()
+    try:
+        yield
+    finally:
+        for lock in reversed(locks):
+            lock.release()
+
+@contextmanager
+def one_write():
+    """Keep sync() out while a batch of changes is applied, so they reach storage in one write.
+
+    A sync() landing midway would persist half the batch, and a crash before the next one would
+    leave it that way. Take it inside member_locks(), as _discard() and refresh() do.
+    """
+    with _write_lock:
+        yield
+
+def durable(endpoint):
+    # Mark a route so its response is held until the flusher has persisted its changes.
+    endpoint.__durable__ = True
+    return endpoint
+
+def is_durable(endpoint) -> bool:
+    return getattr(endpoint, "__durable__", False)
+
+class Flusher:
+    """Background group commit: one sync() per interval covers every mutation made in it.
+
+    `flush()` wakes the flusher early and returns once a sync that started after the call
+    has finished, so concurrent durable requests share a single journal append and fsync.
+    """
+
+    def __init__(self, interval: float = FLUSH_INTERVAL):
+        self.interval = interval
+        self._wake: Optional[asyncio.Event] = None
+        self._next: Optional[asyncio.Future] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        self._next = loop.create_future()
+        self._task = loop.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        sync()
+
+    async def flush(self) -> None:
+        if self._task is None:
+            sync()
+            return
+        waiter = self._next
+        self._wake.set()
+        error = await asyncio.shield(waiter)
+        if error is not None:
+            raise error
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            done, self._next = self._next, loop.create_future()
+            try:
+                await asyncio.to_thread(profiling.call, "sync()", sync)
+                done.set_result(None)
+            except Exception as e:
+                logger.exception("flush failed")
+                done.set_result(e)
+
+flusher = Flusher()
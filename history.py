@@ -0,0 +1,284 @@
+# Tiered transaction history: a recent window in memory, older entries in segment files.
+#
+# Each member keeps the last HISTORY_HOT_WINDOW IDs of `transactions` and `tracked_transactions`
+# in the member record. The archiver moves everything older, family by family, into immutable
+# gzip segments under data/history/<family_id>/:
+#
+#     {"members": {member_id: [[transaction IDs], [tracked_transaction IDs]]},
+#      "ids": [ID of each line below]}                                one header line
+#     {transaction}                                                   one per line, by date
+#
+# and drops the archived records from transactions_db once no hot list refers to them. A
+# HistorySegment record (the `segments` store) describes each file, and the segments_by_member
+# index finds a member's segments. Positions in a member's history count archived entries
+# first, so paging cursors stay valid while entries move out.
+import asyncio
+import datetime
+import functools
+import gzip
+import heapq
+import itertools
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+from uuid import uuid4
+
+import database
+from models import HistorySegment, Member, Transaction
+from records import TransactionRecord, to_us
+
+HISTORY_DIR = "data/history"
+HISTORY_HOT_WINDOW = int(os.getenv("HISTORY_HOT_WINDOW", 1000))
+# A family is archived once its members have this many entries past their windows between
+# them, so segments hold a useful amount of history each.
+HISTORY_SEGMENT_MIN = int(os.getenv("HISTORY_SEGMENT_MIN", 2000))
+HISTORY_ARCHIVE_INTERVAL = float(os.getenv("HISTORY_ARCHIVE_INTERVAL", 60))
+HISTORY_CACHE_SEGMENTS = int(os.getenv("HISTORY_CACHE_SEGMENTS", 16))
+
+FIELDS = ("transactions", "tracked_transactions")
+
+logger = logging.getLogger(__name__)
+
+
+def segment_path(segment: HistorySegment) -> str:
+    return os.path.join(HISTORY_DIR, segment.family_id or "_unassigned", f"{segment.id}.jsonl.gz")
+
+def segments_of(member_id: str) -> List[HistorySegment]:
+    # oldest first: each segment takes the oldest entries left when it was cut
+    return sorted((database.segments_db[s] for s in database.lookup("segments_by_member", member_id)),
+                  key=lambda s: s.id)
+
+def archived_count(member_id: str, field: str) -> int:
+    column = FIELDS.index(field)
+    return sum(s.members[member_id][column] for s in segments_of(member_id))
+
+
+@functools.lru_cache(maxsize=HISTORY_CACHE_SEGMENTS)
+def load_segment(path: str) -> Tuple[Dict[str, List[List[str]]], Dict[str, str]]:
+    # Segments never change once written, so one read can be kept as long as it is useful.
+    # Lines stay encoded until a page asks for them.
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        header = json.loads(f.readline())
+        return header["members"], dict(zip(header["ids"], f.read().splitlines()))
+
+def read(member_id: str, field: str, start: int, stop: int) -> List[Transaction]:
+    """Archived entries start:stop of a member's oldest-first `field` list."""
+    column = FIELDS.index(field)
+    found: List[Transaction] = []
+    offset = 0
+    for segment in segments_of(member_id):
+        n = segment.members[member_id][column]
+        if offset + n > start:
+            members, records = load_segment(segment_path(segment))
+            for transaction_id in members[member_id][column][max(start - offset, 0):stop - offset]:
+                line = records.get(transaction_id)
+                if line is not None:
+                    found.append(TransactionRecord.from_plain(json.loads(line)).to_model())
+        offset += n
+        if offset >= stop:
+            break
+    return found
+
+def page(member: Member, field: str, cursor: int, limit: int) -> Tuple[List[Transaction], Optional[int]]:
+    """`limit` entries of a member's full history from position `cursor`, and the next cursor."""
+    with database.member_locks(member.id):
+        # the archiver moves entries under this lock, so the count and the window agree
+        archived = archived_count(member.id, field)
+        hot = list(getattr(member, field))
+    total = archived + len(hot)
+    stop = min(cursor + limit, total)
+    found = read(member.id, field, cursor, min(stop, archived)) if cursor < archived else []
+    found += database.get_transactions(hot[max(cursor - archived, 0):max(stop - archived, 0)])
+    return found, stop if stop < total else None
+
+def _order(record: TransactionRecord) -> Tuple[int, str]:
+    return record.date_us, record.id
+
+def _segment_records(segment: HistorySegment, member_ids: List[str], since_us: int,
+                     until_us: int) -> Iterator[TransactionRecord]:
+    # Read line by line rather than through load_segment, which keeps whole files; lines are
+    # in date order, so reading stops at `until_us`.
+    with gzip.open(segment_path(segment), "rt", encoding="utf-8") as f:
+        header = json.loads(f.readline())
+        wanted = {i for m in member_ids for ids in header["members"].get(m, ()) for i in ids}
+        for transaction_id, line in zip(header["ids"], f):
+            if transaction_id not in wanted:
+                continue
+            record = TransactionRecord.from_plain(json.loads(line))
+            if record.date_us >= until_us:
+                return
+            if record.date_us >= since_us:
+                yield record
+
+def _archived(segments: List[HistorySegment], member_ids: List[str], since_us: int,
+              until_us: int) -> Iterator[TransactionRecord]:
+    # Segments overlap in time (a transfer is cut from each side's list at a different time),
+    # so they are merged, but each is opened only once the merge reaches its first date. Open
+    # files stay at the few whose dates span the current position, however long the history.
+    waiting = sorted(segments, key=lambda s: s.first_date, reverse=True)
+    heap: list = []  # (date_us, id, tiebreak, record, the segment's iterator)
+    tiebreak = itertools.count()
+
+    def advance(records: Iterator[TransactionRecord]) -> None:
+        record = next(records, None)
+        if record is not None:
+            heapq.heappush(heap, (record.date_us, record.id, next(tiebreak), record, records))
+
+    while waiting or heap:
+        while waiting and (not heap or to_us(waiting[-1].first_date) <= heap[0][0]):
+            advance(_segment_records(waiting.pop(), member_ids, since_us, until_us))
+        if heap:
+            _, _, _, record, records = heapq.heappop(heap)
+            yield record
+            advance(records)
+
+def stream(member_ids: List[str], since: Optional[datetime.datetime] = None,
+           until: Optional[datetime.datetime] = None) -> Iterator[TransactionRecord]:
+    """Every transaction in these members' histories, archived and hot, oldest first and once each.
+
+    `since` is inclusive and `until` exclusive. Memory stays at the members' hot windows plus
+    the segments being read, however long the history.
+    """
+    since_us = to_us(since) if since is not None else -1 << 63
+    until_us = to_us(until) if until is not None else 1 << 63
+    with database.member_locks(*member_ids):
+        # the archiver moves entries under these locks, so segments and windows agree
+        segments = {s.id: s for m in member_ids for s in segments_of(m)}
+        hot = {}
+        for member_id in member_ids:
+            member = database.members_db.get(member_id)
+            if member is not None:
+                for field in FIELDS:
+                    hot.update((i, database.transactions_db.get(i)) for i in getattr(member, field))
+    hot_records = sorted((r for r in hot.values() if r is not None and since_us <= r.date_us < until_us),
+                         key=_order)
+    archived = [s for s in segments.values()
+                if to_us(s.last_date) >= since_us and to_us(s.first_date) < until_us]
+
+    last = None
+    # a transaction shows up once per member list holding it, possibly in a segment and a window
+    for record in heapq.merge(_archived(archived, member_ids, since_us, until_us), hot_records, key=_order):
+        if record.id != last:
+            last = record.id
+            yield record
+
+
+def _write_segment(path: str, members: Dict[str, List[List[str]]], records: List[TransactionRecord]) -> None:
+    p = Path(path)
+    p.parent.mkdir(parents=True, exist_ok=True)
+    tmp = p.with_name(p.name + ".tmp")
+    with tmp.open("wb") as raw:
+        with gzip.GzipFile(fileobj=raw, mode="wb") as f:
+            header = {"members": members, "ids": [record.id for record in records]}
+            f.write((json.dumps(header, ensure_ascii=False) + "\n").encode())
+            for record in records:
+                f.write((json.dumps(record.to_plain(), ensure_ascii=False) + "\n").encode())
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(tmp, p)
+
+def archive(family_id: Optional[str], member_ids: List[str]) -> Optional[HistorySegment]:
+    """Move these members' history past the hot window into one new segment.
+
+    Entries are only ever appended to a member's lists, and only the archiver removes them, so
+    the overflow read here is still the head of each list once the file is written.
+    """
+    cut: Dict[str, List[List[str]]] = {}
+    for member_id in member_ids:
+        member = database.members_db.get(member_id)
+        if member is None:
+            continue
+        lists = [getattr(member, field) for field in FIELDS]
+        heads = [ids[:max(len(ids) - HISTORY_HOT_WINDOW, 0)] for ids in lists]
+        if any(heads):
+            cut[member_id] = heads
+    if sum(len(ids) for heads in cut.values() for ids in heads) < HISTORY_SEGMENT_MIN:
+        return None
+
+    archived = {i for heads in cut.values() for ids in heads for i in ids}
+    records = [r for r in map(database.transactions_db.get, archived) if r is not None]
+    if not records:
+        return None
+    records.sort(key=lambda r: (r.date_us, r.id))
+    segment = HistorySegment(
+        id=f"{time.time_ns():020d}-{uuid4().hex[:8]}", family_id=family_id,
+        first_date=records[0].date, last_date=records[-1].date, count=len(records),
+        members={m: [len(ids) for ids in heads] for m, heads in cut.items()})
+    _write_segment(segment_path(segment), cut, records)
+
+    with database.member_locks(*cut):
+        for member_id, heads in cut.items():
+            member = database.members_db[member_id]
+            for field, ids in zip(FIELDS, heads):
+                del getattr(member, field)[:len(ids)]
+        database.segments_db[segment.id] = segment
+        # Drop only records no hot list shows any more: the other side of a transfer, or a
+        # lender who got a copy (whatever has become of the debt since), may still list them.
+        released = database.release_references(i for heads in cut.values() for ids in heads for i in ids)
+        dropped = [r.id for r in records if r.id in released]
+        for transaction_id in dropped:
+            del database.transactions_db[transaction_id]
+        database.mark_dirty("members", *cut)
+        database.mark_dirty("segments", segment.id)
+        database.mark_dirty("transactions", *dropped)
+    logger.info("archived %d transactions of family %s into %s", len(records), family_id, segment.id)
+    return segment
+
+def archive_due() -> List[HistorySegment]:
+    # Families with a member whose list outgrew the window since the last pass; each is
+    # archived as a whole, so its members' overflow adds up to a segment together.
+    families: Dict[Optional[str], List[str]] = {}
+    for member_id in database.history_candidates(HISTORY_HOT_WINDOW):
+        member = database.members_db.get(member_id)
+        if member is None:
+            continue
+        if member.family_id is None:
+            families.setdefault(None, []).append(member_id)
+        elif member.family_id not in families:
+            families[member.family_id] = sorted(database.lookup("members_by_family", member.family_id))
+    segments = []
+    for family_id, member_ids in families.items():
+        try:
+            segment = archive(family_id, member_ids)
+        except OSError:
+            logger.exception("archiving family %s failed", family_id)
+            continue
+        if segment is not None:
+            segments.append(segment)
+    if segments:
+        database.sync()
+    return segments
+
+
+class Archiver:
+    """Background task running archive_due() every `interval` seconds."""
+
+    def __init__(self, interval: float = HISTORY_ARCHIVE_INTERVAL):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await asyncio.to_thread(archive_due)
+            except Exception:
+                logger.exception("history archiving failed")
+
+
+archiver = Archiver()
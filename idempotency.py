@@ -0,0 +1,147 @@
+# Idempotency-Key support for POST requests, the money-moving endpoints above all
+# (/merchants/pay, /request/resolve_debt, /request/{from_id}/request_money).
+#
+# A client retrying a request it never got an answer to sends the same `Idempotency-Key`
+# header. The first request with a key runs as usual and its response is kept for
+# IDEMPOTENCY_TTL seconds (at most IDEMPOTENCY_MAX_KEYS responses, least recently used dropped
+# first). A repeat gets the kept response back, marked `Idempotent-Replayed: true`, without
+# running the handler, so neither the ledger nor Nessie sees it twice. A repeat arriving while
+# the first is still running waits for it. A replay is put down to the route of the request it
+# repeats (scope["route"]), so metrics count it there.
+#
+# A key belongs to one request: reusing it for a different method, path, query or body is
+# refused with 422. Server errors (5xx) and write conflicts (409) are not kept, so a retry runs
+# again. Keys live in this process only; with several workers a repeat that reaches another
+# worker runs again.
+import asyncio
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, MutableMapping, Optional, Tuple
+
+from fastapi import Request
+from fastapi.responses import JSONResponse, Response
+
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", 24 * 3600))
+IDEMPOTENCY_MAX_KEYS = int(os.getenv("IDEMPOTENCY_MAX_KEYS", 10_000))
+MAX_KEY_LENGTH = 255
+
+# Headers of the first response that are replayed with it; content-length is recomputed.
+REPLAYED_HEADERS = ("content-type", "location", "etag", "retry-after")
+
+
+def applies(request: Request) -> bool:
+    return request.method == "POST" and "idempotency-key" in request.headers
+
+
+class StoredResponse:
+    __slots__ = ("fingerprint", "status_code", "headers", "body", "expires", "route")
+
+    def __init__(self, fingerprint: str, status_code: int, headers: Dict[str, str], body: bytes, expires: float,
+                 route: Any = None):
+        self.fingerprint = fingerprint
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+        self.expires = expires
+        self.route = route  # the route that served the first request
+
+    def replay(self) -> Response:
+        return Response(self.body, status_code=self.status_code,
+                        headers={**self.headers, "Idempotent-Replayed": "true"})
+
+
+class IdempotencyStore:
+    """Kept responses by key (LRU with a TTL), plus the requests still running per key.
+
+    Only touched from the event loop, so it needs no lock.
+    """
+
+    def __init__(self, ttl: float = IDEMPOTENCY_TTL, max_keys: int = IDEMPOTENCY_MAX_KEYS):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self._responses: "OrderedDict[str, StoredResponse]" = OrderedDict()
+        self._running: Dict[str, Tuple[str, asyncio.Future]] = {}
+        self.replayed = 0
+        self.waited = 0
+
+    def get(self, key: str) -> Optional[StoredResponse]:
+        stored = self._responses.get(key)
+        if stored is None:
+            return None
+        if stored.expires <= time.monotonic():
+            del self._responses[key]
+            return None
+        self._responses.move_to_end(key)
+        return stored
+
+    def put(self, key: str, stored: StoredResponse) -> None:
+        self._responses[key] = stored
+        self._responses.move_to_end(key)
+        while len(self._responses) > self.max_keys:
+            self._responses.popitem(last=False)
+        # expired entries at the cold end go too, so an idle store does not hold them for good
+        now = time.monotonic()
+        while self._responses:
+            oldest = next(iter(self._responses.values()))
+            if oldest.expires > now:
+                break
+            self._responses.popitem(last=False)
+
+    async def run(self, key: str, fingerprint: str, scope: MutableMapping[str, Any],
+                  call: Callable[[], Awaitable[Response]]) -> Response:
+        while True:
+            stored = self.get(key)
+            if stored is not None:
+                if stored.fingerprint != fingerprint:
+                    return _reused(key)
+                self.replayed += 1
+                if stored.route is not None:
+                    scope["route"] = stored.route
+                return stored.replay()
+            running = self._running.get(key)
+            if running is None:
+                break
+            if running[0] != fingerprint:
+                return _reused(key)
+            self.waited += 1
+            # then look again: the first request's response, or nothing kept and this one runs
+            await asyncio.shield(running[1])
+
+        done = asyncio.get_running_loop().create_future()
+        self._running[key] = (fingerprint, done)
+        try:
+            response = await call()
+            if response.status_code >= 500 or response.status_code == 409:
+                return response
+            body = b"".join([chunk async for chunk in response.body_iterator])
+            headers = {k: v for k, v in response.headers.items() if k in REPLAYED_HEADERS}
+            self.put(key, StoredResponse(fingerprint, response.status_code, headers, body,
+                                         time.monotonic() + self.ttl, scope.get("route")))
+            return Response(body, status_code=response.status_code, headers=dict(response.headers),
+                            background=response.background)
+        finally:
+            del self._running[key]
+            done.set_result(None)
+
+
+def _reused(key: str) -> Response:
+    return JSONResponse({"detail": f"Idempotency-Key {key!r} was already used for a different request"},
+                        status_code=422)
+
+async def fingerprint(request: Request) -> str:
+    query = "&".join(sorted(request.url.query.split("&")))
+    digest = hashlib.blake2b(f"{request.method} {request.url.path}?{query}\n".encode(), digest_size=16)
+    digest.update(await request.body())  # the bulk endpoints take JSON bodies
+    return digest.hexdigest()
+
+async def handle(request: Request, call: Callable[[], Awaitable[Response]]) -> Response:
+    key = request.headers["idempotency-key"]
+    if not key or len(key) > MAX_KEY_LENGTH:
+        return JSONResponse({"detail": f"Idempotency-Key must be 1 to {MAX_KEY_LENGTH} characters"},
+                            status_code=400)
+    return await store.run(key, await fingerprint(request), request.scope, call)
+
+
+store = IdempotencyStore()
@@ -1,8 +1,19 @@
-from pathlib import Path
 from fastapi import FastAPI, Request
-from routers import family, members, merchants, requests
+from fastapi.responses import JSONResponse, PlainTextResponse
+from starlette.concurrency import run_in_threadpool
+from routers import family, members, merchants, operations, profiles, requests
 import database
+import history
+import idempotency
+import logging
+import metrics
+import nessie_client
+import outbox
 import os
+import profiling
+import time
+
+logger = logging.getLogger(__name__)
 
 app = FastAPI(
     title="CrediBridge API",
@@ -11,21 +22,110 @@ app = FastAPI(
     docs_url="/docs"
 )
 
-app.include_router(family.router, prefix="/family", tags=["Family"])
-app.include_router(members.router, prefix="/members", tags=["Members"])
-app.include_router(merchants.router, prefix='/merchants', tags=["Merchants"])
-app.include_router(requests.router, prefix='/request', tags=["Money Requests"])
+# Route templates for metric labels, by id of the route object: an included route keeps its
+# own path, without the prefix it is served under.
+route_labels = {}
+
+for router, prefix, tag in (
+        (family.router, "/family", "Family"),
+        (members.router, "/members", "Members"),
+        (merchants.router, "/merchants", "Merchants"),
+        (requests.router, "/request", "Money Requests"),
+        (operations.router, "/operations", "Operations"),
+        (profiles.router, "/admin/profiles", "Admin")):
+    for route in router.routes:
+        route_labels[id(route)] = prefix + route.path
+        if profiling.ENABLED:
+            profiling.instrument(route, prefix + route.path)  # before the route's handler is built
+    app.include_router(router, prefix=prefix, tags=[tag])
+
+def route_label(request: Request) -> str:
+    route = request.scope.get("route")
+    if route is None:
+        return "unmatched"  # 404s and the like, kept out of per-path series
+    return route_labels.get(id(route), getattr(route, "path", "unmatched"))
+
+@app.exception_handler(nessie_client.Unavailable)
+async def nessie_unavailable(request: Request, exc: nessie_client.Unavailable):
+    # refused before reaching Nessie, so the client can safely try again
+    return JSONResponse({"detail": f"Nessie unavailable: {exc}"}, status_code=503,
+                        headers={"Retry-After": str(max(round(exc.retry_after), 1))})
+
+@app.exception_handler(nessie_client.DeadlineExceeded)
+async def nessie_deadline(request: Request, exc: nessie_client.DeadlineExceeded):
+    return JSONResponse({"detail": str(exc)}, status_code=504)
+
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 @app.on_event("startup")
 async def on_startup():
-    print("startup pid", os.getpid())
+    logger.info("starting worker pid %d", os.getpid())
     database.init()
-    if not Path("data").is_dir() or not any(Path("data").glob("*.json")):
+    # with several workers on one store only the first to claim it seeds
+    if database.is_empty() and database.claim("seed"):
         database.seed_data()  # create seeded members/families in-memory
     database.sync()
+    if not database.SHARED_STORE:
+        database.flusher.start()
+        history.archiver.start()
+    await nessie_client.start()
+    outbox.dispatcher.start()
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await outbox.dispatcher.stop()
+    await nessie_client.close()
+    await history.archiver.stop()
+    await database.flusher.stop()
+    if profiling.ENABLED:
+        profiling.profiles.save()
 
 @app.middleware("http")
 async def add_custom_header(request: Request, call_next):
+    began = time.perf_counter()
+    status = 500
+    sampled = profiling.begin(request) if profiling.ENABLED else None
+    try:
+        if idempotency.applies(request):
+            # outside the durable flush, so a replayed response is one that reached disk
+            response = await idempotency.handle(request, lambda: handle_request(request, call_next))
+        else:
+            response = await handle_request(request, call_next)
+        status = response.status_code
+        return response
+    finally:
+        profiling.end(sampled)
+        route = route_label(request)
+        metrics.http_latency.observe(time.perf_counter() - began, request.method, route)
+        metrics.http_requests.inc(request.method, route, str(status))
+
+async def handle_request(request: Request, call_next):
+    if database.SHARED_STORE:
+        return await shared_store_request(request, call_next)
     response = await call_next(request)
-    database.sync()
-    return response
\ No newline at end of file
+    # Writes are group-committed by the flusher; durable routes (or callers sending
+    # `X-Durable: 1`) wait until their changes are on disk before the response goes out.
+    route = request.scope.get("route")
+    if database.is_durable(getattr(route, "endpoint", None)) or request.headers.get("x-durable") == "1":
+        await database.flusher.flush()
+    return response
+
+async def shared_store_request(request: Request, call_next):
+    # Several workers share one store: catch up with the others' writes first, then commit
+    # this request's own writes before answering. If another worker changed the same records
+    # in the meantime, its version stands and the client is asked to retry.
+    database.refresh()
+    token = database.collect_request_keys()
+    try:
+        response = await call_next(request)
+    finally:
+        keys = database.end_request_keys(token)
+    if keys:
+        try:
+            await run_in_threadpool(profiling.call, "commit()", database.commit, keys)
+        except database.WriteConflict:
+            return JSONResponse({"detail": "Conflicting update from another worker; retry the request"},
+                                status_code=409)
+    return response
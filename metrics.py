@@ -0,0 +1,126 @@
+# In-process metrics, served at GET /metrics in the Prometheus text format.
+#
+# Counters and histograms are plain lists of numbers behind a lock per metric, so recording
+# costs a bisect and a few additions. Gauges are read from callbacks at scrape time only.
+# Nothing here imports the app's modules; they record into the metrics defined below.
+import bisect
+import threading
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+# Seconds; Prometheus' default buckets with finer steps under 5 ms for in-memory handlers.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+Labels = Tuple[str, ...]
+
+_metrics: List["Metric"] = []
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def _label_text(self, values: Labels, extra: str = "") -> str:
+        pairs = [f'{k}="{_escape(v)}"' for k, v in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self) -> Iterable[str]:
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in sorted(values):
+            yield f"{self.name}{self._label_text(labels)} {_number(value)}"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self._series: Dict[Labels, list] = {}  # labels -> [count per bucket (+Inf last), sum]
+
+    def observe(self, value: float, *labels: str) -> None:
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    def samples(self) -> Iterable[str]:
+        with self._lock:
+            series = [(labels, list(counts), total) for labels, (counts, total) in self._series.items()]
+        for labels, counts, total in sorted(series):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{_number(bound)}"'
+                yield f"{self.name}_bucket{self._label_text(labels, le)} {cumulative}"
+            yield f"{self.name}_sum{self._label_text(labels)} {_number(total)}"
+            yield f"{self.name}_count{self._label_text(labels)} {cumulative}"
+
+
+class Gauge(Metric):
+    """Read at scrape time from `collect`, which yields (label values, value) pairs."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str], collect: Callable[[], Iterable[Tuple[Labels, float]]]):
+        super().__init__(name, help, labels)
+        self.collect = collect
+
+    def samples(self) -> Iterable[str]:
+        for labels, value in sorted(self.collect()):
+            yield f"{self.name}{self._label_text(labels)} {_number(value)}"
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in _metrics) + "\n"
+
+
+http_requests = Counter("credibridge_http_requests_total", "HTTP requests by route and status.",
+                        ("method", "route", "status"))
+http_latency = Histogram("credibridge_http_request_duration_seconds", "HTTP request latency by route.",
+                         ("method", "route"))
+sync_latency = Histogram("credibridge_sync_duration_seconds",
+                         "Time to write a batch of changed records to storage.", ("kind",))
+sync_bytes = Counter("credibridge_sync_bytes_total", "Bytes of UTF-8 encoded JSON records written to storage.")
+sync_records = Counter("credibridge_sync_records_total", "Records written or deleted in storage.")
+nessie_latency = Histogram("credibridge_nessie_request_duration_seconds",
+                           "Nessie call latency by call, queueing and retries included.", ("call",))
+nessie_calls = Counter("credibridge_nessie_requests_total", "Nessie calls by call and outcome.",
+                       ("call", "outcome"))
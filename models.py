@@ -23,9 +23,9 @@ class Member(BaseModel):
     balance: float = 0.0
     nessie_customer_id: Optional[str] = None
     nessie_account_id: List[Dict[str, Any]] = Field(default_factory=list)
-    transactions: List[Transaction] = Field(default_factory=list)
+    transactions: List[str] = Field(default_factory=list)           # transaction IDs, oldest first
     debts: Dict[str, float] = Field(default_factory=dict)            # {lender_id: amount_owed}
-    tracked_transactions: List[Transaction] = Field(default_factory=list)
+    tracked_transactions: List[str] = Field(default_factory=list)   # transaction IDs, oldest first
     family_id: Optional[str] = None
     current_debt: float = 0.0
     requests: Dict[str, Any] = Field(default_factory=dict)          # {request_id: MoneyRequest}
@@ -50,4 +50,39 @@ class MoneyRequest(BaseModel):
     amount: float
     date: datetime.datetime = Field(default_factory=datetime.datetime.now)
     status: str = "pending"
-    description: Optional[str] = None
\ No newline at end of file
+    description: Optional[str] = None
+
+class HistorySegment(BaseModel):
+    # Older transactions of one family, moved out of memory into data/history (history.py)
+    id: str                                   # sorts in creation order
+    family_id: Optional[str] = None
+    first_date: datetime.datetime
+    last_date: datetime.datetime
+    count: int = 0                            # transactions in the file
+    members: Dict[str, List[int]] = Field(default_factory=dict)  # {member_id: [transactions, tracked_transactions] archived}
+
+class Operation(BaseModel):
+    # A pending Nessie call recorded with the local change that needs it (outbox.py)
+    id: str
+    kind: str                                 # outbox handler name
+    payload: Dict[str, Any] = Field(default_factory=dict)
+    status: str = "pending"                   # pending | running | succeeded | failed | unknown
+    attempts: int = 0
+    result: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
+    created: datetime.datetime = Field(default_factory=datetime.datetime.now)
+    finished: Optional[datetime.datetime] = None
+    next_attempt: Optional[datetime.datetime] = None
+    lease_until: Optional[datetime.datetime] = None   # while running: when another dispatcher may take over
+
+class MoneyRequestItem(BaseModel):
+    # one entry of POST /request/bulk_request_money
+    from_id: str
+    to_id: str
+    amount: float
+    description: Optional[str] = None
+
+class ResolutionItem(BaseModel):
+    # one entry of POST /request/bulk_resolve
+    request_id: str
+    success: bool
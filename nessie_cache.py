@@ -0,0 +1,180 @@
+# In-process caches in front of Nessie reads.
+import asyncio
+import logging
+import os
+import threading
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+MERCHANT_CACHE_TTL = float(os.getenv("MERCHANT_CACHE_TTL", 300))
+# Past this age a stale catalog is not served any more; callers wait for the refresh instead.
+MERCHANT_CACHE_MAX_STALE = float(os.getenv("MERCHANT_CACHE_MAX_STALE", 3600))
+BALANCE_CACHE_TTL = float(os.getenv("BALANCE_CACHE_TTL", 5))
+# A check is borderline, and re-reads Nessie, when the amount is within this fraction of the
+# cached balance (or exceeds it).
+BALANCE_CACHE_MARGIN = float(os.getenv("BALANCE_CACHE_MARGIN", 0.1))
+
+logger = logging.getLogger(__name__)
+
+
+class MerchantCatalog:
+    """The Nessie merchant list, fetched once per TTL and shared by every caller.
+
+    Within the TTL the cached copy is served as is. After it, the stale copy keeps being served
+    while one background refresh runs. Concurrent misses all await the same fetch, so a burst of
+    callers costs a single upstream request.
+    """
+
+    def __init__(self, fetch: Callable[[], Awaitable[List[dict]]],
+                 ttl: float = MERCHANT_CACHE_TTL, max_stale: float = MERCHANT_CACHE_MAX_STALE):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self._merchants: Optional[List[dict]] = None
+        self._fetched_at = 0.0
+        self._refreshing: Optional[asyncio.Task] = None
+        self._added_during_refresh: List[dict] = []
+
+    async def get(self) -> List[dict]:
+        if self._merchants is not None:
+            age = time.monotonic() - self._fetched_at
+            if age < self.ttl:
+                return self._merchants
+            if age < self.max_stale:
+                self._refresh()
+                return self._merchants
+        return await asyncio.shield(self._refresh())
+
+    async def page(self, offset: int = 0, limit: int = 5, category: Optional[str] = None):
+        merchants = await self.get()
+        if category:
+            wanted = category.lower()
+            merchants = [m for m in merchants if wanted in _categories(m)]
+        return merchants[offset:offset + limit], len(merchants)
+
+    def add(self, merchant: dict) -> None:
+        # Make a merchant we just created visible without waiting for the next refresh.
+        if self._merchants is not None:
+            self._merchants = self._merchants + [merchant]
+        if self._refreshing is not None:
+            # the in-flight fetch may have been answered before this merchant existed
+            self._added_during_refresh.append(merchant)
+
+    def invalidate(self) -> None:
+        self._merchants = None
+
+    def _refresh(self) -> asyncio.Task:
+        if self._refreshing is None:
+            self._added_during_refresh = []
+            self._refreshing = asyncio.get_running_loop().create_task(self._fetch())
+            self._refreshing.add_done_callback(self._refreshed)
+        return self._refreshing
+
+    async def _fetch(self) -> List[dict]:
+        merchants = await self.fetch()
+        known = {m.get("_id") for m in merchants}
+        merchants += [m for m in self._added_during_refresh if m.get("_id") not in known]
+        self._merchants = merchants
+        self._fetched_at = time.monotonic()
+        return merchants
+
+    def _refreshed(self, task: asyncio.Task) -> None:
+        self._refreshing = None
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("merchant catalog refresh failed: %s", task.exception())
+
+
+class BalanceCache:
+    """Short-lived Nessie account balances, kept current with our own money movements.
+
+    Lookups for the same account while one is in flight share it. Purchases, withdrawals and
+    deposits we make adjust the cached figure locally, so a hot account pays one upstream read
+    per TTL instead of one per purchase; only a borderline check forces an early re-read.
+    """
+
+    def __init__(self, fetch: Callable[[str], Awaitable[float]],
+                 ttl: float = BALANCE_CACHE_TTL, margin: float = BALANCE_CACHE_MARGIN):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.margin = margin
+        self._entries: Dict[str, Tuple[float, float]] = {}  # account_id -> (balance, fetched_at)
+        self._fetching: Dict[str, asyncio.Task] = {}
+        self._debited_while_fetching: Dict[str, float] = {}
+        self._held: Dict[str, float] = {}  # account_id -> amount reserved by in-flight payments
+        # holds are released by outbox handlers in worker threads as well as taken on the loop
+        self._held_lock = threading.Lock()
+
+    async def get(self, account_id: str, max_age: Optional[float] = None) -> float:
+        return (await self._get(account_id, self.ttl if max_age is None else max_age))[0]
+
+    async def check(self, account_id: str, amount: float) -> float:
+        # Balance to compare `amount` against: cached unless the decision is close.
+        started = time.monotonic()
+        balance, fetched_at = await self._get(account_id, self.ttl)
+        if amount >= balance * (1 - self.margin) and fetched_at < started:
+            balance, _ = await self._get(account_id, 0)
+        return balance
+
+    def adjust(self, account_id: str, delta: float) -> None:
+        entry = self._entries.get(account_id)
+        if entry is not None:
+            self._entries[account_id] = (entry[0] + delta, entry[1])
+        if account_id in self._fetching and delta < 0:
+            # the in-flight read may predate this debit; count it again rather than risk
+            # overstating the balance (a credit is left for the next read to pick up)
+            self._debited_while_fetching[account_id] = self._debited_while_fetching.get(account_id, 0) + delta
+
+    def reserve(self, account_id: str, amount: float, balance: float) -> bool:
+        # Hold `amount` for a payment about to be sent, if the balance minus what other in-flight
+        # payments hold covers it. The decision and the hold happen together, under the lock.
+        entry = self._entries.get(account_id)
+        with self._held_lock:
+            available = (entry[0] if entry is not None else balance) - self._held.get(account_id, 0)
+            if available < amount:
+                return False
+            self._held[account_id] = self._held.get(account_id, 0) + amount
+            return True
+
+    def release(self, account_id: str, amount: float) -> None:
+        # Drop a hold once its payment has landed (and adjusted the balance) or failed.
+        with self._held_lock:
+            held = self._held.get(account_id, 0) - amount
+            if held > 1e-9:
+                self._held[account_id] = held
+            else:
+                self._held.pop(account_id, None)
+
+    def invalidate(self, account_id: str) -> None:
+        self._entries.pop(account_id, None)
+
+    async def _get(self, account_id: str, max_age: float) -> Tuple[float, float]:
+        entry = self._entries.get(account_id)
+        if entry is not None and time.monotonic() - entry[1] < max_age:
+            return entry
+        task = self._fetching.get(account_id)
+        if task is None:
+            self._debited_while_fetching[account_id] = 0
+            task = asyncio.get_running_loop().create_task(self._fetch(account_id))
+            task.add_done_callback(lambda t: self._fetched(account_id, t))
+            self._fetching[account_id] = task
+        return await asyncio.shield(task)
+
+    def _fetched(self, account_id: str, task: asyncio.Task) -> None:
+        self._fetching.pop(account_id, None)
+        self._debited_while_fetching.pop(account_id, None)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("balance read for %s failed: %s", account_id, task.exception())
+
+    async def _fetch(self, account_id: str) -> Tuple[float, float]:
+        balance = await self.fetch(account_id)
+        entry = (balance + self._debited_while_fetching.pop(account_id, 0), time.monotonic())
+        self._entries[account_id] = entry
+        return entry
+
+
+def _categories(merchant: dict) -> List[str]:
+    # Nessie returns `category` as a list of strings, older records as a single string.
+    category = merchant.get("category") or []
+    if isinstance(category, str):
+        category = [category]
+    return [c.lower() for c in category]
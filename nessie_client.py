@@ -0,0 +1,377 @@
+# Shared connection pool for every call to the Nessie API, and the limits around it.
+#
+# Each call names its route (see ROUTES), which sets its deadline, how many of its requests may
+# be in flight at once and whether it may be retried. On top of that:
+#
+#   - at most NESSIE_MAX_IN_FLIGHT requests are out at once; further calls queue for a slot, up
+#     to NESSIE_MAX_QUEUE waiting, until their deadline;
+#   - a circuit breaker opens when most recent calls failed, and fails calls fast (Unavailable)
+#     for NESSIE_BREAKER_COOLDOWN seconds before letting one probe through;
+#   - idempotent GETs retry connection errors, timeouts, 429 and 5xx answers while their
+#     deadline allows, but only while the retry budget (a fraction of recent requests) lasts,
+#     so retries cannot multiply the load on a struggling upstream.
+#
+# A call refused before it went out raises Unavailable; one that went out but got no answer by
+# its deadline raises DeadlineExceeded, and may have taken effect upstream.
+import asyncio
+import collections
+import logging
+import os
+import random
+import time
+from typing import Any, Deque, Dict, NamedTuple, Optional, Tuple
+
+import httpx
+from dotenv import load_dotenv
+
+import metrics
+
+load_dotenv()
+NESSIE_API_KEY = os.getenv("NESSIE_API_KEY")
+# Point at a local stand-in (python -m benchmarks.fake_nessie) for offline load tests.
+BASE_URL = os.getenv("NESSIE_BASE_URL", "http://api.nessieisreal.com")
+
+MAX_CONNECTIONS = int(os.getenv("NESSIE_MAX_CONNECTIONS", 100))
+MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("NESSIE_MAX_KEEPALIVE_CONNECTIONS", 20))
+KEEPALIVE_EXPIRY = float(os.getenv("NESSIE_KEEPALIVE_EXPIRY", 30))
+TIMEOUT = float(os.getenv("NESSIE_TIMEOUT", 10))
+CONNECT_TIMEOUT = float(os.getenv("NESSIE_CONNECT_TIMEOUT", 3))
+# HTTP/2 needs the optional `h2` package (pip install httpx[http2]) and only applies to https
+# base URLs; plain http:// stays on HTTP/1.1 keep-alive.
+HTTP2 = os.getenv("NESSIE_HTTP2") == "1"
+
+MAX_IN_FLIGHT = int(os.getenv("NESSIE_MAX_IN_FLIGHT", 64))
+MAX_QUEUE = int(os.getenv("NESSIE_MAX_QUEUE", 512))
+BREAKER_WINDOW = float(os.getenv("NESSIE_BREAKER_WINDOW", 10))        # seconds of calls considered
+BREAKER_MIN_CALLS = int(os.getenv("NESSIE_BREAKER_MIN_CALLS", 20))
+BREAKER_FAILURE_RATIO = float(os.getenv("NESSIE_BREAKER_FAILURE_RATIO", 0.5))
+BREAKER_COOLDOWN = float(os.getenv("NESSIE_BREAKER_COOLDOWN", 5))
+RETRY_BUDGET_RATIO = float(os.getenv("NESSIE_RETRY_BUDGET_RATIO", 0.1))  # retries per request
+RETRY_BUDGET_MAX = float(os.getenv("NESSIE_RETRY_BUDGET_MAX", 10))
+RETRY_BACKOFF = float(os.getenv("NESSIE_RETRY_BACKOFF", 0.05))
+
+
+class Route(NamedTuple):
+    deadline: float    # seconds for the whole call: queueing, every attempt and backoff
+    limit: int         # requests of this route in flight at once
+    retries: int = 0   # extra attempts; only for idempotent calls
+
+
+ROUTES: Dict[str, Route] = {
+    "get_account": Route(deadline=3, limit=32, retries=2),
+    "list_merchants": Route(deadline=5, limit=4, retries=2),
+    "create_customer": Route(deadline=8, limit=16),
+    "create_account": Route(deadline=8, limit=16),
+    "create_merchant": Route(deadline=8, limit=8),
+    "purchase": Route(deadline=8, limit=48),
+    "withdrawal": Route(deadline=8, limit=32),
+    "deposit": Route(deadline=8, limit=32),
+}
+DEFAULT_ROUTE = Route(deadline=TIMEOUT, limit=MAX_IN_FLIGHT)
+
+logger = logging.getLogger(__name__)
+
+
+class NessieError(Exception):
+    pass
+
+class Unavailable(NessieError):
+    """The call was refused before it went out: circuit open or too many calls waiting."""
+
+    def __init__(self, message: str, retry_after: float = 1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class DeadlineExceeded(NessieError):
+    """No answer within the route's deadline; the request may still have reached Nessie."""
+
+
+class CircuitBreaker:
+    """Closed while calls mostly succeed; open (failing fast) after a run of failures.
+
+    Outcomes of the last `window` seconds are kept. Once at least `min_calls` are recorded and
+    `failure_ratio` of them failed, the breaker opens for `cooldown` seconds, then lets a single
+    probe through: its success closes the breaker, its failure opens it again. Calls admitted
+    before the breaker last closed do not count: their timeouts describe the outage just over.
+    """
+
+    def __init__(self, window: float = BREAKER_WINDOW, min_calls: int = BREAKER_MIN_CALLS,
+                 failure_ratio: float = BREAKER_FAILURE_RATIO, cooldown: float = BREAKER_COOLDOWN):
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.closed_at = 0.0
+        self._outcomes: Deque[Tuple[float, bool]] = collections.deque()
+        self._failures = 0
+        self._probing = False
+        self.opened = 0
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() - self.opened_at < self.cooldown:
+            return False
+        if self._probing:
+            return False
+        self.state = "half_open"
+        self._probing = True
+        return True
+
+    def abandon(self) -> None:
+        # The call allowed through never got an answer (queued out, or cancelled): let the next
+        # call probe instead.
+        self._probing = False
+
+    def retry_after(self) -> float:
+        return max(self.cooldown - (time.monotonic() - self.opened_at), 0.1)
+
+    def record(self, ok: bool, admitted: float) -> None:
+        now = time.monotonic()
+        if self.state == "half_open":
+            self._probing = False
+            if ok:
+                self.state = "closed"
+                self.closed_at = now
+                self._outcomes.clear()
+                self._failures = 0
+            else:
+                self._open(now)
+            return
+        if admitted < self.closed_at:
+            return
+        self._outcomes.append((now, ok))
+        self._failures += not ok
+        while self._outcomes and self._outcomes[0][0] < now - self.window:
+            self._failures -= not self._outcomes.popleft()[1]
+        if (self.state == "closed" and len(self._outcomes) >= self.min_calls
+                and self._failures >= self.failure_ratio * len(self._outcomes)):
+            self._open(now)
+
+    def _open(self, now: float) -> None:
+        logger.warning("Nessie circuit breaker open for %gs", self.cooldown)
+        self.state = "open"
+        self.opened_at = now
+        self.opened += 1
+
+
+class RetryBudget:
+    # Every request earns `ratio` of a retry, up to `cap` banked; each retry spends one.
+    def __init__(self, ratio: float = RETRY_BUDGET_RATIO, cap: float = RETRY_BUDGET_MAX):
+        self.ratio = ratio
+        self.cap = cap
+        self.tokens = cap
+
+    def deposit(self) -> None:
+        self.tokens = min(self.tokens + self.ratio, self.cap)
+
+    def withdraw(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class Limiter:
+    """At most `limit` holders; up to `max_queue` callers wait for a slot, in arrival order."""
+
+    def __init__(self, limit: int, max_queue: int):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self._waiters: Deque[asyncio.Future] = collections.deque()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self, timeout: float) -> None:
+        if self.in_flight < self.limit and not self._waiters:
+            self.in_flight += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            raise Unavailable("too many Nessie calls waiting")
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        timer = asyncio.get_running_loop().call_later(
+            max(timeout, 0), lambda: waiter.done() or waiter.set_exception(
+                Unavailable("no Nessie slot free before the deadline")))
+        try:
+            await waiter  # the slot is handed over by release()
+        except BaseException:
+            if waiter.done() and not waiter.cancelled() and waiter.exception() is None:
+                self.release()  # handed a slot just as this caller gave up
+            raise
+        finally:
+            timer.cancel()
+            try:
+                self._waiters.remove(waiter)
+            except ValueError:
+                pass
+
+    def release(self) -> None:
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+
+class _Upstream:
+    # Per-event-loop state, made by start().
+    def __init__(self):
+        self.limiter = Limiter(MAX_IN_FLIGHT, MAX_QUEUE)
+        self.routes: Dict[str, Limiter] = {}
+        self.breaker = CircuitBreaker()
+        self.budget = RetryBudget()
+        self.stats = collections.Counter()
+
+    def route(self, name: str, route: Route) -> Limiter:
+        limiter = self.routes.get(name)
+        if limiter is None:
+            limiter = self.routes[name] = Limiter(route.limit, MAX_QUEUE)
+        return limiter
+
+
+_client: Optional[httpx.AsyncClient] = None
+_upstream: Optional[_Upstream] = None
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        logger.warning("NESSIE_HTTP2=1 but the h2 package is not installed; using HTTP/1.1")
+        return False
+    return True
+
+async def start(transport: Optional[httpx.AsyncBaseTransport] = None) -> httpx.AsyncClient:
+    # Called from app startup; `transport` lets tests and benchmarks route calls in-process.
+    global _client, _upstream
+    if _client is None:
+        _upstream = _Upstream()
+        _client = httpx.AsyncClient(
+            base_url=BASE_URL,
+            params={"key": NESSIE_API_KEY},
+            limits=httpx.Limits(
+                max_connections=MAX_CONNECTIONS,
+                max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(TIMEOUT, connect=CONNECT_TIMEOUT),
+            http2=HTTP2 and _http2_available(),
+            transport=transport,
+        )
+    return _client
+
+async def close() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+metrics.Gauge("credibridge_nessie_in_flight", "Nessie requests out now.", (),
+              lambda: [((), _upstream.limiter.in_flight if _upstream else 0)])
+metrics.Gauge("credibridge_nessie_queued", "Nessie calls waiting for a slot.", (),
+              lambda: [((), _upstream.limiter.queued if _upstream else 0)])
+metrics.Gauge("credibridge_nessie_breaker_open", "1 while the Nessie circuit breaker refuses calls.", (),
+              lambda: [((), int(_upstream is not None and _upstream.breaker.state != "closed"))])
+
+def stats() -> Dict[str, Any]:
+    if _upstream is None:
+        return {}
+    u = _upstream
+    return {"in_flight": u.limiter.in_flight, "queued": u.limiter.queued, "breaker": u.breaker.state,
+            "breaker_opened": u.breaker.opened, "retry_tokens": u.budget.tokens, **u.stats}
+
+def _failed(response: Optional[httpx.Response]) -> bool:
+    # what counts against the breaker and may be retried: no answer, throttling, server errors
+    return response is None or response.status_code == 429 or response.status_code >= 500
+
+async def request(method: str, path: str, route: str = "", **kwargs: Any) -> httpx.Response:
+    """One call to Nessie under its route's deadline, limits and retry policy.
+
+    Returns the last response, as httpx does, error statuses included.
+    """
+    began = time.perf_counter()
+    outcome = "error"
+    try:
+        response = await _request(method, path, route, kwargs)
+        outcome = "ok" if response.is_success else f"{response.status_code // 100}xx"
+        return response
+    except Unavailable:
+        outcome = "unavailable"
+        raise
+    except DeadlineExceeded:
+        outcome = "deadline"
+        raise
+    finally:
+        metrics.nessie_latency.observe(time.perf_counter() - began, route or "other")
+        metrics.nessie_calls.inc(route or "other", outcome)
+
+async def _request(method: str, path: str, route: str, kwargs: Dict[str, Any]) -> httpx.Response:
+    # Scripts that never ran app startup still get a (lazily created) pooled client.
+    client = _client or await start()
+    u = _upstream
+    policy = ROUTES.get(route, DEFAULT_ROUTE)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + policy.deadline
+    attempt = 0
+    while True:
+        response, error = await _attempt(client, u, route, policy, deadline, method, path, kwargs)
+        if not _failed(response):
+            return response
+        attempt += 1
+        backoff = RETRY_BACKOFF * 2 ** (attempt - 1) * random.uniform(0.5, 1.0)
+        if attempt > policy.retries or loop.time() + backoff >= deadline or not u.budget.withdraw():
+            if response is not None:
+                return response
+            if isinstance(error, (asyncio.TimeoutError, httpx.ReadTimeout, httpx.WriteTimeout)):
+                u.stats["deadline_exceeded"] += 1
+                raise DeadlineExceeded(f"Nessie {route or path} got no answer within {policy.deadline}s") from error
+            raise error
+        u.stats["retries"] += 1
+        await asyncio.sleep(backoff)
+
+async def _attempt(client: httpx.AsyncClient, u: _Upstream, route: str, policy: Route, deadline: float,
+                   method: str, path: str, kwargs: Dict[str, Any]
+                   ) -> Tuple[Optional[httpx.Response], Optional[Exception]]:
+    # One request: a response, or the transport error / timeout that stood in for it.
+    loop = asyncio.get_running_loop()
+    if not u.breaker.allow():
+        u.stats["rejected_open"] += 1
+        raise Unavailable("Nessie circuit breaker open", u.breaker.retry_after())
+    admitted = time.monotonic()
+    route_limiter = u.route(route, policy)
+    try:
+        await route_limiter.acquire(deadline - loop.time())
+        try:
+            await u.limiter.acquire(deadline - loop.time())
+            try:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise Unavailable("no Nessie slot free before the deadline")
+                u.budget.deposit()
+                u.stats["requests"] += 1
+                timeout = httpx.Timeout(remaining, connect=min(CONNECT_TIMEOUT, remaining))
+                response = await asyncio.wait_for(client.request(method, path, timeout=timeout, **kwargs), remaining)
+            finally:
+                u.limiter.release()
+        finally:
+            route_limiter.release()
+    except Unavailable:
+        u.stats["rejected_queue"] += 1
+        u.breaker.abandon()
+        raise
+    except (asyncio.TimeoutError, httpx.TransportError) as e:
+        u.breaker.record(False, admitted)
+        return None, e
+    except BaseException:
+        # cancelled, or a bug: no verdict on Nessie's health
+        u.breaker.abandon()
+        raise
+    u.breaker.record(not _failed(response), admitted)
+    return response, None
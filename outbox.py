@@ -0,0 +1,328 @@
+# Transactional outbox for Nessie side effects.
+#
+# An endpoint records its local change and an Operation in the same request, so both reach
+# disk in the same sync() batch, and answers 202 with the operation's ID. The dispatcher then
+# runs the Nessie call in the background, with retries and backoff, and applies the outcome
+# locally. GET /operations/{id} reports progress; endpoints taking `wait` can still answer
+# synchronously if the operation finishes in time.
+#
+# Each kind of operation has a handler: `call` does the upstream work and returns the result,
+# `complete` applies it to the local stores and `fail` undoes the local change once the
+# operation is given up. An operation is started again after a retryable error, so `call`
+# should skip any step whose effect is already recorded locally. After a crash mid-call only
+# kinds registered with `rerun=True` are started again; for the others Nessie may already
+# have acted, so the operation ends as "unknown", to be reconciled by hand. A call can end it
+# the same way by raising OutcomeUnknown, e.g. after a timeout on a step it cannot repeat.
+import asyncio
+import datetime
+import functools
+import logging
+import os
+import random
+import time
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Optional, Set
+from uuid import uuid4
+
+import httpx
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+import database
+import nessie_client
+from models import Operation
+
+OUTBOX_CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", 64))  # nessie_client queues what its limits refuse
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 8))
+OUTBOX_BACKOFF = float(os.getenv("OUTBOX_BACKOFF", 0.5))          # first retry delay, doubled each time
+OUTBOX_BACKOFF_MAX = float(os.getenv("OUTBOX_BACKOFF_MAX", 60))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", 1))
+# A running operation whose dispatcher has not finished it by then (it crashed, or another
+# worker holds it) is picked up again.
+OUTBOX_LEASE = float(os.getenv("OUTBOX_LEASE", 120))
+OUTBOX_RETENTION = float(os.getenv("OUTBOX_RETENTION", 24 * 3600))
+OUTBOX_MAX_WAIT = float(os.getenv("OUTBOX_MAX_WAIT", 30))  # longest `wait` an endpoint honours
+
+FINISHED = ("succeeded", "failed", "unknown")
+
+logger = logging.getLogger(__name__)
+
+
+class OutcomeUnknown(Exception):
+    """Raised by a call when Nessie may or may not have acted; the operation ends "unknown"."""
+
+
+class Handler(NamedTuple):
+    call: Callable[[Operation], Awaitable[Dict[str, Any]]]
+    complete: Optional[Callable[[Operation, Dict[str, Any]], Dict[str, Any]]] = None  # -> stored result
+    fail: Optional[Callable[[Operation, str], None]] = None
+    rerun: bool = False  # safe to call again after a crash mid-call
+
+
+handlers: Dict[str, Handler] = {}
+
+def register(kind: str, call: Callable[[Operation], Awaitable[Dict[str, Any]]],
+             complete: Optional[Callable[[Operation, Dict[str, Any]], Dict[str, Any]]] = None,
+             fail: Optional[Callable[[Operation, str], None]] = None, rerun: bool = False) -> None:
+    handlers[kind] = Handler(call, complete, fail, rerun)
+
+
+def enqueue(kind: str, payload: Dict[str, Any], operation_id: Optional[str] = None) -> Operation:
+    """Record an operation next to the caller's local change; the dispatcher picks it up.
+
+    Reusing an `operation_id` returns the operation already recorded under it, so a retried
+    request does not queue the same upstream call twice.
+    """
+    if kind not in handlers:
+        raise ValueError(f"No outbox handler for {kind!r}")
+    operation_id = operation_id or str(uuid4())
+    existing = database.operations_db.get(operation_id)
+    if existing is not None:
+        return existing
+    operation = Operation(id=operation_id, kind=kind, payload=payload)
+    database.operations_db[operation.id] = operation
+    database.mark_dirty("operations", operation.id)
+    dispatcher.wake()
+    return operation
+
+async def respond(operation: Operation, wait: float, accepted: Dict[str, Any],
+                  failed_status: int, failed_detail: str) -> JSONResponse:
+    """The endpoint's answer: the result if the operation finishes within `wait` seconds,
+    otherwise 202 with `accepted` and where to poll."""
+    if wait > 0:
+        operation = await dispatcher.wait(operation.id, min(wait, OUTBOX_MAX_WAIT))
+    if operation.status == "succeeded":
+        return JSONResponse(jsonable_encoder(operation.result))
+    if operation.status == "failed":
+        raise HTTPException(failed_status, f"{failed_detail}: {operation.error}")
+    if operation.status == "unknown":
+        # not known to have failed, so no error status a client would take as "try again"
+        body = {"operation_id": operation.id, "status": operation.status, "detail": operation.error}
+        return JSONResponse(body, status_code=202, headers={"Location": f"/operations/{operation.id}"})
+    body = {**accepted, "operation_id": operation.id, "status": operation.status}
+    return JSONResponse(jsonable_encoder(body), status_code=202, headers={"Location": f"/operations/{operation.id}"})
+
+def describe(operation: Operation) -> Dict[str, Any]:
+    return operation.model_dump(include={"id", "kind", "status", "attempts", "result", "error", "created", "finished"})
+
+def _retryable(error: Exception) -> bool:
+    # Only failures where Nessie cannot have acted: the request never went out, or was turned
+    # away. A timeout or 500 mid-call may have gone through, and these calls are not idempotent.
+    if isinstance(error, nessie_client.Unavailable):
+        return True
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in (429, 503)
+    return isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+
+def uncertain(error: Exception) -> bool:
+    # The request may have reached Nessie and been acted on: it timed out or failed mid-call.
+    if _retryable(error):
+        return False
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    return isinstance(error, (nessie_client.DeadlineExceeded, httpx.TimeoutException, httpx.TransportError))
+
+def _backoff(attempts: int, error: Optional[Exception] = None) -> float:
+    if isinstance(error, nessie_client.Unavailable):
+        return error.retry_after  # the circuit breaker says when Nessie is worth trying again
+    delay = min(OUTBOX_BACKOFF * 2 ** (attempts - 1), OUTBOX_BACKOFF_MAX)
+    return delay * random.uniform(0.5, 1.0)  # jitter, so failures do not retry in lockstep
+
+def _is_due(operation: Operation, now: datetime.datetime) -> bool:
+    if operation.status == "pending":
+        return operation.next_attempt is None or operation.next_attempt <= now
+    return operation.status == "running" and operation.lease_until is not None and operation.lease_until <= now
+
+def due(now: datetime.datetime) -> List[Operation]:
+    found = []
+    for status in ("pending", "running"):
+        for operation_id in database.lookup("operations_by_status", status):
+            operation = database.operations_db.get(operation_id)
+            if operation is not None and _is_due(operation, now):
+                found.append(operation)
+    return sorted(found, key=lambda o: o.created)
+
+def prune(now: datetime.datetime) -> int:
+    # Finished operations are kept for polling for OUTBOX_RETENTION, then dropped; unknown ones
+    # stay until someone reconciles them.
+    cutoff = now - datetime.timedelta(seconds=OUTBOX_RETENTION)
+    expired = []
+    for status in ("succeeded", "failed"):
+        for operation_id in database.lookup("operations_by_status", status):
+            operation = database.operations_db.get(operation_id)
+            if operation is not None and operation.finished is not None and operation.finished < cutoff:
+                expired.append(operation_id)
+    for operation_id in expired:
+        database.operations_db.pop(operation_id, None)
+    database.mark_dirty("operations", *expired)
+    return len(expired)
+
+async def _wait_event(event: asyncio.Event, timeout: float) -> None:
+    # Not asyncio.wait_for: on 3.11 it drops a cancellation that arrives as the event is set,
+    # and the dispatcher is woken often enough for stop() to hang on that.
+    timer = asyncio.get_running_loop().call_later(timeout, event.set)
+    try:
+        await event.wait()
+    finally:
+        timer.cancel()
+
+
+class Dispatcher:
+    """Background runner for due operations, at most `concurrency` at a time."""
+
+    def __init__(self, concurrency: int = OUTBOX_CONCURRENCY, poll_interval: float = OUTBOX_POLL_INTERVAL):
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self._task: Optional[asyncio.Task] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._running: Set[str] = set()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._finished: Dict[str, asyncio.Event] = {}
+        self._pruned = 0.0
+
+    def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        self._task = self._loop.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def wake(self) -> None:
+        # Safe from handler threads as well as from the event loop.
+        if self._loop is None or self._wake is None:
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            self._wake.set()
+        else:
+            self._loop.call_soon_threadsafe(self._wake.set)
+
+    async def wait(self, operation_id: str, timeout: float) -> Operation:
+        """The operation once it has finished, or as it stands after `timeout` seconds."""
+        deadline = time.monotonic() + timeout
+        event = self._finished.setdefault(operation_id, asyncio.Event())
+        try:
+            while True:
+                event.clear()  # set by _dispatch, or by the timer in _wait_event
+                database.refresh()  # another worker may have run it
+                operation = database.operations_db[operation_id]
+                remaining = deadline - time.monotonic()
+                if operation.status in FINISHED or remaining <= 0:
+                    return operation
+                await _wait_event(event, min(remaining, self.poll_interval))
+        finally:
+            self._finished.pop(operation_id, None)
+
+    async def _run(self) -> None:
+        while True:
+            await _wait_event(self._wake, self.poll_interval)
+            self._wake.clear()
+            try:
+                if not database.SHARED_STORE:
+                    await database.flusher.flush()  # operations reach disk before their calls run
+                database.refresh()
+                now = datetime.datetime.now()
+                if time.monotonic() - self._pruned > 60:
+                    self._pruned = time.monotonic()
+                    prune(now)
+                for operation in due(now):
+                    if len(self._running) >= self.concurrency:
+                        break
+                    # not committed by its request yet (shared store)
+                    if operation.id not in self._running and not database.is_dirty("operations", operation.id):
+                        self._running.add(operation.id)
+                        self._loop.create_task(self._dispatch(operation.id))
+            except Exception:
+                logger.exception("outbox scan failed")
+
+    async def _dispatch(self, operation_id: str) -> None:
+        try:
+            operation = await asyncio.to_thread(database.commit_now, lambda: _claim(operation_id))
+            if operation is None:
+                return  # finished, or taken by another worker since the scan
+            handler = handlers[operation.kind]
+            try:
+                result = await handler.call(operation)
+            except Exception as e:
+                retry = _retryable(e) and operation.attempts < OUTBOX_MAX_ATTEMPTS
+                logger.warning("outbox %s %s attempt %d failed: %s", operation.kind, operation.id,
+                               operation.attempts, e)
+                await asyncio.to_thread(database.commit_now, functools.partial(_failed, operation, handler, e, retry))
+            else:
+                await asyncio.to_thread(database.commit_now, functools.partial(_succeeded, operation, handler, result))
+            if not database.SHARED_STORE:
+                await database.flusher.flush()  # with a shared store commit_now has written it
+        except Exception:
+            logger.exception("outbox dispatch of %s failed", operation_id)
+        finally:
+            self._running.discard(operation_id)
+            event = self._finished.get(operation_id)
+            if event is not None:
+                event.set()
+            self._wake.set()  # a slot is free
+
+
+def _claim(operation_id: str) -> Optional[Operation]:
+    operation = database.operations_db.get(operation_id)
+    now = datetime.datetime.now()
+    if operation is None or not _is_due(operation, now):
+        return None
+    handler = handlers[operation.kind]
+    if operation.status == "running" and not handler.rerun:
+        _interrupted(operation, handler)
+        return None
+    operation.status = "running"
+    operation.attempts += 1
+    operation.lease_until = now + datetime.timedelta(seconds=OUTBOX_LEASE)
+    database.mark_dirty("operations", operation.id)
+    return operation
+
+def _interrupted(operation: Operation, handler: Handler) -> None:
+    # Its lease ran out mid-call (the dispatcher crashed or hung), and Nessie may have acted on
+    # it; calling again could charge twice.
+    logger.error("outbox %s %s was interrupted mid-call; its outcome at Nessie needs reconciling",
+                 operation.kind, operation.id)
+    operation.status = "unknown"
+    operation.error = "interrupted while calling Nessie; whether it went through is unknown"
+    operation.lease_until = None
+    operation.finished = datetime.datetime.now()
+    if handler.fail is not None:
+        handler.fail(operation, operation.error)  # nothing more will happen to it here
+    database.mark_dirty("operations", operation.id)
+
+def _succeeded(operation: Operation, handler: Handler, result: Dict[str, Any]) -> None:
+    if handler.complete is not None:
+        result = handler.complete(operation, result)
+    operation.status = "succeeded"
+    operation.result = result
+    operation.error = None
+    operation.lease_until = None
+    operation.finished = datetime.datetime.now()
+    database.mark_dirty("operations", operation.id)
+
+def _failed(operation: Operation, handler: Handler, error: Exception, retry: bool) -> None:
+    operation.error = str(error) or type(error).__name__
+    operation.lease_until = None
+    if retry:
+        operation.status = "pending"
+        operation.next_attempt = datetime.datetime.now() + datetime.timedelta(seconds=_backoff(operation.attempts, error))
+    else:
+        # set first, so fail() can tell an outcome nobody knows from a refusal
+        operation.status = "unknown" if isinstance(error, OutcomeUnknown) else "failed"
+        if handler.fail is not None:
+            handler.fail(operation, operation.error)
+        operation.finished = datetime.datetime.now()
+    database.mark_dirty("operations", operation.id)
+
+
+dispatcher = Dispatcher()
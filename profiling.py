@@ -0,0 +1,169 @@
+# Sampled cProfile captures, aggregated per route and written to PROFILE_DIR.
+#
+# Off unless PROFILE_SAMPLE_RATE or PROFILE_TOKEN is set; then main.py wraps each route's
+# endpoint at startup, and nothing is wrapped or checked per call otherwise. A request is
+# profiled with probability PROFILE_SAMPLE_RATE, or always when it carries
+# `X-Profile: <PROFILE_TOKEN>`. The flusher's sync() is sampled at PROFILE_SAMPLE_RATE too.
+#
+# Profiles from one route add up into one pstats file per worker,
+# <PROFILE_DIR>/<route>.<pid>.prof, which `python -m pstats` or snakeviz read. They are listed
+# and served by GET /admin/profiles, to requests carrying the token; without PROFILE_TOKEN, or
+# with profiling off, those routes answer 404.
+#
+# A sync endpoint is profiled in its threadpool thread, so only its own work is counted. An
+# async endpoint is profiled on the event loop, one at a time. Anything else the loop runs
+# while that endpoint waits is counted with it.
+import cProfile
+import contextvars
+import datetime
+import functools
+import inspect
+import io
+import json
+import os
+import pstats
+import random
+import re
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0))
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+PROFILE_DIR = os.getenv("PROFILE_DIR", "data/profiles")
+PROFILE_WRITE_INTERVAL = float(os.getenv("PROFILE_WRITE_INTERVAL", 10))
+
+ENABLED = PROFILE_SAMPLE_RATE > 0 or bool(PROFILE_TOKEN)
+
+_sampled: contextvars.ContextVar[bool] = contextvars.ContextVar("profiling_sampled", default=False)
+_loop_busy = False  # a thread has one profiler at a time, so the loop profiles one endpoint
+
+
+def begin(request) -> Optional[contextvars.Token]:
+    """Mark the request for profiling if it is sampled; pass the result to end()."""
+    if (PROFILE_TOKEN and request.headers.get("x-profile") == PROFILE_TOKEN) or random.random() < PROFILE_SAMPLE_RATE:
+        return _sampled.set(True)
+    return None
+
+def end(token: Optional[contextvars.Token]) -> None:
+    if token is not None:
+        _sampled.reset(token)
+
+def call(label: str, fn: Callable, *args: Any) -> Any:
+    """fn(*args), profiled under `label` for a sampled fraction of calls."""
+    if not ENABLED or random.random() >= PROFILE_SAMPLE_RATE:
+        return fn(*args)
+    return _run(label, fn, args, {})
+
+def _run(label: str, fn: Callable, args: tuple, kwargs: dict) -> Any:
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        profiler.disable()
+        profiles.add(label, profiler)
+
+def instrument(route: Any, label: str) -> None:
+    """Profile sampled requests to `route` under `label`. Use only when ENABLED."""
+    dependant = getattr(route, "dependant", None)
+    if dependant is None or dependant.call is None:
+        return
+    endpoint = dependant.call
+    if inspect.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def profiled(*args, **kwargs):
+            global _loop_busy
+            if not _sampled.get() or _loop_busy:
+                return await endpoint(*args, **kwargs)
+            _loop_busy = True
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                profiler.disable()
+                _loop_busy = False
+                profiles.add(label, profiler)
+    else:
+        @functools.wraps(endpoint)
+        def profiled(*args, **kwargs):
+            if not _sampled.get():
+                return endpoint(*args, **kwargs)
+            return _run(label, endpoint, args, kwargs)
+    dependant.call = route.endpoint = profiled
+
+
+def _file_name(label: str) -> str:
+    slug = re.sub(r"[^A-Za-z0-9_{}-]+", "_", label).strip("_") or "root"
+    return f"{slug}.{os.getpid()}.prof"
+
+
+class Profiles:
+    """This worker's aggregated stats by label, written out at most every `write_interval`."""
+
+    def __init__(self, directory: str = PROFILE_DIR, write_interval: float = PROFILE_WRITE_INTERVAL):
+        self.directory = Path(directory)
+        self.write_interval = write_interval
+        self._lock = threading.Lock()
+        self._stats: Dict[str, pstats.Stats] = {}
+        self._samples: Dict[str, int] = {}
+        self._unsaved = set()
+        self._written = time.monotonic()
+
+    def add(self, label: str, profiler: cProfile.Profile) -> None:
+        stats = pstats.Stats(profiler)
+        with self._lock:
+            if label in self._stats:
+                self._stats[label].add(stats)
+            else:
+                self._stats[label] = stats
+            self._samples[label] = self._samples.get(label, 0) + 1
+            self._unsaved.add(label)
+            due = time.monotonic() - self._written >= self.write_interval
+        if due:
+            self.save()
+
+    def save(self) -> None:
+        with self._lock:
+            self._written = time.monotonic()
+            if not self._unsaved:
+                return
+            self.directory.mkdir(parents=True, exist_ok=True)
+            for label in self._unsaved:
+                self._stats[label].dump_stats(self.directory / _file_name(label))
+            self._unsaved.clear()
+            index = {_file_name(label): {"route": label, "samples": n} for label, n in self._samples.items()}
+            tmp = self.directory / f"index.{os.getpid()}.json.tmp"
+            tmp.write_text(json.dumps(index))
+            os.replace(tmp, self.directory / f"index.{os.getpid()}.json")
+
+
+def listing(directory: str = PROFILE_DIR) -> List[Dict[str, Any]]:
+    """Every profile on disk, from this worker and others, with its route and sample count."""
+    found = []
+    for index in sorted(Path(directory).glob("index.*.json")):
+        pid = int(index.name.split(".")[1])
+        for name, entry in json.loads(index.read_text()).items():
+            path = index.parent / name
+            if not path.exists():
+                continue
+            stat = path.stat()
+            found.append({"name": name, "route": entry["route"], "pid": pid, "samples": entry["samples"],
+                          "bytes": stat.st_size, "modified": datetime.datetime.fromtimestamp(stat.st_mtime)})
+    return found
+
+def path(name: str, directory: str = PROFILE_DIR) -> Optional[Path]:
+    # only names from the listing, so a request cannot reach other files
+    if any(entry["name"] == name for entry in listing(directory)):
+        return Path(directory) / name
+    return None
+
+def report(profile: Path, sort: str = "cumulative", limit: int = 50) -> str:
+    out = io.StringIO()
+    pstats.Stats(str(profile), stream=out).sort_stats(sort).print_stats(limit)
+    return out.getvalue()
+
+
+profiles = Profiles()
@@ -0,0 +1,110 @@
+# Storage-side representations, converted to the models.py API models only at the boundary.
+import datetime
+import sys
+from typing import Any, Dict, Optional
+
+from models import Transaction
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+def to_cents(amount: float) -> int:
+    return int(round(amount * 100))
+
+def from_cents(cents: int) -> float:
+    return cents / 100
+
+def _intern(value: Optional[str]) -> Optional[str]:
+    # member IDs, names and types repeat across a member's whole history; keep one copy of each
+    return sys.intern(value) if value is not None else None
+
+
+class TransactionRecord:
+    """One stored transaction: slotted, amounts in integer cents, date as integer microseconds.
+
+    A Pydantic Transaction costs a model instance, its __dict__, three floats and a datetime;
+    this is a single slotted object whose repeated strings are interned. Dates are naive, like
+    Transaction.date, and counted from a naive epoch so they round-trip exactly.
+    """
+
+    __slots__ = ("id", "type_transaction", "from_id", "to_id", "from_name", "to_name",
+                 "amount_cents", "from_debt_cents", "to_debt_cents", "date_us", "description")
+
+    def __init__(self, id: str, type_transaction: str, from_id: str, to_id: str, from_name: str,
+                 to_name: str, amount_cents: int, from_debt_cents: int, to_debt_cents: int,
+                 date_us: int, description: Optional[str] = None):
+        self.id = id
+        self.type_transaction = _intern(type_transaction)
+        self.from_id = _intern(from_id)
+        self.to_id = _intern(to_id)
+        self.from_name = _intern(from_name)
+        self.to_name = _intern(to_name)
+        self.amount_cents = amount_cents
+        self.from_debt_cents = from_debt_cents
+        self.to_debt_cents = to_debt_cents
+        self.date_us = date_us
+        self.description = description
+
+    @property
+    def date(self) -> datetime.datetime:
+        return _EPOCH + self.date_us * _MICROSECOND
+
+    @classmethod
+    def from_model(cls, transaction: Transaction) -> "TransactionRecord":
+        return cls(transaction.id, transaction.type_transaction, transaction.from_id, transaction.to_id,
+                   transaction.from_name, transaction.to_name, to_cents(transaction.amount),
+                   to_cents(transaction.from_debt), to_cents(transaction.to_debt),
+                   to_us(transaction.date), transaction.description)
+
+    def to_model(self) -> Transaction:
+        # Fields are already valid, so skip validation.
+        return Transaction.model_construct(
+            id=self.id, type_transaction=self.type_transaction, from_id=self.from_id, to_id=self.to_id,
+            from_name=self.from_name, to_name=self.to_name, amount=from_cents(self.amount_cents),
+            from_debt=from_cents(self.from_debt_cents), to_debt=from_cents(self.to_debt_cents),
+            date=self.date, description=self.description)
+
+    @classmethod
+    def from_plain(cls, plain: Dict[str, Any]) -> "TransactionRecord":
+        # The stored layout is Transaction's JSON, so existing snapshots, journals and rows load as is.
+        return cls(plain["id"], plain["type_transaction"], plain["from_id"], plain["to_id"],
+                   plain["from_name"], plain["to_name"], to_cents(plain["amount"]),
+                   to_cents(plain["from_debt"]), to_cents(plain["to_debt"]),
+                   to_us(_parse_date(plain.get("date"))), plain.get("description"))
+
+    @classmethod
+    def from_row(cls, row: tuple) -> "TransactionRecord":
+        return cls(*row)
+
+    def to_row(self) -> tuple:
+        # Binary snapshot layout (snapshots.py): the slots in order.
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def to_plain(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "type_transaction": self.type_transaction,
+            "from_id": self.from_id,
+            "to_id": self.to_id,
+            "from_name": self.from_name,
+            "to_name": self.to_name,
+            "amount": from_cents(self.amount_cents),
+            "from_debt": from_cents(self.from_debt_cents),
+            "to_debt": from_cents(self.to_debt_cents),
+            "date": self.date.isoformat(),
+            "description": self.description,
+        }
+
+
+def to_us(date: datetime.datetime) -> int:
+    if date.tzinfo is not None:
+        date = date.astimezone().replace(tzinfo=None)
+    return (date - _EPOCH) // _MICROSECOND
+
+def _parse_date(value: Any) -> datetime.datetime:
+    if value is None:
+        return datetime.datetime.now()
+    if isinstance(value, datetime.datetime):
+        return value
+    return datetime.datetime.fromisoformat(value)
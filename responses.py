@@ -0,0 +1,90 @@
+# Cached JSON responses for hot read endpoints.
+#
+# A response is cached as encoded bytes together with the versions of the records it was built
+# from (database.version, bumped by every mark_dirty). While none of those versions move, the
+# bytes are served as they are, and a client echoing the ETag gets an empty 304.
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Iterable, Tuple
+
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+
+import database
+
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 10_000))
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(obj: Any) -> bytes:
+    # orjson (pip install orjson) encodes model_dump() output, datetimes included, several times
+    # faster than the stdlib; without it the payload goes through jsonable_encoder as before.
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(jsonable_encoder(obj), separators=(",", ":"), ensure_ascii=False).encode()
+
+
+class ResponseCache:
+    """LRU of (versions, body, etag) per response key."""
+
+    def __init__(self, size: int = RESPONSE_CACHE_SIZE):
+        self.size = size
+        self._entries: "OrderedDict[Hashable, Tuple[tuple, bytes, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, versions: tuple, build: Callable[[], Any]) -> Tuple[bytes, str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == versions:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1], entry[2]
+            self.misses += 1
+        # Built outside the lock. `versions` was read before building, so a change that lands
+        # meanwhile leaves this entry behind the record and the next request rebuilds it.
+        body = build()
+        etag = '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+        with self._lock:
+            self._entries[key] = (versions, body, etag)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return body, etag
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+cache = ResponseCache()
+
+
+def _not_modified(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    return header.strip() == "*" or etag in (tag.strip().removeprefix("W/") for tag in header.split(","))
+
+
+def cached_json(request: Request, key: Hashable, records: Iterable[Tuple[str, str]],
+                build: Callable[[], Any]) -> Response:
+    """Serve `build()` as JSON, re-encoding it only when one of `records` has changed.
+
+    `records` lists every (store, key) the payload is read from. The ETag hashes the body, so it
+    is the same from every worker and across restarts.
+    """
+    versions = tuple(database.version(store, record_key) for store, record_key in records)
+    body, etag = cache.get(key, versions, lambda: dumps(build()))
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if _not_modified(request, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
@@ -1,6 +1,14 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from typing import Iterator, List, Optional
 from models import Family
+from records import to_us
+import datetime
 import database
+import heapq
+import history
+import responses
+import settlement
 import uuid
 
 router = APIRouter()
@@ -12,19 +20,98 @@ def create_family(name: str):
     new_family = Family(id=fid, name=name)
 
     database.families_db[fid] = new_family
+    database.mark_dirty("families", fid)
     return {"family_id": fid, "message": "Family created successfully"}
 
 @router.get("/{family_id}")
-def get_family(family_id: str):
+def get_family(family_id: str, request: Request):
     family = database.families_db.get(family_id)
     if not family:
         raise HTTPException(404, "Family not found")
-    return family
+    return responses.cached_json(request, ("family", family_id), [("families", family_id)], family.model_dump)
 
 @router.get("/get_members/{family_id}")
-def get_family_members(family_id: str):
+def get_family_members(family_id: str, request: Request):
     if database.families_db.get(family_id) is None:
         raise HTTPException(404, "Family not found")
-    
-    members = [database.members_db[member_id] for member_id in database.families_db[family_id].members]
-    return {"family_id": family_id, "members": members}
\ No newline at end of file
+
+    roster = _roster(family_id)
+    # the family's version covers its join order, and member versions cover who is still in it
+    return responses.cached_json(
+        request, ("family_members", family_id),
+        [("families", family_id)] + [("members", member_id) for member_id in roster],
+        lambda: {"family_id": family_id, "members": [database.members_db[m].model_dump() for m in roster]})
+
+def _roster(family_id: str) -> List[str]:
+    # Members in the order they joined (family.members); the index says who is still in the family.
+    current = set(database.lookup("members_by_family", family_id))
+    return [m for m in dict.fromkeys(database.families_db[family_id].members) if m in current]
+
+EXPORT_CHUNK = 64 * 1024  # bytes per chunk; the generator runs in the threadpool, one hop per chunk
+
+def _export_lines(member_ids: List[str], since: Optional[datetime.datetime],
+                  until: Optional[datetime.datetime]) -> Iterator[bytes]:
+    since_us = to_us(since) if since is not None else -1 << 63
+    until_us = to_us(until) if until is not None else 1 << 63
+    transactions = ((r.date_us, r.id, "transaction", r.to_plain()) for r in history.stream(member_ids, since, until))
+    # money requests are all in memory anyway; only references to them are sorted here
+    request_ids = {r for m in member_ids for index in ("requests_by_from", "requests_by_to")
+                   for r in database.lookup(index, m)}
+    found = (database.money_requests_db.get(r) for r in request_ids)
+    money_requests = sorted((to_us(r.date), r.id, "money_request", r) for r in found
+                            if r is not None and since_us <= to_us(r.date) < until_us)
+    chunk = bytearray()
+    for _, _, kind, entry in heapq.merge(transactions, money_requests, key=lambda e: e[:2]):
+        if kind == "money_request":
+            entry = entry.model_dump()
+        chunk += responses.dumps({"kind": kind, **entry}) + b"\n"
+        if len(chunk) >= EXPORT_CHUNK:
+            yield bytes(chunk)
+            chunk.clear()
+    if chunk:
+        yield bytes(chunk)
+
+@router.get("/{family_id}/export")
+def export_family(family_id: str, since: Optional[datetime.datetime] = None,
+                  until: Optional[datetime.datetime] = None):
+    # The family's transactions and money requests as NDJSON, oldest first, each once, archived
+    # history included; `since` (inclusive) and `until` (exclusive) bound the dates. A client
+    # syncing incrementally passes the last date it has as `since` and drops the IDs it already has.
+    if database.families_db.get(family_id) is None:
+        raise HTTPException(404, "Family not found")
+    roster = _roster(family_id)
+    return StreamingResponse(_export_lines(roster, since, until), media_type="application/x-ndjson")
+
+@router.post("/{family_id}/settle")
+@database.durable
+async def settle_family_debts(family_id: str, nessie: bool = False):
+    # Net every debt between family members into the fewest transfers and settle them at once.
+    # With `nessie` the ledger is settled here and the Nessie transfers are queued in the outbox
+    # (see settlement.py), so an error status always means nothing moved.
+    try:
+        plan = settlement.plan_family(family_id)
+    except KeyError:
+        raise HTTPException(404, "Family not found")
+    if not plan.edges:
+        return {"message": "No debts to settle", "edges_settled": 0, "transfers": []}
+    if nessie:
+        missing = settlement.without_accounts(plan)
+        if missing:
+            names = ", ".join(database.members_db[m].first_name for m in missing)
+            raise HTTPException(409, f"Nessie account not ready for: {names}")
+    try:
+        transactions = settlement.apply(plan)
+    except settlement.SettlementError as e:
+        raise HTTPException(400, str(e))
+    body = {
+        "message": f"Settled {len(plan.edges)} debts with {len(plan.transfers)} transfers",
+        "edges_settled": len(plan.edges),
+        "transfers": [t.__dict__ for t in plan.transfers],
+        "transaction_ids": [t.id for t in transactions],
+    }
+    if not nessie or not transactions:
+        return body  # debts that net to zero are cleared without moving money
+    operations = settlement.queue_transfers(plan, transactions)
+    body["operations"] = [{"operation_id": o.id, "status": o.status, "location": f"/operations/{o.id}"}
+                          for o in operations]
+    return JSONResponse(body, status_code=202)
\ No newline at end of file
@@ -1,23 +1,26 @@
-from fastapi import APIRouter, HTTPException
-from models import Member, Transaction, MoneyRequest
+from fastapi import APIRouter, HTTPException, Request
+from models import Member, Operation, Transaction, MoneyRequest
 import database
-import httpx, uuid, os
-from dotenv import load_dotenv
-from typing import Optional
+import history
+import outbox
+import responses
+import asyncio, uuid
+from typing import Any, Dict, Optional
 
-from routers.nessie import create_nessie_customer
+from routers.nessie import create_nessie_customer, create_nessie_account
 from datetime import datetime
 
 router = APIRouter()
-load_dotenv()
 
-NESSIE_API_KEY = os.getenv("NESSIE_API_KEY")
-BASE_URL = "http://api.nessieisreal.com"
+MAX_PAGE_SIZE = 500
 
 router = APIRouter()
 
-@router.post('/register')
-async def create_member(first_name_temp: str, last_name_temp: str):
+@router.post('/register', status_code=202)
+@database.durable
+async def create_member(first_name_temp: str, last_name_temp: str, wait: float = 0):
+    """Register a member. The member exists right away; their Nessie customer and checking
+    account are created in the background (poll /operations/{id}, or pass `wait`)."""
     first_name = first_name_temp
     last_name = last_name_temp
 
@@ -29,54 +32,64 @@ async def create_member(first_name_temp: str, last_name_temp: str):
         balance=500.0,
         nessie_account_id=[])
 
-    try:
-        nessie_customer = await create_nessie_customer(first_name, last_name)
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Nessie customer creation failed: {e}")
-    
-    nessie_customer_id = nessie_customer['_id']
-
-    # Step 2 — Create a checking account for that customer
-    account_data = {
-        "type": "Checking",
-        "nickname": f"{first_name}'s Account",
-        "rewards": 0,
-        "balance": 500  # mock starting balance
-    }
-
-    async with httpx.AsyncClient() as client:
-        acc_res = await client.post(
-            f"{BASE_URL}/customers/{nessie_customer_id}/accounts?key={NESSIE_API_KEY}",
-            json=account_data
-        )
-
-        if acc_res.status_code != 201:
-            raise HTTPException(
-                status_code=acc_res.status_code,
-                detail=f"Nessie account creation failed: {acc_res.text}"
-            )
-
-        nessie_account = acc_res.json()["objectCreated"]
-
     database.members_db[mid] = member
-
-    database.members_db[mid].nessie_customer_id = nessie_customer_id
-    database.members_db[mid].nessie_account_id.append(nessie_account)
-
+    database.mark_dirty("members", mid)
+    operation = outbox.enqueue("register_member", {"member_id": mid})
+
+    accepted = {"message": f"Member {first_name} {last_name} created, Nessie account pending", "member_id": mid}
+    return await outbox.respond(operation, wait, accepted, 400, "Nessie account creation failed")
+
+async def _create_nessie_accounts(operation: Operation) -> Dict[str, Any]:
+    # Steps already recorded on the member by an earlier attempt are not repeated.
+    member = database.members_db.get(operation.payload["member_id"])
+    if member is None:
+        raise LookupError("member no longer exists")
+    if not member.nessie_customer_id:
+        nessie_customer = await create_nessie_customer(member.first_name, member.last_name)
+
+        def record_customer():
+            with database.member_locks(member.id):
+                member.nessie_customer_id = nessie_customer['_id']
+                database.mark_dirty("members", member.id)
+        await asyncio.to_thread(database.commit_now, record_customer)
+    if member.nessie_account_id:
+        return {"nessie_account": member.nessie_account_id[0]}
+    # Step 2 — Create a checking account for that customer
+    return {"nessie_account": await create_nessie_account(member.nessie_customer_id, member.first_name)}
+
+def _record_nessie_account(operation: Operation, result: Dict[str, Any]) -> Dict[str, Any]:
+    member = database.members_db[operation.payload["member_id"]]
+    nessie_account = result["nessie_account"]
+    with database.member_locks(member.id):
+        if not member.nessie_account_id:
+            member.nessie_account_id.append(nessie_account)
+            database.mark_dirty("members", member.id)
     return {
-        "message": f"Member {first_name} {last_name} created successfully",
-        "member_id": mid,
-        "nessie_customer_id": nessie_customer_id,
+        "message": f"Member {member.first_name} {member.last_name} created successfully",
+        "member_id": member.id,
+        "nessie_customer_id": member.nessie_customer_id,
         "nessie_account_id": nessie_account["_id"],
         "starting_balance": nessie_account["balance"]
     }
 
+def _drop_member(operation: Operation, error: str) -> None:
+    # Without a Nessie account the member cannot pay; remove them as registration used to.
+    member_id = operation.payload["member_id"]
+    with database.member_locks(member_id):
+        member = database.members_db.get(member_id)
+        if member is not None and not member.nessie_account_id and not member.family_id:
+            del database.members_db[member_id]
+            database.mark_dirty("members", member_id)
+
+outbox.register("register_member", _create_nessie_accounts, _record_nessie_account, _drop_member,
+                rerun=True)  # a repeat at worst leaves an unused Nessie customer or account
+
 @router.get('/{member_id}')
-def get_member(member_id: str):
+def get_member(member_id: str, request: Request):
     member = database.members_db.get(member_id)
     if not member:
         raise HTTPException(404, "Member not found")
-    return member.model_dump()
+    return responses.cached_json(request, ("member", member_id), [("members", member_id)], member.model_dump)
 
 @router.post("/{family_id}/add/{member_id}")
 def add_member(family_id: str, member_id: str):
@@ -91,47 +104,77 @@ def add_member(family_id: str, member_id: str):
 
     family.members.append(member.id)
     database.members_db.get(member_id).family_id = family_id
+    database.mark_dirty("families", family_id)
+    database.mark_dirty("members", member_id)
     return {"message": "f{member.first_name} {member.last_name} added to {family.name} family"}
 
+def page_transactions(member: Member, field: str, limit: int, cursor: int):
+    # `cursor` is a position in the member's oldest-first history, archived segments included;
+    # only the page is loaded.
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    transactions, next_cursor = history.page(member, field, max(cursor, 0), limit)
+    return {"transactions": transactions, "next_cursor": next_cursor}
+
 @router.get("/{member_id}/transactions")
-def get_member_transactions(member_id: str):
+def get_member_transactions(member_id: str, limit: int = 50, cursor: int = 0):
     member = database.members_db.get(member_id)
-    return member.transactions
+    if not member:
+        raise HTTPException(404, "Member not found")
+    return page_transactions(member, "transactions", limit, cursor)
 
 @router.get("/{member_id}/borrower_transactions")
-def get_borrower_transactions(member_id: str):
+def get_borrower_transactions(member_id: str, limit: int = 50, cursor: int = 0):
     member = database.members_db.get(member_id)
+    if not member:
+        raise HTTPException(404, "Member not found")
+    return page_transactions(member, "tracked_transactions", limit, cursor)
 
-    return member.tracked_transactions
+def _first_named(first_name: str) -> Optional[Member]:
+    # The first member with this name in members_db order, as a scan would find; the index
+    # narrows the candidates, and only a shared name needs the order.
+    found = database.lookup("members_by_name", first_name)
+    if len(found) > 1:
+        candidates = set(found)
+        found = [next((m for m in database.members_db if m in candidates), found[0])]
+    return database.members_db[found[0]] if found else None
 
 @router.get("/thegoat/bakra")
 def get_bakra():
-    for member_id, member in database.members_db.items():
-        print(member.first_name)
-        if member.first_name == "Aiyaz":
-            return member
-        
+    member = _first_named("Aiyaz")
+    if member is not None:
+        return member
+
     raise HTTPException(404, "Bakra not found")
 
 @router.get("/thegoat/cakra")
 def get_bakra():
-    for member_id, member in database.members_db.items():
-        print(member.first_name)
-        if member.first_name == "Chinmay":
-            return member
-        
+    member = _first_named("Chinmay")
+    if member is not None:
+        return member
+
     raise HTTPException(404, "Cakra not found")
 
 @router.get("/thegoat/dakra")
 def get_bakra():
-    for member_id, member in database.members_db.items():
-        print(member.first_name)
-        if member.first_name == "Connor":
-            return member
-        
+    member = _first_named("Connor")
+    if member is not None:
+        return member
+
     raise HTTPException(404, "Dakra not found")
 
 @router.get("/{member_id}/get_indebted_to")
 def get_indebted_to(member_id: str):
     member = database.members_db.get(member_id)
-    return member.debts
\ No newline at end of file
+    return member.debts
+
+@router.get("/{member_id}/owed_by")
+def get_owed_by(member_id: str):
+    # Reverse of get_indebted_to: {borrower_id: amount_owed} for everyone who owes this member.
+    if member_id not in database.members_db:
+        raise HTTPException(404, "Member not found")
+    owed = {}
+    for borrower_id in database.lookup("borrowers_by_lender", member_id):
+        amount = database.members_db[borrower_id].debts.get(member_id)
+        if amount is not None:
+            owed[borrower_id] = amount
+    return owed
\ No newline at end of file
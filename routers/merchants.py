@@ -1,39 +1,26 @@
 # backend/routers/merchants.py
 from fastapi import APIRouter, HTTPException
-from routers.nessie import list_merchants, nessie_make_purchase, get_nessie_account_balance
+from routers.nessie import list_merchants, nessie_make_purchase, create_nessie_merchant, merchant_catalog, balance_cache
 import database
-import uuid, httpx, os
-from models import Merchants, Transaction
+import nessie_client
+import outbox
+import uuid
+from typing import Any, Dict, Optional, Tuple
+from models import Merchants, Operation, Transaction
 
 router = APIRouter()
-NESSIE_API_KEY = os.getenv("NESSIE_API_KEY")
-BASE_URL = "http://api.nessieisreal.com"
 
 @router.get("/")
-async def get_merchants(limit: int = 5):
-    """Fetch a few merchants from Nessie (e.g., Target, Walmart)."""
+async def get_merchants(limit: int = 5, offset: int = 0, category: Optional[str] = None):
+    """Fetch a page of Nessie merchants (e.g., Target, Walmart), optionally by category."""
     try:
-        merchants = await list_merchants(limit)
-        return {"count": len(merchants), "merchants": merchants}
+        merchants, total = await list_merchants(limit, offset, category)
+        return {"count": len(merchants), "total": total, "merchants": merchants}
+    except nessie_client.NessieError:
+        raise  # 503/504 from the app's handlers
     except Exception as e:
         raise HTTPException(500, f"Failed to fetch merchants: {e}")
 
-async def create_nessie_merchant(name: str, category: str, address: dict, geocode: dict):
-    """
-    Create a merchant in the real Nessie API and return the created object.
-    """
-    payload = {
-        "name": name,
-        "category": category,
-        "address": address,
-        "geocode": geocode
-    }
-
-    async with httpx.AsyncClient() as client:
-        res = await client.post(f"{BASE_URL}/merchants?key={NESSIE_API_KEY}", json=payload)
-        res.raise_for_status()
-        return res.json()["objectCreated"]
-
 @router.post("/create")
 async def create_merchant(name: str, category: str, city: str = "Austin", state: str = "TX"):
     """
@@ -51,8 +38,11 @@ async def create_merchant(name: str, category: str, city: str = "Austin", state:
 
     try:
         nessie_obj = await create_nessie_merchant(name, category, address, geocode)
+    except nessie_client.NessieError:
+        raise
     except Exception as e:
         raise HTTPException(500, f"Failed to create merchant in Nessie: {e}")
+    merchant_catalog.add(nessie_obj)
 
     # Create local merchant object
     local_id = str(uuid.uuid4())
@@ -64,6 +54,7 @@ async def create_merchant(name: str, category: str, city: str = "Austin", state:
     )
 
     database.merchants_db[local_id] = merchant
+    database.mark_dirty("merchants", local_id)
 
     return {
         "message": f"Merchant '{name}' created successfully",
@@ -73,47 +64,84 @@ async def create_merchant(name: str, category: str, city: str = "Austin", state:
         "address": address
     }
 
-@router.post("/pay")
-async def pay_merchant(member_id: str, merchant_id: str, amount: float, desc: str = "Merchant purchase"):
-    """Allow a user to pay a merchant using their Nessie account."""
+# Holds this process placed for queued purchases: operation ID -> (account ID, amount)
+_holds: Dict[str, Tuple[str, float]] = {}
+
+@router.post("/pay", status_code=202)
+@database.durable
+async def pay_merchant(member_id: str, merchant_id: str, amount: float, desc: str = "Merchant purchase",
+                       wait: float = 0):
+    """Allow a user to pay a merchant using their Nessie account.
+
+    The purchase is queued and sent to Nessie in the background: the reply is 202 with an
+    operation to poll at /operations/{id}, or the purchase itself if it completes within `wait`
+    seconds.
+    """
     member = database.members_db.get(member_id)
     if not member:
         raise HTTPException(404, "Member not found")
 
+    if not member.nessie_account_id:
+        # registration still pending, or it failed for a member kept for their family
+        raise HTTPException(409, "Nessie account not ready for this member")
     account_id = member.nessie_account_id[0]["_id"]
 
-    # Check Nessie balance
-    balance = await get_nessie_account_balance(account_id)
-    if balance < amount:
+    # Check Nessie balance (cached; re-read from Nessie only when stale or close to the amount),
+    # then hold the amount so concurrent purchases cannot spend the same balance twice. The
+    # hold lasts until the queued purchase lands or is given up.
+    balance = await balance_cache.check(account_id, amount)
+    if not balance_cache.reserve(account_id, amount, balance):
         raise HTTPException(400, f"Insufficient balance (${balance} available)")
 
-    # Execute Nessie purchase
+    operation = outbox.enqueue("purchase", {
+        "member_id": member_id, "account_id": account_id, "merchant_id": merchant_id,
+        "amount": amount, "desc": desc})
+    _holds[operation.id] = (account_id, amount)
+    accepted = {"message": f"{member.first_name}'s purchase at {desc} is queued", "merchant_id": merchant_id}
+    return await outbox.respond(operation, wait, accepted, 500, "Purchase failed")
+
+async def _send_purchase(operation: Operation) -> Dict[str, Any]:
+    p = operation.payload
     try:
-        purchase = await nessie_make_purchase(account_id, merchant_id, amount, desc)
+        purchase = await nessie_make_purchase(p["account_id"], p["merchant_id"], p["amount"], p["desc"])
     except Exception as e:
-        raise HTTPException(500, f"Purchase failed: {e}")
-
-    # Update transaction state.
-    mid = str(uuid.uuid4())
-    transaction = Transaction(
-        id=mid,
-        type_transaction="purchased",
-        amount=amount,
-        from_id = member_id,
-        to_id = merchant_id,
-        from_name = member.first_name + " " + member.last_name,
-        to_name = desc,
-        from_debt=member.current_debt,
-        to_debt=0)
-    
-    database.members_db[member_id].balance -= amount
-    database.members_db[member.id].transactions.append(transaction)
-    for k in member.debts:
-        database.members_db[k].transactions.append(transaction)
+        if outbox.uncertain(e):
+            # Nessie may have charged the account: not "failed", which a client would retry
+            raise outbox.OutcomeUnknown(f"purchase may have gone through: {e}") from e
+        raise
+    return {"purchase_id": purchase["_id"]}
+
+def _record_purchase(operation: Operation, result: Dict[str, Any]) -> Dict[str, Any]:
+    # Runs once Nessie has taken the purchase; the transaction shares the operation's ID.
+    p = operation.payload
+    _release(operation)
+    member = database.members_db[p["member_id"]]
+    with database.member_locks(member.id):
+        transaction = Transaction(
+            id=operation.id,
+            type_transaction="purchased",
+            amount=p["amount"],
+            from_id=member.id,
+            to_id=p["merchant_id"],
+            from_name=member.first_name + " " + member.last_name,
+            to_name=p["desc"],
+            from_debt=member.current_debt,
+            to_debt=0)
+
+        member.balance -= p["amount"]
+        database.record_transaction(transaction, member.id, *member.debts)
+        new_balance = member.balance
 
     return {
-        "message": f"{member.first_name} spent ${amount} at {desc}",
-        "purchase_id": purchase["_id"],
-        "merchant_id": merchant_id,
-        "new_balance": member.balance
-    }
\ No newline at end of file
+        "message": f"{member.first_name} spent ${p['amount']} at {p['desc']}",
+        "purchase_id": result["purchase_id"],
+        "merchant_id": p["merchant_id"],
+        "new_balance": new_balance
+    }
+
+def _release(operation: Operation, error: Optional[str] = None) -> None:
+    hold = _holds.pop(operation.id, None)
+    if hold is not None:
+        balance_cache.release(*hold)
+
+outbox.register("purchase", _send_purchase, _record_purchase, _release)
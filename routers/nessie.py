@@ -1,10 +1,8 @@
 # backend/routers/nessie.py
-import httpx, os
-from dotenv import load_dotenv
+from typing import Optional
 
-load_dotenv()
-NESSIE_API_KEY = os.getenv("NESSIE_API_KEY")
-BASE_URL = "http://api.nessieisreal.com"
+import nessie_client
+from nessie_cache import BalanceCache, MerchantCatalog
 
 # Create a new Nessie customer
 async def create_nessie_customer(first_name: str, last_name: str):
@@ -20,10 +18,9 @@ async def create_nessie_customer(first_name: str, last_name: str):
         }
     }
 
-    async with httpx.AsyncClient() as client:
-        res = await client.post(f"{BASE_URL}/customers?key={NESSIE_API_KEY}", json=payload)
-        res.raise_for_status()
-        return res.json()["objectCreated"]
+    res = await nessie_client.request("POST", "/customers", route="create_customer", json=payload)
+    res.raise_for_status()
+    return res.json()["objectCreated"]
 
 # Create a default checking account
 async def create_nessie_account(customer_id: str, name: str):
@@ -34,29 +31,30 @@ async def create_nessie_account(customer_id: str, name: str):
         "balance": 500
     }
     
-    async with httpx.AsyncClient() as client:
-        res = await client.post(
-            f"{BASE_URL}/customers/{customer_id}/accounts?key={NESSIE_API_KEY}",
-            json=payload
-        )
-        res.raise_for_status()
-        return res.json()["objectCreated"]
+    res = await nessie_client.request("POST", f"/customers/{customer_id}/accounts", route="create_account", json=payload)
+    res.raise_for_status()
+    return res.json()["objectCreated"]
 
 # Fetch Nessie account balance
 async def get_nessie_account_balance(account_id: str):
-    async with httpx.AsyncClient() as client:
-        res = await client.get(f"{BASE_URL}/accounts/{account_id}?key={NESSIE_API_KEY}")
-        res.raise_for_status()
-        data = res.json()
-        return data["balance"]
+    res = await nessie_client.request("GET", f"/accounts/{account_id}", route="get_account")
+    res.raise_for_status()
+    data = res.json()
+    return data["balance"]
 
-# Fetch available merchants
-async def list_merchants(limit: int = 5):
-    async with httpx.AsyncClient() as client:
-        res = await client.get(f"{BASE_URL}/merchants?key={NESSIE_API_KEY}")
-        res.raise_for_status()
-        merchants = res.json()
-        return merchants[:limit]  # limit for simplicity
+balance_cache = BalanceCache(get_nessie_account_balance)
+
+# Fetch the full merchant catalog from Nessie
+async def fetch_merchants():
+    res = await nessie_client.request("GET", "/merchants", route="list_merchants")
+    res.raise_for_status()
+    return res.json()
+
+merchant_catalog = MerchantCatalog(fetch_merchants)
+
+# Page through available merchants, served from the cached catalog
+async def list_merchants(limit: int = 5, offset: int = 0, category: Optional[str] = None):
+    return await merchant_catalog.page(offset, limit, category)
 
 
 # Make a purchase at a merchant
@@ -69,13 +67,16 @@ async def nessie_make_purchase(account_id: str, merchant_id: str, amount: float,
         "status": "pending",
         "description": description
     }
-    async with httpx.AsyncClient() as client:
-        res = await client.post(
-            f"{BASE_URL}/accounts/{account_id}/purchases?key={NESSIE_API_KEY}",
-            json=payload
-        )
-        res.raise_for_status()
-        return res.json()["objectCreated"]
+    try:
+        res = await nessie_client.request("POST", f"/accounts/{account_id}/purchases", route="purchase", json=payload)
+    except nessie_client.DeadlineExceeded:
+        balance_cache.invalidate(account_id)  # it may still have gone through
+        raise
+    if res.is_error:
+        balance_cache.invalidate(account_id)
+    res.raise_for_status()
+    balance_cache.adjust(account_id, -amount)
+    return res.json()["objectCreated"]
 
 # Withdraw money from a user's account
 async def nessie_withdraw(account_id: str, amount: float, description: str = "Transfer out"):
@@ -86,13 +87,16 @@ async def nessie_withdraw(account_id: str, amount: float, description: str = "Tr
         "amount": amount,
         "description": description
     }
-    async with httpx.AsyncClient() as client:
-        res = await client.post(
-            f"{BASE_URL}/accounts/{account_id}/withdrawals?key={NESSIE_API_KEY}",
-            json=payload
-        )
-        res.raise_for_status()
-        return res.json()["objectCreated"]
+    try:
+        res = await nessie_client.request("POST", f"/accounts/{account_id}/withdrawals", route="withdrawal", json=payload)
+    except nessie_client.DeadlineExceeded:
+        balance_cache.invalidate(account_id)  # it may still have gone through
+        raise
+    if res.is_error:
+        balance_cache.invalidate(account_id)
+    res.raise_for_status()
+    balance_cache.adjust(account_id, -amount)
+    return res.json()["objectCreated"]
     
 # Deposit money into a user's account
 async def nessie_deposit(account_id: str, amount: float, description: str = "Transfer in"):
@@ -103,10 +107,25 @@ async def nessie_deposit(account_id: str, amount: float, description: str = "Tra
         "amount": amount,
         "description": description
     }
-    async with httpx.AsyncClient() as client:
-        res = await client.post(
-            f"{BASE_URL}/accounts/{account_id}/deposits?key={NESSIE_API_KEY}",
-            json=payload
-        )
-        res.raise_for_status()
-        return res.json()["objectCreated"]
\ No newline at end of file
+    try:
+        res = await nessie_client.request("POST", f"/accounts/{account_id}/deposits", route="deposit", json=payload)
+    except nessie_client.DeadlineExceeded:
+        balance_cache.invalidate(account_id)  # it may still have gone through
+        raise
+    if res.is_error:
+        balance_cache.invalidate(account_id)
+    res.raise_for_status()
+    balance_cache.adjust(account_id, amount)
+    return res.json()["objectCreated"]
+
+# Register a merchant
+async def create_nessie_merchant(name: str, category: str, address: dict, geocode: dict):
+    payload = {
+        "name": name,
+        "category": category,
+        "address": address,
+        "geocode": geocode
+    }
+    res = await nessie_client.request("POST", "/merchants", route="create_merchant", json=payload)
+    res.raise_for_status()
+    return res.json()["objectCreated"]
\ No newline at end of file
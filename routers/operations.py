@@ -0,0 +1,14 @@
+from fastapi import APIRouter, HTTPException
+import database
+import outbox
+
+router = APIRouter()
+
+@router.get("/{operation_id}")
+def get_operation(operation_id: str):
+    # Progress of a Nessie call queued by an endpoint that answered 202
+    database.refresh()
+    operation = database.operations_db.get(operation_id)
+    if operation is None:
+        raise HTTPException(404, "Operation not found")
+    return outbox.describe(operation)
@@ -0,0 +1,36 @@
+import hmac
+import pstats
+
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import FileResponse, PlainTextResponse
+import profiling
+
+def require_token(request: Request):
+    # Profiles show the code's internals: only for callers sending `X-Profile: <PROFILE_TOKEN>`,
+    # and not there at all without a token or with profiling off.
+    if not profiling.ENABLED or not profiling.PROFILE_TOKEN:
+        raise HTTPException(404, "Not Found")
+    if not hmac.compare_digest(request.headers.get("x-profile", "").encode(), profiling.PROFILE_TOKEN.encode()):
+        raise HTTPException(403, "X-Profile token required")
+
+router = APIRouter(dependencies=[Depends(require_token)])
+
+@router.get("/")
+def list_profiles():
+    # Aggregated request profiles (see profiling.py), this worker's latest samples included
+    profiling.profiles.save()
+    return profiling.listing()
+
+@router.get("/{name}")
+def get_profile(name: str, format: str = "prof", sort: str = "cumulative", limit: int = 50):
+    # `format=prof` is the pstats file itself; `format=text` the top `limit` functions by `sort`
+    profile = profiling.path(name)
+    if profile is None:
+        raise HTTPException(404, "Profile not found")
+    if format == "prof":
+        return FileResponse(profile, media_type="application/octet-stream", filename=name)
+    if format != "text":
+        raise HTTPException(400, "format must be 'prof' or 'text'")
+    if sort not in pstats.Stats.sort_arg_dict_default:
+        raise HTTPException(400, f"sort must be one of {sorted(pstats.Stats.sort_arg_dict_default)}")
+    return PlainTextResponse(profiling.report(profile, sort, limit))
@@ -1,34 +1,32 @@
 from fastapi import APIRouter, HTTPException
-from models import Member, Transaction, MoneyRequest
+from models import Member, Transaction, MoneyRequest, MoneyRequestItem, ResolutionItem
 import database
 import httpx, uuid, os
 from dotenv import load_dotenv
-from typing import Optional
+from typing import Dict, List, Optional, Tuple
 
 from routers.nessie import create_nessie_customer
 from datetime import datetime
 
 router = APIRouter()
 
-@router.post("/{from_id}/request_money")
-def request_money(from_id: str, to_id: str, amount: float, description: Optional[str] = None):
-    sender = database.members_db.get(from_id)
-    receiver = database.members_db.get(to_id)
+MAX_BULK_ITEMS = 500
 
+def _request_error(sender: Optional[Member], receiver: Optional[Member], amount: float) -> Optional[Tuple[int, str]]:
     if not sender or not receiver:
-        raise HTTPException(status_code=404, detail="Invalid member IDs")
-    
+        return 404, "Invalid member IDs"
     if sender.family_id != receiver.family_id:
-        raise HTTPException(status_code=400, detail="Must be same family")
-
+        return 400, "Must be same family"
     if amount <= 0:
-        raise HTTPException(status_code=400, detail="Amount must be positive")
+        return 400, "Amount must be positive"
+    return None
 
+def _create_request(sender: Member, receiver: Member, amount: float, description: Optional[str]) -> MoneyRequest:
     request_id = str(uuid.uuid4())
     money_request = MoneyRequest(
         id=request_id,
-        from_id=from_id,
-        to_id=to_id,
+        from_id=sender.id,
+        to_id=receiver.id,
         amount=amount,
         description=description,
         date=datetime.now(),
@@ -37,30 +35,48 @@ def request_money(from_id: str, to_id: str, amount: float, description: Optional
 
     database.money_requests_db[request_id] = money_request
     database.members_db[receiver.id].requests[request_id] = money_request
+    database.mark_dirty("money_requests", request_id)
+    database.mark_dirty("members", receiver.id)
+    return money_request
+
+@router.post("/{from_id}/request_money")
+def request_money(from_id: str, to_id: str, amount: float, description: Optional[str] = None):
+    sender = database.members_db.get(from_id)
+    receiver = database.members_db.get(to_id)
+
+    error = _request_error(sender, receiver, amount)
+    if error:
+        raise HTTPException(status_code=error[0], detail=error[1])
+
+    with database.member_locks(from_id, to_id):
+        money_request = _create_request(sender, receiver, amount, description)
 
     return {
         "message": f"Money request of ${amount} sent from {sender.first_name} to {receiver.first_name}",
         "request": money_request.model_dump()
     }
 
-@router.post("/resolve_request/{request_id}")
-def resolve_request(request_id: str, success: bool):
-    if request_id not in database.money_requests_db:
-        raise HTTPException(status_code=404, detail="Request not found")
-
-    request = database.money_requests_db.get(request_id)
+def _resolution_error(request: Optional[MoneyRequest], balances: Dict[str, float]) -> Optional[Tuple[int, str]]:
+    # `balances` holds member balances as they stand at this point of the batch
+    if request is None:
+        return 404, "Request not found"
     sender = database.members_db.get(request.from_id)
     receiver = database.members_db.get(request.to_id)
-    
+
     if not sender or not receiver:
-        raise HTTPException(status_code=404, detail="Invalid member IDs")
-    
+        return 404, "Invalid member IDs"
+
     if sender.family_id != receiver.family_id:
-        raise HTTPException(status_code=400, detail="Must be same family")
-    
-    if receiver.balance - request.amount < 0:
-        raise HTTPException(status_code=400, detail="Amount must be positive")
-    
+        return 400, "Must be same family"
+
+    if balances.get(receiver.id, receiver.balance) - request.amount < 0:
+        return 400, "Amount must be positive"
+    return None
+
+def _apply_resolution(request: MoneyRequest, success: bool) -> None:
+    sender = database.members_db.get(request.from_id)
+    receiver = database.members_db.get(request.to_id)
+
     mid = str(uuid.uuid4())
     transaction = Transaction(
         id=mid,
@@ -74,26 +90,45 @@ def resolve_request(request_id: str, success: bool):
         to_debt=receiver.current_debt)
 
     del database.money_requests_db[request.id]
-    del database.members_db[receiver.id].requests[request_id]
+    del database.members_db[receiver.id].requests[request.id]
+    database.mark_dirty("money_requests", request.id)
+    database.mark_dirty("members", receiver.id)
 
     if success:
         database.members_db[receiver.id].balance = receiver.balance - request.amount
         database.members_db[sender.id].balance = sender.balance + request.amount
         database.members_db[sender.id].current_debt = sender.current_debt + request.amount
 
-        database.members_db[sender.id].transactions.append(transaction)
-        database.members_db[receiver.id].transactions.append(transaction)
+        database.record_transaction(
+            transaction, sender.id, receiver.id, *(k for k in receiver.debts if k != sender.id))
 
-        for k in receiver.debts:
-            if k != sender.id:
-                database.members_db[k].transactions.append(transaction)
-
-        print(request.amount)
         if receiver.id in database.members_db[sender.id].debts:
             database.members_db[sender.id].debts[receiver.id] += request.amount
         else:
             database.members_db[sender.id].debts[receiver.id] = request.amount
-    else:
+        database.mark_dirty("members", sender.id)
+
+def _parties(request_ids: List[str]) -> List[str]:
+    # the members on either side of the given requests, to lock before resolving them
+    ids = []
+    for request_id in request_ids:
+        request = database.money_requests_db.get(request_id)
+        if request is not None:
+            ids += [m for m in (request.from_id, request.to_id) if m]
+    return ids
+
+@router.post("/resolve_request/{request_id}")
+@database.durable
+def resolve_request(request_id: str, success: bool):
+    with database.member_locks(*_parties([request_id])):
+        # checked under the locks: a concurrent call may have resolved it while we waited
+        error = _resolution_error(database.money_requests_db.get(request_id), {})
+        if error:
+            raise HTTPException(status_code=error[0], detail=error[1])
+
+        _apply_resolution(database.money_requests_db[request_id], success)
+
+    if not success:
         return {
             "message": "request declined"
         }
@@ -102,7 +137,94 @@ def resolve_request(request_id: str, success: bool):
         "message": "resolved debt"
     }
 
+def _check_batch_size(items: list) -> None:
+    if len(items) > MAX_BULK_ITEMS:
+        raise HTTPException(400, f"At most {MAX_BULK_ITEMS} items per batch")
+
+def _reject_if_atomic(results: List[dict], atomic: bool) -> None:
+    # An atomic batch with any failed item is rejected whole, reporting every item's outcome.
+    failed = sum(r["status"] == "failed" for r in results)
+    if failed and atomic:
+        for r in results:
+            if r["status"] == "ok":
+                r["status"] = "not applied"
+        raise HTTPException(400, {"message": f"{failed} of {len(results)} items failed validation; "
+                                             "nothing was applied", "results": results})
+
+@router.post("/bulk_request_money")
+@database.durable
+def bulk_request_money(items: List[MoneyRequestItem], atomic: bool = True):
+    """Create many money requests in one call, e.g. a bill split across a family.
+
+    Every item is validated before any is applied. With `atomic` (the default) a single invalid
+    item rejects the whole batch with a 400 listing each item's outcome; otherwise the valid items
+    are created and the invalid ones reported. Either way the batch is applied under
+    database.one_write(), so it is persisted in one write.
+    """
+    _check_batch_size(items)
+    with database.member_locks(*(m for item in items for m in (item.from_id, item.to_id))):
+        results = []
+        for i, item in enumerate(items):
+            error = _request_error(database.members_db.get(item.from_id), database.members_db.get(item.to_id), item.amount)
+            results.append({"index": i, "status": "failed", "status_code": error[0], "error": error[1]}
+                           if error else {"index": i, "status": "ok"})
+        _reject_if_atomic(results, atomic)
+
+        with database.one_write():
+            for item, result in zip(items, results):
+                if result["status"] == "ok":
+                    sender, receiver = database.members_db[item.from_id], database.members_db[item.to_id]
+                    result["request"] = _create_request(sender, receiver, item.amount, item.description).model_dump()
+    created = sum(r["status"] == "ok" for r in results)
+    return {
+        "message": f"{created} of {len(items)} money requests sent",
+        "results": results
+    }
+
+@router.post("/bulk_resolve")
+@database.durable
+def bulk_resolve(items: List[ResolutionItem], atomic: bool = True):
+    """Accept or decline many money requests in one call.
+
+    Items are validated in order against the balances earlier items in the batch leave behind,
+    so a batch that is valid as a whole is valid when applied. `atomic` works as for
+    bulk_request_money.
+    """
+    _check_batch_size(items)
+    # validate and apply under every involved member's lock, so the batch sees no interleaving
+    with database.member_locks(*_parties([item.request_id for item in items])):
+        balances: Dict[str, float] = {}
+        seen = set()
+        results = []
+        for i, item in enumerate(items):
+            request = database.money_requests_db.get(item.request_id)
+            error = (400, "Request appears more than once in this batch") if item.request_id in seen \
+                else _resolution_error(request, balances)
+            if error:
+                results.append({"index": i, "request_id": item.request_id, "status": "failed",
+                                "status_code": error[0], "error": error[1]})
+                continue
+            seen.add(item.request_id)
+            if item.success:
+                sender, receiver = database.members_db[request.from_id], database.members_db[request.to_id]
+                balances[receiver.id] = balances.get(receiver.id, receiver.balance) - request.amount
+                balances[sender.id] = balances.get(sender.id, sender.balance) + request.amount
+            results.append({"index": i, "request_id": item.request_id, "status": "ok"})
+        _reject_if_atomic(results, atomic)
+
+        with database.one_write():
+            for item, result in zip(items, results):
+                if result["status"] == "ok":
+                    _apply_resolution(database.money_requests_db[item.request_id], item.success)
+                    result["message"] = "resolved debt" if item.success else "request declined"
+    resolved = sum(r["status"] == "ok" for r in results)
+    return {
+        "message": f"{resolved} of {len(items)} requests resolved",
+        "results": results
+    }
+
 @router.post("/resolve_debt/{from_id}/{to_id}")
+@database.durable
 def resolve_debt(from_id: str, to_id: str, amount: float):
     # money should be returned back to the lender
     borrower = database.members_db.get(from_id)
@@ -111,40 +233,54 @@ def resolve_debt(from_id: str, to_id: str, amount: float):
     if not lender or not borrower:
         raise HTTPException(404, "Invalid member IDs")
 
-    if to_id not in borrower.debts or borrower.debts[to_id] < amount:
-        raise HTTPException(400, "No such debt to resolve or insufficient debt amount")
+    with database.member_locks(from_id, to_id):
+        if to_id not in borrower.debts or borrower.debts[to_id] < amount:
+            raise HTTPException(400, "No such debt to resolve or insufficient debt amount")
 
-    if borrower.balance < amount:
-        raise HTTPException(400, "Borrower has insufficient balance")
+        if borrower.balance < amount:
+            raise HTTPException(400, "Borrower has insufficient balance")
 
-    database.members_db.get(borrower.id).balance -= amount
-    database.members_db.get(lender.id).balance += amount
+        database.members_db.get(borrower.id).balance -= amount
+        database.members_db.get(lender.id).balance += amount
 
-    database.members_db.get(borrower.id).debts[to_id] -= amount
+        database.members_db.get(borrower.id).debts[to_id] -= amount
 
-    if database.members_db.get(borrower.id).debts[to_id] == 0:
-        del database.members_db.get(borrower.id).debts[to_id]
+        if database.members_db.get(borrower.id).debts[to_id] == 0:
+            del database.members_db.get(borrower.id).debts[to_id]
 
-    mid = str(uuid.uuid4())
-    transaction = Transaction(
-        id=mid,
-        type_transaction="debt resolution",
-        from_id = from_id,
-        amount=amount,
-        to_id = to_id,
-        from_name = borrower.first_name + " " + borrower.last_name,
-        to_name = lender.first_name + " " + lender.last_name,
-        from_debt=borrower.current_debt - amount,
-        to_debt=lender.current_debt)
+        mid = str(uuid.uuid4())
+        transaction = Transaction(
+            id=mid,
+            type_transaction="debt resolution",
+            from_id = from_id,
+            amount=amount,
+            to_id = to_id,
+            from_name = borrower.first_name + " " + borrower.last_name,
+            to_name = lender.first_name + " " + lender.last_name,
+            from_debt=borrower.current_debt - amount,
+            to_debt=lender.current_debt)
 
-    database.members_db[borrower.id].current_debt -= amount
+        database.members_db[borrower.id].current_debt -= amount
 
-    database.members_db[borrower.id].transactions.append(transaction)
-    database.members_db[lender.id].transactions.append(transaction)
+        database.record_transaction(transaction, borrower.id, lender.id)
 
-    return {
-        "message": f"{borrower.first_name} resolved ${amount} of debt to {lender.first_name}",
-        "new_borrower_balance": borrower.balance,
-        "new_lender_balance": lender.balance,
-        "remaining_debt": borrower.debts[to_id]
-    }
\ No newline at end of file
+        return {
+            "message": f"{borrower.first_name} resolved ${amount} of debt to {lender.first_name}",
+            "new_borrower_balance": borrower.balance,
+            "new_lender_balance": lender.balance,
+            "remaining_debt": borrower.debts.get(to_id, 0)
+        }
+
+@router.get("/sent/{member_id}")
+def get_sent_requests(member_id: str):
+    if member_id not in database.members_db:
+        raise HTTPException(404, "Member not found")
+    requests = [database.money_requests_db[rid] for rid in database.lookup("requests_by_from", member_id)]
+    return sorted(requests, key=lambda r: r.date)
+
+@router.get("/received/{member_id}")
+def get_received_requests(member_id: str):
+    if member_id not in database.members_db:
+        raise HTTPException(404, "Member not found")
+    requests = [database.money_requests_db[rid] for rid in database.lookup("requests_by_to", member_id)]
+    return sorted(requests, key=lambda r: r.date)
\ No newline at end of file
@@ -0,0 +1,219 @@
+# Family debt netting: replace every borrower -> lender edge inside a family with the fewest
+# transfers that leave everyone's net position unchanged, then settle them as one batch.
+#
+# With real money the ledger is settled first, under the members' locks, and each transfer is
+# then queued in the outbox as a Nessie withdrawal and deposit. A transfer Nessie refuses is
+# compensated: its ledger entry is reversed (the payer owes the payee its amount again) and a
+# withdrawal already made is paid back. One whose outcome is unknown is left for reconciliation.
+import asyncio
+import logging
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Tuple
+
+import database
+import outbox
+from models import Operation, Transaction
+from routers.nessie import nessie_deposit, nessie_withdraw
+
+
+logger = logging.getLogger(__name__)
+
+
+class SettlementError(Exception):
+    pass
+
+
+@dataclass
+class Transfer:
+    from_id: str
+    to_id: str
+    amount: float
+
+
+@dataclass
+class SettlementPlan:
+    family_id: str
+    transfers: List[Transfer] = field(default_factory=list)
+    edges: List[Tuple[str, str, float]] = field(default_factory=list)  # (borrower, lender, amount)
+
+
+def _cents(amount: float) -> int:
+    return int(round(amount * 100))
+
+def net_transfers(debts: Dict[str, Dict[str, float]]) -> List[Transfer]:
+    """Minimal-count transfers for a {borrower: {lender: amount}} graph.
+
+    Each member's position is what they are owed minus what they owe; the largest debtor
+    pays the largest creditor until one side is even, so there are at most n - 1 transfers.
+    Amounts are netted in integer cents so float residue never produces a stray transfer.
+    """
+    net: Dict[str, int] = {}
+    for borrower, lenders in debts.items():
+        for lender, amount in lenders.items():
+            net[borrower] = net.get(borrower, 0) - _cents(amount)
+            net[lender] = net.get(lender, 0) + _cents(amount)
+    debtors = sorted(((-v, k) for k, v in net.items() if v < 0), reverse=True)
+    creditors = sorted(((v, k) for k, v in net.items() if v > 0), reverse=True)
+    transfers = []
+    i = j = 0
+    while i < len(debtors) and j < len(creditors):
+        owed, debtor = debtors[i]
+        due, creditor = creditors[j]
+        paid = min(owed, due)
+        transfers.append(Transfer(debtor, creditor, paid / 100))
+        debtors[i] = (owed - paid, debtor)
+        creditors[j] = (due - paid, creditor)
+        if owed == paid:
+            i += 1
+        if due == paid:
+            j += 1
+    return transfers
+
+def plan_family(family_id: str) -> SettlementPlan:
+    if family_id not in database.families_db:
+        raise KeyError(family_id)
+    roster = set(database.lookup("members_by_family", family_id))
+    debts: Dict[str, Dict[str, float]] = {}
+    edges = []
+    for borrower_id in roster:
+        # debts to members outside the family are left for resolve_debt
+        owed = {lender: amount for lender, amount in database.members_db[borrower_id].debts.items()
+                if lender in roster and amount > 0}
+        if owed:
+            debts[borrower_id] = owed
+            edges.extend((borrower_id, lender, amount) for lender, amount in owed.items())
+    return SettlementPlan(family_id, net_transfers(debts), edges)
+
+def validate(plan: SettlementPlan) -> None:
+    for borrower_id, lender_id, amount in plan.edges:
+        if database.members_db[borrower_id].debts.get(lender_id) != amount:
+            raise SettlementError("Debts changed while settling; retry")
+    paying: Dict[str, float] = {}
+    for t in plan.transfers:
+        paying[t.from_id] = paying.get(t.from_id, 0.0) + t.amount
+    short = {m: amount for m, amount in paying.items() if database.members_db[m].balance < amount}
+    if short:
+        names = ", ".join(database.members_db[m].first_name for m in short)
+        raise SettlementError(f"Insufficient balance to settle for: {names}")
+
+def apply(plan: SettlementPlan) -> List[Transaction]:
+    """Move the net amounts and clear every settled edge; nothing is applied if validation fails.
+
+    Validation is repeated under the locks of every member involved, so a resolve_debt that
+    lands between planning and applying fails the batch instead of being overwritten.
+    """
+    parties = [m for edge in plan.edges for m in edge[:2]]
+    with database.member_locks(*parties):
+        validate(plan)
+        members = database.members_db
+        touched = set()
+        for borrower_id, lender_id, amount in plan.edges:
+            borrower = members[borrower_id]
+            del borrower.debts[lender_id]
+            borrower.current_debt -= amount
+            touched.add(borrower_id)
+        transactions = []
+        for t in plan.transfers:
+            payer, payee = members[t.from_id], members[t.to_id]
+            payer.balance -= t.amount
+            payee.balance += t.amount
+            transaction = Transaction(
+                id=str(uuid.uuid4()),
+                type_transaction="debt settlement",
+                amount=t.amount,
+                from_id=payer.id,
+                to_id=payee.id,
+                from_name=payer.first_name + " " + payer.last_name,
+                to_name=payee.first_name + " " + payee.last_name,
+                from_debt=payer.current_debt,
+                to_debt=payee.current_debt,
+                description=f"Net settlement of family {plan.family_id}")
+            database.record_transaction(transaction, payer.id, payee.id)
+            transactions.append(transaction)
+            touched.update((payer.id, payee.id))
+        database.mark_dirty("members", *touched)
+        return transactions
+
+def without_accounts(plan: SettlementPlan) -> List[str]:
+    """Members of the plan's transfers that have no Nessie account to move money with."""
+    parties = {m for t in plan.transfers for m in (t.from_id, t.to_id)}
+    return sorted(m for m in parties if not database.members_db[m].nessie_account_id)
+
+def queue_transfers(plan: SettlementPlan, transactions: List[Transaction]) -> List[Operation]:
+    """One outbox operation per transfer apply() recorded; each shares its transaction's ID."""
+    operations = []
+    for transaction in transactions:
+        payer, payee = database.members_db[transaction.from_id], database.members_db[transaction.to_id]
+        operations.append(outbox.enqueue("settlement_transfer", {
+            "family_id": plan.family_id, "transaction_id": transaction.id,
+            "from_id": payer.id, "to_id": payee.id, "amount": transaction.amount,
+            "from_account": payer.nessie_account_id[0]["_id"], "to_account": payee.nessie_account_id[0]["_id"],
+            "description": f"Family settlement {plan.family_id}"}, operation_id=transaction.id))
+    return operations
+
+async def _nessie(call, *args) -> Dict[str, Any]:
+    try:
+        return await call(*args)
+    except Exception as e:
+        if outbox.uncertain(e):
+            raise outbox.OutcomeUnknown(f"{call.__name__} may have gone through: {e}") from e
+        raise
+
+async def _send_transfer(operation: Operation) -> Dict[str, Any]:
+    # The withdrawal is recorded before the deposit is sent, so a retried deposit does not
+    # withdraw a second time.
+    p = operation.payload
+    if not p.get("withdrawal_id"):
+        withdrawal = await _nessie(nessie_withdraw, p["from_account"], p["amount"], p["description"])
+
+        def record_withdrawal():
+            p["withdrawal_id"] = withdrawal["_id"]
+            database.mark_dirty("operations", operation.id)
+        await asyncio.to_thread(database.commit_now, record_withdrawal)
+    deposit = await _nessie(nessie_deposit, p["to_account"], p["amount"], p["description"])
+    return {"transaction_id": p["transaction_id"], "withdrawal_id": p["withdrawal_id"], "deposit_id": deposit["_id"]}
+
+def _reverse_transfer(operation: Operation, error: str) -> None:
+    p = operation.payload
+    if operation.status == "unknown":
+        logger.error("settlement transfer %s of family %s needs reconciling: %s", operation.id, p["family_id"], error)
+        return
+    # Nessie refused the transfer: the payer still owes the payee what it was meant to settle.
+    members = database.members_db
+    with database.member_locks(p["from_id"], p["to_id"]):
+        payer, payee = members[p["from_id"]], members[p["to_id"]]
+        payer.balance += p["amount"]
+        payee.balance -= p["amount"]
+        payer.debts[payee.id] = payer.debts.get(payee.id, 0) + p["amount"]
+        payer.current_debt += p["amount"]
+        transaction = Transaction(
+            id=str(uuid.uuid4()),
+            type_transaction="debt settlement reversed",
+            amount=p["amount"],
+            from_id=payee.id,
+            to_id=payer.id,
+            from_name=payee.first_name + " " + payee.last_name,
+            to_name=payer.first_name + " " + payer.last_name,
+            from_debt=payee.current_debt,
+            to_debt=payer.current_debt,
+            description=f"Nessie transfer failed: {error}")
+        database.record_transaction(transaction, payer.id, payee.id)
+        database.mark_dirty("members", payer.id, payee.id)
+    if p.get("withdrawal_id"):
+        outbox.enqueue("settlement_refund", {
+            "family_id": p["family_id"], "account_id": p["from_account"], "amount": p["amount"],
+            "description": f"Refund of family settlement {p['family_id']}"}, operation_id=f"{operation.id}-refund")
+
+async def _send_refund(operation: Operation) -> Dict[str, Any]:
+    p = operation.payload
+    deposit = await _nessie(nessie_deposit, p["account_id"], p["amount"], p["description"])
+    return {"deposit_id": deposit["_id"]}
+
+def _refund_failed(operation: Operation, error: str) -> None:
+    # The ledger is already reversed; only Nessie is short the payer's money now.
+    logger.error("refund %s of family %s settlement needs reconciling: %s", operation.id,
+                 operation.payload["family_id"], error)
+
+outbox.register("settlement_transfer", _send_transfer, fail=_reverse_transfer)
+outbox.register("settlement_refund", _send_refund, fail=_refund_failed)
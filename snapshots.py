@@ -0,0 +1,267 @@
+"""Binary snapshots: the json backend's on-disk image, loaded through mmap without validation.
+
+Layout of data/snapshot.bin:
+
+    MAGIC | record, record, ... | index | u64 index offset | MAGIC
+
+Each record is one marshal-encoded row: the JSON-mode dict of a Pydantic model, or the tuple
+from TransactionRecord.to_row(). The index is a marshalled {store: (keys, offsets)}: keys in
+sorted order, so a lookup is a bisect rather than a dict built at startup, and offsets an
+array('Q') of n + 1 absolute file positions, so record i of a store spans offsets[i]:offsets[i + 1]. The file is only ever written by this process's own compaction and
+swapped in with a rename, so rows are trusted: they are rebuilt with model_construct instead of
+being validated field by field.
+
+JSON stays the interchange format:
+
+    python -m snapshots export DIR   # one <store>.json per store, the old snapshot layout
+    python -m snapshots import DIR   # validate, replace every store, persist
+"""
+import datetime
+import marshal
+import mmap
+import os
+import struct
+import sys
+import threading
+import typing
+from array import array
+from bisect import bisect_left
+from collections.abc import MutableMapping
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from pydantic import BaseModel
+
+MAGIC = b"C360SNP1"
+_TRAILER = struct.Struct("<Q")
+
+
+def is_lazy(model: type) -> bool:
+    # Storage records (records.py) stay in the mapped file until first read; models are
+    # few and small, and are built at load.
+    return hasattr(model, "from_row")
+
+def to_row(model: type, plain: Dict[str, Any]) -> Any:
+    return model.from_plain(plain).to_row() if is_lazy(model) else plain
+
+
+# -- trusted construction ---------------------------------------------------------------------
+
+_trusted: Dict[type, Callable[[Dict[str, Any]], BaseModel]] = {}
+
+def trusted(model: type) -> Callable[[Dict[str, Any]], BaseModel]:
+    """A decoder for JSON-mode dicts we wrote ourselves: model_construct plus the few
+    conversions validation would have done (datetimes and nested models)."""
+    decoder = _trusted.get(model)
+    if decoder is None:
+        converters = {}
+        for name, field in model.model_fields.items():
+            convert = _converter(field.annotation)
+            if convert is not None:
+                converters[name] = convert
+        fields = tuple(model.model_fields)
+        construct = model.model_construct
+        new = model.__new__
+        setattr_ = object.__setattr__
+
+        def decoder(plain: Dict[str, Any]) -> BaseModel:
+            for name, convert in converters.items():
+                value = plain.get(name)
+                if value is not None:
+                    plain[name] = convert(value)
+            if tuple(plain) != fields:
+                return construct(**plain)  # fill in defaults
+            # A complete dump in field order is already the instance's __dict__; this is what
+            # model_construct ends up doing, minus its per-field default handling.
+            instance = new(model)
+            setattr_(instance, "__dict__", plain)
+            setattr_(instance, "__pydantic_fields_set__", set(fields))
+            setattr_(instance, "__pydantic_extra__", None)
+            setattr_(instance, "__pydantic_private__", None)
+            return instance
+
+        _trusted[model] = decoder
+    return decoder
+
+def _converter(annotation: Any) -> Optional[Callable[[Any], Any]]:
+    origin, args = typing.get_origin(annotation), typing.get_args(annotation)
+    if origin is typing.Union:
+        options = [a for a in args if a is not type(None)]
+        return _converter(options[0]) if len(options) == 1 else None
+    if annotation is datetime.datetime:
+        return lambda v: v if isinstance(v, datetime.datetime) else datetime.datetime.fromisoformat(v)
+    if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+        return lambda v: trusted(annotation)(v) if isinstance(v, dict) else v
+    if origin in (list, List) and args:
+        item = _converter(args[0])
+        return (lambda v: [item(x) for x in v]) if item else None
+    if origin in (dict, Dict) and len(args) == 2:
+        item = _converter(args[1])
+        return (lambda v: {k: item(x) for k, x in v.items()}) if item else None
+    return None
+
+
+# -- reading ----------------------------------------------------------------------------------
+
+class Snapshot:
+    """An open snapshot file. The mapping stays valid after a newer snapshot replaces the file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        mm = self._mm
+        end = len(mm) - len(MAGIC)
+        if mm[:len(MAGIC)] != MAGIC or mm[end:] != MAGIC:
+            raise ValueError(f"{path} is not a snapshot file")
+        (index_at,) = _TRAILER.unpack(mm[end - _TRAILER.size:end])
+        self.index: Dict[str, Tuple[List[str], array]] = {}
+        for store, (keys, offsets) in marshal.loads(mm[index_at:end - _TRAILER.size]).items():
+            positions = array("Q")
+            positions.frombytes(offsets)
+            self.index[store] = (keys, positions)
+
+    def keys(self, store: str) -> List[str]:
+        return self.index.get(store, ([], None))[0]
+
+    def raw(self, store: str, i: int) -> bytes:
+        offsets = self.index[store][1]
+        return self._mm[offsets[i]:offsets[i + 1]]
+
+    def row(self, store: str, i: int) -> Any:
+        return marshal.loads(self.raw(store, i))
+
+    def load(self, store: str, model: type) -> MutableMapping:
+        if is_lazy(model):
+            return SnapshotMapping(self, store, model)
+        decode = trusted(model)
+        return {key: decode(self.row(store, i)) for i, key in enumerate(self.keys(store))}
+
+
+class SnapshotMapping(MutableMapping):
+    """Dict-like store whose records are decoded from the snapshot on first access.
+
+    Startup only loads the key index; each record costs one marshal.loads the first time it
+    is read, and stays cached after that. Records set or deleted since load shadow the snapshot.
+    """
+
+    def __init__(self, snapshot: Snapshot, store: str, model: type):
+        self.store = store
+        self.model = model
+        self._base = (snapshot, snapshot.keys(store))  # swapped as one by rebase()
+        self._cache: Dict[str, Any] = {}
+        self._deleted: set = set()  # snapshot keys deleted since load
+        self._new: set = set()  # keys set since load that the snapshot does not have
+
+    def rebase(self, snapshot: Snapshot) -> None:
+        # After compaction: the new snapshot holds everything cached here that was written by
+        # then, and later writes are still cached, so only the index changes. The key sets are
+        # pruned in place, after the swap, so keys set or deleted meanwhile are not lost.
+        self._base = (snapshot, snapshot.keys(self.store))
+        keys = self._base[1]
+        for key in list(self._new):
+            if self._position(keys, key) >= 0:
+                self._new.discard(key)
+        for key in list(self._deleted):
+            if self._position(keys, key) < 0:
+                self._deleted.discard(key)
+
+    @staticmethod
+    def _position(keys: List[str], key: object) -> int:
+        i = bisect_left(keys, key) if isinstance(key, str) else len(keys)
+        return i if i < len(keys) and keys[i] == key else -1
+
+    def __getitem__(self, key: str) -> Any:
+        value = self._cache.get(key)
+        if value is not None:
+            return value
+        if key in self._deleted:
+            raise KeyError(key)
+        snapshot, keys = self._base
+        i = self._position(keys, key)
+        if i < 0:
+            raise KeyError(key)
+        return self._cache.setdefault(key, self.model.from_row(snapshot.row(self.store, i)))
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        self._cache[key] = value
+        self._deleted.discard(key)
+        if self._position(self._base[1], key) < 0:
+            self._new.add(key)
+
+    def __delitem__(self, key: str) -> None:
+        if key not in self:
+            raise KeyError(key)
+        self._cache.pop(key, None)
+        self._new.discard(key)
+        self._deleted.add(key)
+
+    def __contains__(self, key: object) -> bool:
+        if key in self._cache:
+            return True
+        return key not in self._deleted and self._position(self._base[1], key) >= 0
+
+    def __iter__(self) -> Iterator[str]:
+        for key in self._base[1]:
+            if key not in self._deleted:
+                yield key
+        yield from list(self._new)
+
+    def __len__(self) -> int:
+        # Cheap enough for a metrics scrape: only the deletions since the last compaction are
+        # looked at.
+        keys = self._base[1]
+        removed = sum(1 for key in list(self._deleted) if self._position(keys, key) >= 0)
+        return len(keys) - removed + len(self._new)
+
+    def clear(self) -> None:
+        for key in list(self):
+            del self[key]
+
+
+# -- writing ----------------------------------------------------------------------------------
+
+def write(path: str, stores: Dict[str, Iterable[Tuple[str, bytes]]]) -> None:
+    """Write a snapshot of already marshalled rows, as (key, blob) pairs per store in key
+    order, atomically."""
+    p = Path(path)
+    p.parent.mkdir(parents=True, exist_ok=True)
+    tmp = p.with_name(f"{p.name}.{os.getpid()}-{threading.get_ident()}.tmp")  # one per writer
+    index = {}
+    with tmp.open("wb") as f:
+        f.write(MAGIC)
+        for store, rows in stores.items():
+            keys, offsets = [], array("Q", [f.tell()])
+            for key, blob in rows:
+                f.write(blob)
+                keys.append(key)
+                offsets.append(f.tell())
+            index[store] = (keys, offsets.tobytes())
+        index_at = f.tell()
+        f.write(marshal.dumps(index))
+        f.write(_TRAILER.pack(index_at))
+        f.write(MAGIC)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, p)
+
+
+# -- JSON import / export ---------------------------------------------------------------------
+
+def main(argv: List[str]) -> None:
+    import database
+
+    if len(argv) != 2 or argv[0] not in ("export", "import"):
+        sys.exit("usage: python -m snapshots export|import DIR")
+    command, directory = argv
+    database.init()
+    if command == "export":
+        database.export_json(directory)
+    else:
+        database.import_json(directory)
+        database.compact()
+    print(f"{command}ed {', '.join(f'{len(database._mapping(n))} {n}' for n in database.STORES)}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
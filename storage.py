@@ -0,0 +1,563 @@
+import heapq
+import json
+import marshal
+import os
+import sqlite3
+import threading
+from collections.abc import MutableMapping
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+import snapshots
+from snapshots import Snapshot, SnapshotMapping
+
+# (store, key, plain record, encoded record); record is None for a delete
+Op = Tuple[str, str, Optional[Dict[str, Any]], Optional[str]]
+
+# Shared mode keeps this many change_log entries; a worker that falls further behind reloads
+# everything it has cached.
+CHANGE_LOG_KEEP = int(os.getenv("CHANGE_LOG_KEEP", 100_000))
+
+
+def decode(model: type, plain: Dict[str, Any], trusted: bool = False) -> Any:
+    # Stores hold either Pydantic models or storage records with from_plain (records.py).
+    # `trusted` skips validation for records this app encoded itself (snapshots, journal, rows).
+    from_plain = getattr(model, "from_plain", None)
+    if from_plain is not None:
+        return from_plain(plain)
+    return snapshots.trusted(model)(plain) if trusted else model.model_validate(plain)
+
+def decode_json(model: type, text: str, trusted: bool = False) -> Any:
+    if trusted or hasattr(model, "from_plain"):
+        return decode(model, json.loads(text), trusted)
+    return model.model_validate_json(text)
+
+def encode(value: Any) -> Dict[str, Any]:
+    to_plain = getattr(value, "to_plain", None)
+    return to_plain() if to_plain is not None else value.model_dump(mode="json")
+
+
+def _assign(target: Any, source: Any) -> None:
+    # Copy every field of `source` onto `target`, for models and slotted records alike.
+    if hasattr(target, "__dict__"):
+        target.__dict__.update(source.__dict__)
+    else:
+        for name in target.__slots__:
+            setattr(target, name, getattr(source, name))
+
+
+class WriteConflict(Exception):
+    """Another worker changed these records since they were read; nothing was written."""
+
+    def __init__(self, keys: List[Tuple[str, str]]):
+        super().__init__(f"{len(keys)} record(s) changed by another worker")
+        self.keys = keys
+
+
+def read_json_file(path: str) -> Dict[str, Any]:
+    p = Path(path)
+    if not p.exists() or p.stat().st_size == 0:
+        return {}
+    return json.loads(p.read_text(encoding="utf-8"))
+
+def write_text_atomic(path: str, text: str) -> None:
+    # Write next to the target and rename over it, so readers see the old file or the new one.
+    p = Path(path)
+    p.parent.mkdir(parents=True, exist_ok=True)
+    tmp = p.with_name(p.name + ".tmp")
+    with tmp.open("w", encoding="utf-8") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, p)
+
+def write_json_file(path: str, obj: Any) -> None:
+    write_text_atomic(path, json.dumps(obj, ensure_ascii=False, indent=2))
+
+def write_encoded_mapping(path: str, encoded: Dict[str, str]) -> None:
+    # Records are already serialized, so a write is a join rather than a full re-encode.
+    body = ",\n".join(f"{json.dumps(k, ensure_ascii=False)}: {v}" for k, v in encoded.items())
+    write_text_atomic(path, "{\n" + body + "\n}")
+
+
+class JsonStorage:
+    """A binary snapshot in data/snapshot.bin plus an append-only journal.
+
+    Every write() appends one line of [store, key, record-or-null] ops; load() maps the snapshot
+    (snapshots.py) and replays the journal over it, and compact() folds the journal into a new
+    snapshot once it grows past the threshold. Data from before the binary format, one
+    data/<store>.json per store, is read and validated once and compacted into a snapshot; the
+    JSON files are left in place but not read again while snapshot.bin exists.
+    """
+
+    name = "json"
+    snapshot_path = "data/snapshot.bin"
+    journal_path = "data/journal.jsonl"
+    compacting_journal_path = "data/journal.jsonl.compacting"
+
+    def __init__(self, stores: Dict[str, Tuple[str, type]], compact_bytes: int):
+        self.stores = stores
+        self.compact_bytes = compact_bytes
+        self._snapshot: Optional[Snapshot] = None
+        # key -> encoded record, or None if deleted, for everything changed since the snapshot
+        self._encoded: Dict[str, Dict[str, Optional[str]]] = {name: {} for name in stores}
+        self._mappings: Dict[str, Any] = {}
+        self._lock = threading.Lock()  # serializes journal appends and compaction's journal swap
+        self._compact_lock = threading.Lock()  # one compaction at a time
+        self._compacting = False
+
+    def claim(self, name: str) -> bool:
+        # Single process only, so every one-off task is ours.
+        return True
+
+    def _replay_journal(self, path: str, raw: Dict[str, Dict[str, Any]]) -> None:
+        # Leaves None for deleted keys, so deletes of snapshot records survive the replay.
+        p = Path(path)
+        if not p.exists():
+            return
+        with p.open("rb+") as f:
+            for line in iter(f.readline, b""):
+                try:
+                    ops = json.loads(line)
+                except json.JSONDecodeError:
+                    # torn tail from a crash mid-append: everything before it is intact, and
+                    # cutting it off keeps the next append from being glued onto it
+                    f.truncate(f.tell() - len(line))
+                    break
+                for store, key, value in ops:
+                    raw[store][key] = value
+                if not line.endswith(b"\n"):
+                    f.write(b"\n")
+
+    def load(self, upgrade=None) -> Dict[str, Dict[str, Any]]:
+        if not Path("data").is_dir():
+            return {name: {} for name in self.stores}
+        if not Path(self.snapshot_path).exists():
+            return self._load_json(upgrade)
+        self._snapshot = Snapshot(self.snapshot_path)
+        changes: Dict[str, Dict[str, Any]] = {name: {} for name in self.stores}
+        self._replay_journal(self.compacting_journal_path, changes)
+        self._replay_journal(self.journal_path, changes)
+        mappings = {}
+        for name, (_, model) in self.stores.items():
+            mapping = mappings[name] = self._snapshot.load(name, model)
+            for key, value in changes[name].items():
+                if value is None:
+                    mapping.pop(key, None)
+                else:
+                    mapping[key] = decode(model, value, trusted=True)
+            self._encoded[name] = {k: None if v is None else json.dumps(v, ensure_ascii=False)
+                                   for k, v in changes[name].items()}
+        self._mappings = mappings
+        return mappings
+
+    def _load_json(self, upgrade) -> Dict[str, Dict[str, Any]]:
+        # JSON snapshots from before snapshot.bin: validated like any import, then compacted
+        # right away so the next start maps the binary snapshot instead.
+        raw = {name: read_json_file(path) for name, (path, _) in self.stores.items()}
+        self._replay_journal(self.compacting_journal_path, raw)
+        self._replay_journal(self.journal_path, raw)
+        raw = {name: {k: v for k, v in records.items() if v is not None} for name, records in raw.items()}
+        if upgrade is not None:
+            upgrade(raw)
+        mappings = {}
+        for name, (_, model) in self.stores.items():
+            mappings[name] = {k: decode(model, v) for k, v in raw[name].items()}
+            self._encoded[name] = {k: json.dumps(encode(v), ensure_ascii=False) for k, v in mappings[name].items()}
+        self._mappings = mappings
+        if any(raw.values()):
+            self.start_compaction()
+        return mappings
+
+    def write(self, ops: List[Op]) -> None:
+        lines = []
+        with self._lock:
+            for store, key, _, value_json in ops:
+                self._encoded[store][key] = value_json
+                lines.append(f"[{json.dumps(store)}, {json.dumps(key, ensure_ascii=False)}, {value_json or 'null'}]")
+            journal = Path(self.journal_path)
+            journal.parent.mkdir(parents=True, exist_ok=True)
+            with journal.open("a", encoding="utf-8") as f:
+                f.write("[" + ", ".join(lines) + "]\n")
+                f.flush()
+                os.fsync(f.fileno())
+                size = f.tell()
+        if size > self.compact_bytes:
+            self.start_compaction()
+
+    def start_compaction(self) -> None:
+        with self._lock:
+            if self._compacting:
+                return
+            self._compacting = True
+        threading.Thread(target=self.compact, name="journal-compaction", daemon=True).start()
+
+    def compact(self) -> None:
+        # Swap the live journal aside and take the changes since the last snapshot in one step
+        # under the lock, then write the new snapshot without holding it; writes meanwhile start
+        # a fresh journal and a fresh set of changes.
+        try:
+            with self._compact_lock:
+                with self._lock:
+                    journal = Path(self.journal_path)
+                    pending = Path(self.compacting_journal_path)
+                    if journal.exists():
+                        if pending.exists():
+                            # an earlier compaction died before finishing; keep its entries too
+                            with pending.open("a", encoding="utf-8") as f:
+                                f.write(journal.read_text(encoding="utf-8"))
+                            journal.unlink()
+                        else:
+                            journal.rename(pending)
+                    changes, base = self._encoded, self._snapshot
+                    self._encoded = {name: {} for name in self.stores}
+                try:
+                    snapshots.write(self.snapshot_path, {
+                        name: self._rows(base, name, model, changes[name])
+                        for name, (_, model) in self.stores.items()})
+                except BaseException:
+                    with self._lock:
+                        for name in self.stores:
+                            changes[name].update(self._encoded[name])
+                        self._encoded = changes
+                    raise
+                self._snapshot = Snapshot(self.snapshot_path)
+                for mapping in self._mappings.values():
+                    if isinstance(mapping, SnapshotMapping):
+                        mapping.rebase(self._snapshot)  # let the previous file go
+                pending.unlink(missing_ok=True)
+        finally:
+            self._compacting = False
+
+    @staticmethod
+    def _rows(base: Optional[Snapshot], name: str, model: type, changes: Dict[str, Optional[str]]):
+        # Key order, as the snapshot requires; unchanged records are copied across as the
+        # bytes already in the old snapshot.
+        kept = ((key, i) for i, key in enumerate(base.keys(name) if base is not None else ()) if key not in changes)
+        written = ((key, None) for key in sorted(changes) if changes[key] is not None)
+        for key, i in heapq.merge(kept, written):
+            if i is not None:
+                yield key, base.raw(name, i)
+            else:
+                yield key, marshal.dumps(snapshots.to_row(model, json.loads(changes[key])))
+
+
+# Indexed columns per table, pulled out of the record on write; everything else lives in `data`.
+SQLITE_COLUMNS = {
+    "members": ("family_id",),
+    "families": (),
+    "merchants": (),
+    "money_requests": ("from_id", "to_id"),
+    "transactions": ("from_id", "to_id"),
+    "segments": ("family_id",),
+    "operations": ("status",),
+}
+
+
+class SqliteMapping(MutableMapping):
+    """Dict-like view of one SQLite table that loads rows on first access.
+
+    Loaded records stay in an identity map, so routers can keep mutating them in place and
+    calling mark_dirty(); additions and deletions are visible immediately and reach the table
+    on the next sync().
+    """
+
+    def __init__(self, storage: "SqliteStorage", table: str, model: type):
+        self.storage = storage
+        self.table = table
+        self.model = model
+        self._cache: Dict[str, Any] = {}
+        self._versions: Dict[str, int] = {}  # row version each cached record was read at
+        self._unsaved: Set[str] = set()   # set here but not yet written
+        self._deleted: Set[str] = set()   # deleted here but not yet written
+        self._get_sql = f"SELECT data, version FROM {table} WHERE id = ?"
+        self._ids_sql = f"SELECT id, NULL, NULL FROM {table}"
+        self._rows_sql = f"SELECT id, data, version FROM {table}"
+        self._count_sql = f"SELECT COUNT(*) FROM {table}"
+        self._exists_sql = f"SELECT 1 FROM {table} WHERE id = ?"
+
+    def _in_table(self, key: str) -> bool:
+        return self.storage.conn().execute(self._exists_sql, (key,)).fetchone() is not None
+
+    def __getitem__(self, key: str) -> Any:
+        value = self._cache.get(key)
+        if value is not None:
+            return value
+        if key in self._deleted:
+            raise KeyError(key)
+        row = self.storage.conn().execute(self._get_sql, (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return self._cached(key, decode_json(self.model, row[0], trusted=True), row[1])
+
+    def _cached(self, key: str, value: Any, version: int) -> Any:
+        cached = self._cache.setdefault(key, value)
+        if cached is value:
+            self._versions[key] = version
+        return cached
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        self._cache[key] = value
+        self._deleted.discard(key)
+        self._unsaved.add(key)
+
+    def __delitem__(self, key: str) -> None:
+        if key not in self:
+            raise KeyError(key)
+        self._cache.pop(key, None)
+        self._unsaved.discard(key)
+        self._deleted.add(key)
+
+    def __contains__(self, key: object) -> bool:
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self) -> Iterator[str]:
+        return (key for key, _ in self._rows(load=False))
+
+    def __len__(self) -> int:
+        (count,) = self.storage.conn().execute(self._count_sql).fetchone()
+        added = sum(1 for k in list(self._unsaved) if not self._in_table(k))
+        removed = sum(1 for k in list(self._deleted) if self._in_table(k))
+        return count + added - removed
+
+    def _rows(self, load: bool):
+        # One pass over the table instead of a query per key, then records not written yet.
+        pending = set(self._unsaved)
+        for key, data, version in self.storage.conn().execute(self._rows_sql if load else self._ids_sql):
+            pending.discard(key)
+            if key in self._deleted:
+                continue
+            value = self._cache.get(key)
+            if value is None and load:
+                value = self._cached(key, decode_json(self.model, data, trusted=True), version)
+            yield key, value
+        for key in pending:
+            if key in self._cache:
+                yield key, self._cache[key]
+
+    def items(self):
+        return self._rows(load=True)
+
+    def values(self):
+        return (value for _, value in self.items())
+
+    def clear(self) -> None:
+        for key in list(self):
+            del self[key]
+
+    def _written(self, key: str, deleted: bool, version: Optional[int] = None) -> None:
+        (self._deleted if deleted else self._unsaved).discard(key)
+        if deleted:
+            self._versions.pop(key, None)
+        elif version is not None:
+            self._versions[key] = version
+
+    def reload(self, key: str) -> Optional[Any]:
+        """Replace a record with what the table holds now, discarding local changes.
+
+        A cached record is updated in place, so references routers already hold see the new
+        values rather than going stale.
+        """
+        row = self.storage.conn().execute(self._get_sql, (key,)).fetchone()
+        self._unsaved.discard(key)
+        self._deleted.discard(key)
+        if row is None:
+            self._cache.pop(key, None)
+            self._versions.pop(key, None)
+            return None
+        fresh = decode_json(self.model, row[0], trusted=True)
+        cached = self._cache.get(key)
+        if cached is not None:
+            _assign(cached, fresh)
+            fresh = cached
+        self._cache[key] = fresh
+        self._versions[key] = row[1]
+        return fresh
+
+    def cached_keys(self) -> List[str]:
+        return list(self._cache)
+
+
+class SqliteStorage:
+    """One table per model in data/cap360.db, WAL mode, rows loaded on demand.
+
+    Statements are fixed strings with ? parameters, so sqlite3's per-connection statement
+    cache prepares each of them once.
+    """
+
+    name = "sqlite"
+    path = "data/cap360.db"
+
+    def __init__(self, stores: Dict[str, Tuple[str, type]], shared: bool = False,
+                 worker_id: str = ""):
+        self.stores = stores
+        # Shared mode: several processes use this file. Writes check each row's version, log to
+        # change_log, and changes_since() tells a worker what the others wrote.
+        self.shared = shared
+        self.worker_id = worker_id
+        self.last_seq = 0
+        self._writes = 0
+        self._local = threading.local()
+        self.mappings: Dict[str, SqliteMapping] = {}
+        self._upsert_sql = {}
+        self._delete_sql = {}
+        self._insert_sql = {}
+        self._update_sql = {}
+        self._checked_delete_sql = {}
+        for name in stores:
+            columns = ("id",) + SQLITE_COLUMNS[name] + ("data",)
+            self._upsert_sql[name] = (
+                f"INSERT INTO {name} ({', '.join(columns)}, version) VALUES ({', '.join('?' * len(columns))}, 1) "
+                f"ON CONFLICT(id) DO UPDATE SET {', '.join(f'{c} = excluded.{c}' for c in columns[1:])}, "
+                f"version = version + 1"
+            )
+            self._delete_sql[name] = f"DELETE FROM {name} WHERE id = ?"
+            self._insert_sql[name] = (
+                f"INSERT INTO {name} ({', '.join(columns)}, version) VALUES ({', '.join('?' * len(columns))}, 1)")
+            self._update_sql[name] = (
+                f"UPDATE {name} SET {', '.join(f'{c} = ?' for c in columns[1:])}, version = version + 1 "
+                f"WHERE id = ? AND version = ?")
+            self._checked_delete_sql[name] = f"DELETE FROM {name} WHERE id = ? AND version = ?"
+
+    def conn(self) -> sqlite3.Connection:
+        # sqlite3 connections are per thread; WAL lets readers run alongside the flusher's writes.
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.path, isolation_level=None, cached_statements=256)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def load(self, upgrade=None) -> Dict[str, SqliteMapping]:
+        # `upgrade` rewrites legacy JSON layouts, which predate this backend; nothing to do here.
+        conn = self.conn()
+        for name in self.stores:
+            extra = "".join(f", {c} TEXT" for c in SQLITE_COLUMNS[name])
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {name} (id TEXT PRIMARY KEY{extra}, data TEXT NOT NULL, "
+                         f"version INTEGER NOT NULL DEFAULT 1)")
+            if "version" not in {row[1] for row in conn.execute(f"PRAGMA table_info({name})")}:
+                conn.execute(f"ALTER TABLE {name} ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+            for column in SQLITE_COLUMNS[name]:
+                conn.execute(f"CREATE INDEX IF NOT EXISTS {name}_{column} ON {name} ({column})")
+        conn.execute("CREATE TABLE IF NOT EXISTS change_log "
+                     "(seq INTEGER PRIMARY KEY AUTOINCREMENT, store TEXT NOT NULL, id TEXT NOT NULL, writer TEXT NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        (self.last_seq,) = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM change_log").fetchone()
+        self.mappings = {name: SqliteMapping(self, name, model) for name, (_, model) in self.stores.items()}
+        return self.mappings
+
+    def write(self, ops: List[Op]) -> None:
+        if self.shared:
+            return self._write_checked(ops)
+        conn = self.conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for store, key, plain, value_json in ops:
+                if value_json is None:
+                    conn.execute(self._delete_sql[store], (key,))
+                else:
+                    columns = tuple(plain.get(c) for c in SQLITE_COLUMNS[store])
+                    conn.execute(self._upsert_sql[store], (key,) + columns + (value_json,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        for store, key, _, value_json in ops:
+            self.mappings[store]._written(key, value_json is None)
+
+    def _write_checked(self, ops: List[Op]) -> None:
+        # Optimistic concurrency: every row must still be at the version it was read at, or the
+        # whole batch is rolled back and WriteConflict names the rows that moved.
+        conn = self.conn()
+        conflicts = []
+        written = []
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for store, key, plain, value_json in ops:
+                expected = self.mappings[store]._versions.get(key)
+                if value_json is None:
+                    if expected is None:
+                        continue  # created and deleted here without ever being written
+                    ok = conn.execute(self._checked_delete_sql[store], (key, expected)).rowcount == 1
+                elif expected is None:
+                    columns = tuple(plain.get(c) for c in SQLITE_COLUMNS[store])
+                    try:
+                        conn.execute(self._insert_sql[store], (key,) + columns + (value_json,))
+                        ok = True
+                    except sqlite3.IntegrityError:
+                        ok = False
+                else:
+                    columns = tuple(plain.get(c) for c in SQLITE_COLUMNS[store])
+                    ok = conn.execute(self._update_sql[store], columns + (value_json, key, expected)).rowcount == 1
+                if ok:
+                    written.append((store, key, value_json is None, None if expected is None else expected + 1))
+                else:
+                    conflicts.append((store, key))
+            if conflicts:
+                conn.execute("ROLLBACK")
+                raise WriteConflict(conflicts)
+            conn.executemany("INSERT INTO change_log (store, id, writer) VALUES (?, ?, ?)",
+                             [(store, key, self.worker_id) for store, key, _, _ in written])
+            self._writes += 1
+            if self._writes % 500 == 0:
+                conn.execute("DELETE FROM change_log WHERE seq <= (SELECT MAX(seq) FROM change_log) - ?",
+                             (CHANGE_LOG_KEEP,))
+            conn.execute("COMMIT")
+        except WriteConflict:
+            raise
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        for store, key, deleted, version in written:
+            self.mappings[store]._written(key, deleted, 1 if version is None else version)
+
+    def changes_since(self) -> Optional[List[Tuple[str, str]]]:
+        """(store, key) of every row other workers wrote since the last call, oldest first.
+
+        None means the log was trimmed past our position, so the caller must reload everything.
+        """
+        conn = self.conn()
+        rows = conn.execute("SELECT seq, store, id, writer FROM change_log WHERE seq > ? ORDER BY seq",
+                            (self.last_seq,)).fetchall()
+        if not rows:
+            return []
+        behind = rows[0][0] > self.last_seq + 1 and self.last_seq > 0
+        self.last_seq = rows[-1][0]
+        if behind:
+            return None
+        return [(store, key) for _, store, key, writer in rows if writer != self.worker_id]
+
+    def claim(self, name: str) -> bool:
+        # True for exactly one caller across every worker sharing the file, e.g. to seed once.
+        return self.conn().execute("INSERT OR IGNORE INTO meta (key, value) VALUES (?, ?)",
+                                   (name, self.worker_id)).rowcount == 1
+
+    def scan(self, store: str, field: str):
+        # (id, field) for every row, read with json_extract so no record is validated.
+        if field in SQLITE_COLUMNS[store]:
+            rows = self.conn().execute(f"SELECT id, {field} FROM {store}")
+            return iter(rows.fetchall())
+        path = f"$.{field}"
+        rows = self.conn().execute(
+            f"SELECT id, json_extract(data, ?), json_type(data, ?) FROM {store}", (path, path)).fetchall()
+        return ((key, json.loads(value) if kind in ("object", "array") else value) for key, value, kind in rows)
+
+    def compact(self) -> None:
+        self.conn().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+def open_storage(backend: str, stores: Dict[str, Tuple[str, type]], compact_bytes: int,
+                 shared: bool = False, worker_id: str = ""):
+    if backend == "sqlite":
+        return SqliteStorage(stores, shared, worker_id)
+    if shared:
+        raise ValueError("SHARED_STORE=1 (multiple workers) needs STORAGE_BACKEND=sqlite")
+    if backend == "json":
+        return JsonStorage(stores, compact_bytes)
+    raise ValueError(f"Unknown STORAGE_BACKEND {backend!r} (expected 'json' or 'sqlite')")